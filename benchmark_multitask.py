@@ -0,0 +1,295 @@
+import os
+import json
+import time
+import platform
+import tempfile
+import numpy as np
+import pandas as pd
+import torch
+from torch import nn
+from torch.utils.data.dataloader import default_collate
+
+import argparse
+
+from models.model_multitask import HEADS, MultiTaskModel
+from dataset_collate import collate_samples
+from dataset_manifest import build_manifest
+from dataset_multitask import create_batch_transform, create_dataset
+from metrics_multitask import MultiTaskMetrics
+from synthesize_multitask import synthesize
+
+
+def timeit(func, repeats=10, warmup=1):
+    """Median and spread of the wall time of a function.
+    :param func: function without arguments
+    :param repeats: number of timed calls
+    :param warmup: number of untimed calls before
+    :return: dict with median, min and max in ms"""
+    for _ in range(warmup):
+        func()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(1000 * (time.perf_counter() - start))
+    times.sort()
+    return {
+        "median_ms": times[len(times) // 2],
+        "min_ms": times[0],
+        "max_ms": times[-1],
+        "repeats": repeats,
+    }
+
+
+def sample_loop(dataset, n):
+    """Load the first `n` samples of a dataset."""
+    for idx in range(min(n, len(dataset))):
+        dataset[idx]
+
+
+def data_cases(paths, channels, cache_dir, n_items=16):
+    """Benchmarks of the data pipeline on the synthetic dataset.
+    :param paths: paths returned by `synthesize`
+    :param channels: list of channels indices
+    :param cache_dir: path to the dataset cache
+    :param n_items: number of samples per timed call
+    :return: dict mapping case names to functions"""
+    reg_data = pd.read_csv(paths["reg_file"])
+    split_dirs = {
+        "120": ("training/120x120", 120),
+        "300": ("training/300x300", 300),
+    }
+    cases = {}
+    for name, (split, size) in split_dirs.items():
+        datadir = os.path.join(paths["datadir"], split)
+        seglabeldir = os.path.join(paths["seglabeldir"], split)
+        cases["manifest_build_{}".format(name)] = lambda d=datadir, s=seglabeldir: (
+            build_manifest(d, s, reg_data)
+        )
+        kwargs = dict(
+            datadir=datadir,
+            seglabeldir=seglabeldir,
+            reg_data=reg_data,
+            channels=channels,
+            size=size,
+            train=True,
+        )
+        raw = create_dataset(apply_transforms=False, **kwargs)
+        cached = create_dataset(apply_transforms=False, cache_dir=cache_dir, **kwargs)
+        host = create_dataset(cache_dir=cache_dir, **kwargs)
+        device = create_dataset(cache_dir=cache_dir, device_transforms=True, **kwargs)
+        cases["getitem_{}".format(name)] = lambda d=raw: sample_loop(d, n_items)
+        cases["getitem_{}_cached".format(name)] = lambda d=cached: sample_loop(
+            d, n_items
+        )
+
+        # transform chains on preloaded samples, without the file reads
+        raw_samples = [cached[idx] for idx in range(min(n_items, len(cached)))]
+        cases["transforms_host_{}".format(name)] = lambda s=raw_samples, d=host: [
+            d.transform(dict(sample)) for sample in s
+        ]
+
+        samples = [device[idx] for idx in range(min(n_items, len(device)))]
+        batch = default_collate(samples)
+        batch_transform = create_batch_transform(channels, train=True)
+        cases["collate_{}".format(name)] = lambda s=samples: default_collate(s)
+        cases["collate_samples_{}".format(name)] = lambda s=samples: collate_samples(
+            s
+        )
+        cases["transforms_batch_{}".format(name)] = lambda b=batch: batch_transform(
+            b["img"], b["fpt"]
+        )
+    return cases
+
+
+def model_cases(channels, heads, batch_sizes, size=120):
+    """Benchmarks of a training step of `MultiTaskModel` on the CPU.
+    :param channels: list of channels indices
+    :param heads: task heads
+    :param batch_sizes: list of batch sizes
+    :param size: side length of the input tiles
+    :return: dict mapping case names to functions"""
+    model = MultiTaskModel(n_channels=len(channels), n_classes=1, heads=heads)
+    model.train()
+    loss = nn.L1Loss()
+
+    cases = {}
+    for bs in batch_sizes:
+        x = torch.randn(bs, len(channels), size, size)
+        w = torch.randn(bs, 1, 4)
+
+        def step(x=x, w=w):
+            model.zero_grad()
+            seg_output, reg_output, cls_output = model(x, w)
+            (seg_output.mean() + loss(reg_output, reg_output.detach() + 1)).backward()
+
+        cases["forward_backward_bs{}".format(bs)] = step
+    return cases
+
+
+def metric_cases(n_batches=20, bs=16, size=120):
+    """Benchmark of the metric loop of one epoch.
+    :param n_batches: number of updates per timed call
+    :param bs: batch size
+    :param size: side length of the masks
+    :return: dict mapping case names to functions"""
+    metrics = MultiTaskMetrics(torch.device("cpu"))
+    seg_output = torch.randn(bs, 1, size, size)
+    y = (torch.rand(bs, size, size) > 0.9).float()
+    reg_output = torch.rand(bs, 1)
+    e = torch.rand(bs)
+    cls_output = torch.randn(bs, 4)
+    t = torch.randint(0, 4, (bs,))
+    loss = torch.tensor(1.0)
+
+    def epoch():
+        metrics.reset()
+        for _ in range(n_batches):
+            metrics.update(seg_output, y, reg_output, e, cls_output, t, loss=loss)
+        metrics.compute()
+
+    return {"metrics_epoch": epoch}
+
+
+def compare(results, baseline, tolerance):
+    """Compare median times against a baseline.
+    :param results: benchmark results
+    :param baseline: earlier benchmark results
+    :param tolerance: allowed relative slowdown
+    :return: names of the cases slower than the baseline by more than
+        `tolerance`"""
+    regressions = []
+    for name, stats in results["results"].items():
+        if name not in baseline["results"]:
+            continue
+        ratio = stats["median_ms"] / baseline["results"][name]["median_ms"]
+        stats["baseline_ratio"] = ratio
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    # setup argument parser
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--data_dir",
+        type=str,
+        default=None,
+        help="Path to synthetic data (see synthesize_multitask.py); "
+        "generated in a temporary directory if not given",
+    )
+    parser.add_argument(
+        "--n_samples",
+        type=int,
+        default=16,
+        help="Number of positive and of negative tiles per split to generate",
+    )
+    parser.add_argument(
+        "-channels", type=str, default="0,1,2,3,4,5,6,7,8,9,10,11", help="Channels"
+    )
+    parser.add_argument(
+        "--heads",
+        type=str,
+        default="dense",
+        choices=HEADS,
+        help="Task heads",
+    )
+    parser.add_argument(
+        "--batch_sizes",
+        type=str,
+        default="2,8,32",
+        help="Comma-separated batch sizes of the forward/backward benchmark",
+    )
+    parser.add_argument(
+        "--repeats", type=int, default=10, help="Number of timed calls per case"
+    )
+    parser.add_argument(
+        "--num_threads", type=int, default=None, help="Number of CPU threads"
+    )
+    parser.add_argument(
+        "--filter", type=str, default="", help="Only run cases containing this"
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="benchmark.json",
+        help="Path to the JSON results; pass them as --baseline to a later run",
+    )
+    parser.add_argument(
+        "--baseline", type=str, default=None, help="Path to baseline results"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Relative slowdown against the baseline counted as a regression",
+    )
+    args = parser.parse_args()
+
+    channels = [int(c) for c in args.channels.split(",")]
+    batch_sizes = [int(bs) for bs in args.batch_sizes.split(",")]
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data_dir or os.path.join(tmp_dir, "data")
+        if not os.path.exists(os.path.join(data_dir, "labels.csv")):
+            synthesize(data_dir, n_samples=args.n_samples)
+        paths = {
+            "datadir": os.path.join(data_dir, "images"),
+            "seglabeldir": os.path.join(data_dir, "segmentation_labels"),
+            "reg_file": os.path.join(data_dir, "labels.csv"),
+        }
+
+        cases = {}
+        cases.update(data_cases(paths, channels, os.path.join(tmp_dir, "cache")))
+        cases.update(model_cases(channels, args.heads, batch_sizes))
+        cases.update(metric_cases())
+
+        results = {
+            "meta": {
+                "torch": torch.__version__,
+                "numpy": np.__version__,
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "processor": platform.processor(),
+                "num_threads": torch.get_num_threads(),
+                "repeats": args.repeats,
+            },
+            "results": {},
+        }
+        for name, func in cases.items():
+            if args.filter in name:
+                results["results"][name] = timeit(func, repeats=args.repeats)
+
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+
+    print("{:<28} {:>10} {:>10}".format("case", "median ms", "baseline"))
+    for name, stats in results["results"].items():
+        ratio = stats.get("baseline_ratio")
+        print(
+            "{:<28} {:>10.2f} {:>10}".format(
+                name,
+                stats["median_ms"],
+                "" if ratio is None else "{:.2f}x".format(ratio),
+            )
+        )
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    if regressions:
+        raise SystemExit(
+            "slower than the baseline by more than {:.0%}: {}".format(
+                args.tolerance, ", ".join(regressions)
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
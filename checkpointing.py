@@ -0,0 +1,216 @@
+import os
+import queue
+import random
+import shutil
+import threading
+import numpy as np
+import torch
+
+CRITERIA = ["segmentation", "regression", "classification"]
+
+# state of the run, written every epoch and read by `--resume`
+LAST_CHECKPOINT = "last.ckpt"
+
+
+def _to_cpu(state):
+    """Copy all tensors of a (nested) state dict to the CPU, so a snapshot
+    does not change while training continues.
+    :param state: state dict, list or tensor
+    :return: copy with CPU tensors"""
+    if torch.is_tensor(state):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {k: _to_cpu(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(_to_cpu(v) for v in state)
+    return state
+
+
+def rng_state():
+    """Random generator states of python, numpy and torch."""
+    state = dict(
+        python=random.getstate(),
+        numpy=np.random.get_state(),
+        torch=torch.get_rng_state(),
+    )
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    """Restore the random generator states saved by `rng_state`."""
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def _atomic_save(obj, path):
+    """Write to a temporary file next to `path` and rename it, so a run
+    killed while saving never leaves a truncated checkpoint."""
+    tmp_path = path + ".tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _link_or_copy(src, dst):
+    """Hard link `dst` to `src`, copying where links are not supported."""
+    tmp_path = dst + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+def load_checkpoint(path, model, opt=None, scaler=None, restore_rng=True):
+    """Restore a run from a checkpoint written by `CheckpointManager`.
+    :param path: path to the checkpoint
+    :param model: model instance, not wrapped in `DistributedDataParallel`
+    :param opt: optimizer instance
+    :param scaler: `GradScaler` instance
+    :param restore_rng: restore the random generator states; every rank of a
+        distributed run loads the weights, but only rank 0 saved its RNG
+    :return: checkpoint without the model, optimizer and scaler states"""
+    state = torch.load(path, map_location=torch.device("cpu"))
+    model.load_state_dict(state.pop("model"))
+    optimizer_state = state.pop("optimizer")
+    scaler_state = state.pop("scaler")
+    if opt is not None:
+        opt.load_state_dict(optimizer_state)
+    if scaler is not None:
+        scaler.load_state_dict(scaler_state)
+    if restore_rng:
+        set_rng_state(state["rng"])
+    return state
+
+
+class CheckpointManager(object):
+    """Save the checkpoints of a training run in a background thread.
+
+    The best model of every criterion in `CRITERIA` is kept in
+    `<criterion>_checkpoints/` as a plain state dict, as read by the
+    evaluation scripts. An epoch that is best on several criteria is written
+    once and hard linked to the other directories. Only the `keep` newest
+    best checkpoints per criterion are kept. Every epoch also writes
+    `last.ckpt` with the model, optimizer, scaler, epoch, RNG and best-metric
+    state to resume from.
+
+    Snapshots are copied to the CPU on the calling thread; serialization and
+    disk writes overlap with the next epoch. All files are written
+    atomically.
+    """
+
+    def __init__(self, exp_out_dir, filename, keep=None):
+        """
+        :param exp_out_dir: path to the experiment's checkpoints
+        :param filename: format string of model file names, filled with the epoch
+        :param keep: number of best checkpoints to keep per criterion; all if `None`
+        """
+        if keep is not None and keep < 1:
+            raise ValueError("keep must be at least 1, got {}".format(keep))
+        self.exp_out_dir = exp_out_dir
+        self.filename = filename
+        self.keep = keep
+        self.saved = {criterion: [] for criterion in CRITERIA}
+        for criterion in CRITERIA:
+            os.makedirs(self.checkpoint_dir(criterion), exist_ok=True)
+
+        # at most one snapshot waits while another is written
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def checkpoint_dir(self, criterion):
+        return os.path.join(self.exp_out_dir, "{}_checkpoints".format(criterion))
+
+    @property
+    def last_path(self):
+        return os.path.join(self.exp_out_dir, LAST_CHECKPOINT)
+
+    def restore(self, state):
+        """Continue the retention of a resumed run.
+        :param state: checkpoint returned by `load_checkpoint`"""
+        self.saved = {
+            criterion: list(state["saved"].get(criterion, []))
+            for criterion in CRITERIA
+        }
+
+    def save(self, epoch, model, opt, scaler, best, criteria):
+        """Queue the checkpoints of an epoch.
+        :param epoch: finished epoch
+        :param model: model instance, not wrapped in `DistributedDataParallel`
+        :param opt: optimizer instance
+        :param scaler: `GradScaler` instance
+        :param best: best metrics so far, stored to resume from
+        :param criteria: criteria the epoch is best on"""
+        self._raise_error()
+        model_state = _to_cpu(model.state_dict())
+
+        paths = []
+        for criterion in criteria:
+            path = os.path.join(
+                self.checkpoint_dir(criterion), self.filename.format(epoch)
+            )
+            paths.append(path)
+            self.saved[criterion].append(path)
+        removed = []
+        if self.keep is not None:
+            for criterion in CRITERIA:
+                removed += self.saved[criterion][: -self.keep]
+                self.saved[criterion] = self.saved[criterion][-self.keep :]
+
+        state = dict(
+            model=model_state,
+            optimizer=_to_cpu(opt.state_dict()),
+            scaler=scaler.state_dict(),
+            epoch=epoch,
+            rng=rng_state(),
+            best=dict(best),
+            saved={k: list(v) for k, v in self.saved.items()},
+        )
+        self._queue.put((model_state, paths, state, removed))
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is not None and self._error is None:
+                    self._write(*job)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+            if job is None:
+                return
+
+    def _write(self, model_state, paths, state, removed):
+        if paths:
+            _atomic_save(model_state, paths[0])
+            for path in paths[1:]:
+                _link_or_copy(paths[0], path)
+        _atomic_save(state, self.last_path)
+        for path in removed:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError("saving a checkpoint failed") from self._error
+
+    def wait(self):
+        """Block until all queued checkpoints are written."""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Write the queued checkpoints and stop the background thread."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
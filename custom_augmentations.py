@@ -1,5 +1,6 @@
 import numpy as np
 import random
+import torch
 
 
 class Mirror(object):
@@ -46,3 +47,53 @@ class Rotate(object):
             imgdata = np.rot90(imgdata, rot, axes=(1, 2))
             fptdata = np.rot90(fptdata, rot, axes=(0, 1))
         return imgdata, fptdata
+
+
+class BatchMirror(object):
+    """Mirror a batch of images, drawing independently for each sample."""
+
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, imgdata, fptdata):
+        apply = self.p < torch.rand(imgdata.shape[0], device=imgdata.device)
+        imgdata = torch.where(apply.view(-1, 1, 1, 1), imgdata.flip(3), imgdata)
+        fptdata = torch.where(apply.view(-1, 1, 1), fptdata.flip(2), fptdata)
+        return imgdata, fptdata
+
+
+class BatchFlip(object):
+    """Flip a batch of images, drawing independently for each sample."""
+
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, imgdata, fptdata):
+        apply = self.p < torch.rand(imgdata.shape[0], device=imgdata.device)
+        imgdata = torch.where(apply.view(-1, 1, 1, 1), imgdata.flip(2), imgdata)
+        fptdata = torch.where(apply.view(-1, 1, 1), fptdata.flip(1), fptdata)
+        return imgdata, fptdata
+
+
+class BatchRotate(object):
+    """Rotate a batch of square images, drawing independently for each
+    sample."""
+
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, imgdata, fptdata):
+        n = imgdata.shape[0]
+        apply = self.p < torch.rand(n, device=imgdata.device)
+        rot = torch.randint(0, 4, (n,), device=imgdata.device) * apply
+        # select per sample instead of indexing to avoid a host sync
+        imgout, fptout = imgdata, fptdata
+        for k in range(1, 4):
+            sel = rot == k
+            imgout = torch.where(
+                sel.view(-1, 1, 1, 1), torch.rot90(imgdata, k, (2, 3)), imgout
+            )
+            fptout = torch.where(
+                sel.view(-1, 1, 1), torch.rot90(fptdata, k, (1, 2)), fptout
+            )
+        return imgout, fptout
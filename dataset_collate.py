@@ -0,0 +1,182 @@
+import numpy as np
+import torch
+from torch.utils.data import get_worker_info
+
+
+def _target_dtype(x):
+    """Batch dtype of a sample field: floating point data becomes float32,
+    uint16 images travel reinterpreted as int16 like `ToTensor(raw=True)`,
+    everything else keeps its dtype."""
+    if torch.is_tensor(x):
+        return torch.float32 if x.is_floating_point() else x.dtype
+    x = np.asarray(x)
+    if x.dtype.kind == "f":
+        return torch.float32
+    if x.dtype == np.uint16:
+        return torch.int16
+    return torch.from_numpy(np.zeros(0, dtype=x.dtype)).dtype
+
+
+def _empty_batch(shape, dtype):
+    """Uninitialized batch tensor; in DataLoader workers it is allocated in
+    shared memory like by the default collate, so it is not copied again
+    when sent to the main process."""
+    if get_worker_info() is None:
+        return torch.empty(shape, dtype=dtype)
+    numel = int(np.prod(shape))
+    storage = torch.empty(0, dtype=dtype).storage()._new_shared(numel)
+    return torch.empty(0, dtype=dtype).new(storage).resize_(shape)
+
+
+def _stack_into(values):
+    """Write equally shaped sample arrays or tensors into one preallocated
+    batch tensor of the target dtype, without intermediate copies.
+    :param values: list of arrays or tensors
+    :return: tensor (batch, ...)"""
+    first = values[0]
+    shape = (len(values),) + tuple(first.shape)
+    out = _empty_batch(shape, _target_dtype(first))
+    out_np = out.numpy()
+    for i, x in enumerate(values):
+        if torch.is_tensor(x):
+            out[i].copy_(x)
+        else:
+            x = np.asarray(x)
+            # uint16 data is reinterpreted, not converted
+            out_np[i] = x.view(np.int16) if x.dtype == np.uint16 else x
+    return out
+
+
+class Batch(object):
+    """Batch of samples with every field in its compute dtype.
+
+    Tensors: `img` (float32, or int16-reinterpreted uint16 for device
+    transforms), `fpt` (mask dtype of the samples), `weather` (float32,
+    batch x 1 x 4), `gen_output` (float32), `type` (int64), `lbl` (bool) and
+    `idx` (int64). Everything else, e.g. image file names, travels in the
+    `meta` dict of lists and never goes to the device.
+    """
+
+    fields = ("img", "fpt", "weather", "gen_output", "type", "lbl", "idx")
+
+    def __init__(self, img, fpt, weather, gen_output, type, lbl, idx, meta=None):
+        self.img = img
+        self.fpt = fpt
+        self.weather = weather
+        self.gen_output = gen_output
+        self.type = type
+        self.lbl = lbl
+        self.idx = idx
+        self.meta = {} if meta is None else meta
+
+    def __len__(self):
+        return len(self.type)
+
+    def tensors(self):
+        return {name: getattr(self, name) for name in self.fields}
+
+    def _replace(self, tensors, meta=None):
+        return Batch(meta=self.meta if meta is None else meta, **tensors)
+
+    def slice(self, start, stop):
+        """Micro-batch of samples `start` to `stop`; tensors are views."""
+        return self._replace(
+            {k: v[start:stop] for k, v in self.tensors().items()},
+            {k: v[start:stop] for k, v in self.meta.items()},
+        )
+
+    def to(self, device, non_blocking=False):
+        return self._replace(
+            {
+                k: v.to(device, non_blocking=non_blocking)
+                for k, v in self.tensors().items()
+            }
+        )
+
+    def pin_memory(self):
+        """Called by data loaders with `pin_memory=True`."""
+        return self._replace({k: v.pin_memory() for k, v in self.tensors().items()})
+
+
+def collate_samples(samples):
+    """Collate sample dicts into a `Batch`, writing every field straight into
+    a tensor of its target dtype. Replaces the default collate, which
+    converts python scalars one at a time and stacks float64 arrays.
+    :param samples: list of sample dicts as returned by the datasets
+    :return: `Batch` instance"""
+    first = samples[0]
+    tensors = {
+        "img": _stack_into([s["img"] for s in samples]),
+        "fpt": _stack_into([s["fpt"] for s in samples]),
+        "weather": torch.from_numpy(
+            np.array([s["weather"] for s in samples], dtype=np.float32)
+        ),
+        "gen_output": torch.from_numpy(
+            np.array([s["gen_output"] for s in samples], dtype=np.float32)
+        ),
+        "type": torch.from_numpy(
+            np.array([s["type"] for s in samples], dtype=np.int64)
+        ),
+        "lbl": torch.from_numpy(np.array([s["lbl"] for s in samples], dtype=bool)),
+        "idx": torch.from_numpy(np.array([s["idx"] for s in samples], dtype=np.int64)),
+    }
+    meta = {k: [s[k] for s in samples] for k in first if k not in Batch.fields}
+    return Batch(meta=meta, **tensors)
+
+
+class DevicePrefetcher(object):
+    """Move `Batch`es to a CUDA device ahead of their use.
+
+    Every batch is sent to the device on a side stream while the previous
+    batch is still being computed on. Batches pinned by the data loader are
+    copied asynchronously straight from its pinned memory, whose blocks the
+    caching host allocator reuses once their copies have finished. On other
+    devices batches are moved as they are needed.
+    """
+
+    def __init__(self, batches, device):
+        """
+        :param batches: iterable of `Batch`es, e.g. a data loader with
+            `collate_fn=collate_samples` and `pin_memory=True` on CUDA
+        :param device: target device
+        """
+        self.batches = batches
+        self.device = device
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        if self.device.type != "cuda":
+            for batch in self.batches:
+                yield batch.to(self.device)
+            return
+
+        stream = torch.cuda.Stream(self.device)
+
+        def load(batch):
+            with torch.cuda.stream(stream):
+                batch = batch.to(self.device, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(stream)
+            return batch, event
+
+        def ready(loaded):
+            batch, event = loaded
+            current = torch.cuda.current_stream(self.device)
+            current.wait_event(event)
+            # the tensors were allocated on the side stream
+            for tensor in batch.tensors().values():
+                tensor.record_stream(current)
+            return batch
+
+        iterator = iter(self.batches)
+        first = next(iterator, None)
+        if first is None:
+            return
+        loaded = load(first)
+        for batch in iterator:
+            upcoming = load(batch)
+            yield ready(loaded)
+            loaded = upcoming
+        yield ready(loaded)
@@ -0,0 +1,232 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+fuel_type_dict = {
+    "Fossil Brown coal/Lignite": 0,
+    "Fossil Hard coal": 1,
+    "Fossil Gas": 2,
+    "Fossil Peat": 3,
+    "Fossil Coal-derived gas": 2,
+    "Fossil Oil": 3,
+}
+
+weather_columns = ["temp", "humidity", "wind-u", "wind-v"]
+
+# bump whenever the manifest layout or the selection logic changes
+MANIFEST_VERSION = 1
+
+
+def list_image_files(datadir):
+    """List all GeoTIFF files below a directory in `os.walk` order.
+    :param datadir: path to the folder of the images
+    :return: list of (root, filename) tuples"""
+    return [
+        (root, filename)
+        for root, _, files in os.walk(datadir)
+        for filename in files
+        if filename.endswith(".tif")
+    ]
+
+
+def seglabel_target(segdata):
+    """Derive the image file name a Label Studio annotation refers to.
+    :param segdata: parsed Label Studio JSON
+    :return: GeoTIFF file name"""
+    return "-".join(segdata["data"]["image"].split("-")[1:]).replace(".png", ".tif")
+
+
+def read_seglabels(seglabeldir):
+    """Read segmentation label files into polygon lists.
+    :param seglabeldir: path to the folder of Label Studio JSON files
+    :return: dict mapping image file names to lists of closed polygons in
+        percent coordinates; later files win for duplicate image names"""
+    seglabels = {}
+    for seglabelfile in os.listdir(seglabeldir):
+        with open(os.path.join(seglabeldir, seglabelfile), "r") as f:
+            segdata = json.load(f)
+        polygons = []
+        for completions in segdata["completions"]:
+            for result in completions["result"]:
+                points = result["value"]["points"]
+                polygons.append(np.array(points + [points[0]], dtype=np.float64))
+        seglabels[seglabel_target(segdata)] = polygons
+    return seglabels
+
+
+def seglabel_fingerprint(seglabeldir):
+    """Hash the names, sizes and modification times of all segmentation label
+    files in a directory.
+    :param seglabeldir: path to segmentation labels
+    :return: hex digest"""
+    h = hashlib.sha1()
+    for seglabelfile in sorted(os.listdir(seglabeldir)):
+        stat = os.stat(os.path.join(seglabeldir, seglabelfile))
+        h.update(
+            "{}:{}:{}".format(seglabelfile, stat.st_size, stat.st_mtime_ns).encode()
+        )
+    return h.hexdigest()
+
+
+class Polygons(object):
+    """Segmentation polygons of all samples in one flat coordinate buffer
+    with per-polygon and per-sample offsets, like a CSR matrix.
+
+    Only three numpy arrays are held, so forked DataLoader workers share
+    them read-only without refcount writes to per-polygon objects, and
+    pickling copies three buffers.
+    """
+
+    def __init__(self, coords, offsets, sample_offsets):
+        """
+        :param coords: (n_points, 2) array of all polygon edge coordinates
+        :param offsets: start of every polygon in `coords`, plus the total
+        :param sample_offsets: first polygon of every sample, plus the total
+        """
+        self.coords = coords
+        self.offsets = offsets
+        self.sample_offsets = sample_offsets
+
+    def __len__(self):
+        return len(self.sample_offsets) - 1
+
+    def __getitem__(self, idx):
+        """
+        :param idx: sample index
+        :return: list of (n, 2) coordinate views, one per polygon"""
+        return [
+            self.coords[self.offsets[p] : self.offsets[p + 1]]
+            for p in range(self.sample_offsets[idx], self.sample_offsets[idx + 1])
+        ]
+
+    def scaled(self, factor):
+        """
+        :param factor: scale of the coordinates
+        :return: `Polygons` with scaled coordinates and shared offsets"""
+        return Polygons(self.coords * factor, self.offsets, self.sample_offsets)
+
+
+def manifest_fingerprint(files, seglabeldir, reg_data):
+    """Hash everything a manifest is derived from.
+    :param files: list of (root, filename) tuples from `list_image_files`
+    :param seglabeldir: path to segmentation labels
+    :param reg_data: regression data frame
+    :return: hex digest"""
+    h = hashlib.sha1()
+    h.update(str(MANIFEST_VERSION).encode())
+    for root, filename in files:
+        h.update(os.path.join(root, filename).encode())
+        h.update(b"\0")
+    h.update(seglabel_fingerprint(seglabeldir).encode())
+    columns = ["filename", "gen_output", "fuel_type"] + weather_columns
+    h.update(
+        pd.util.hash_pandas_object(reg_data[columns], index=False).values.tobytes()
+    )
+    return h.hexdigest()
+
+
+def build_manifest(datadir, seglabeldir, reg_data, files=None):
+    """Join the image file listing, the segmentation labels and the regression
+    data in one vectorized pass.
+
+    Selection follows the original `MultiTaskDataset` logic: positive images
+    need at least one polygon, negative images are added up to the number of
+    positive images, and both need regression rows without missing
+    `gen_output`.
+    :param datadir: path to satellite images
+    :param seglabeldir: path to segmentation labels
+    :param reg_data: regression data frame
+    :param files: optional precomputed result of `list_image_files`
+    :return: dict of columnar arrays"""
+    if files is None:
+        files = list_image_files(datadir)
+    seglabels = read_seglabels(seglabeldir)
+
+    filedf = pd.DataFrame(files, columns=["root", "filename"])
+    filedf["order"] = np.arange(len(filedf))
+
+    # first regression row per file name, dropping names with missing targets
+    missing = (
+        reg_data["gen_output"].isna().groupby(reg_data["filename"]).transform("any")
+    )
+    reg_first = reg_data[~missing].drop_duplicates("filename")
+    reg_first = reg_first[["filename", "gen_output", "fuel_type"] + weather_columns]
+
+    filedf = filedf.merge(reg_first, on="filename", how="inner").sort_values("order")
+
+    has_polygons = filedf["filename"].map(lambda f: len(seglabels.get(f, [])) > 0)
+    positive = filedf[
+        filedf["root"].str.contains("positive", regex=False) & has_polygons
+    ]
+    negative = filedf[filedf["root"].str.contains("negative", regex=False)]
+    negative = negative.iloc[: len(positive)]
+    selected = pd.concat([positive, negative])
+
+    fossil_type = selected["fuel_type"].map(fuel_type_dict)
+    if fossil_type.isna().any():
+        raise KeyError(selected["fuel_type"][fossil_type.isna()].iloc[0])
+
+    # flatten polygons into one coordinate buffer with offset arrays
+    polygons = [pol for f in positive["filename"] for pol in seglabels[f]]
+    n_polygons = [len(seglabels[f]) for f in positive["filename"]]
+    n_polygons += [0] * len(negative)
+    poly_offsets = np.zeros(len(polygons) + 1, dtype=np.int64)
+    np.cumsum([len(pol) for pol in polygons], out=poly_offsets[1:])
+    sample_poly_offsets = np.zeros(len(selected) + 1, dtype=np.int64)
+    np.cumsum(n_polygons, out=sample_poly_offsets[1:])
+    poly_coords = (
+        np.concatenate(polygons) if polygons else np.zeros((0, 2), dtype=np.float64)
+    )
+
+    n_pos = len(positive)
+    return {
+        "imgfiles": np.array(
+            [
+                os.path.join(r, f)
+                for r, f in zip(selected["root"], selected["filename"])
+            ],
+            dtype=str,
+        ),
+        "labels": np.arange(len(selected)) < n_pos,
+        "fossil_type": fossil_type.to_numpy(dtype=np.int64),
+        "gen_outputs": selected["gen_output"].to_numpy(dtype=np.float64),
+        "weather": selected[weather_columns].to_numpy(dtype=np.float64)[:, None, :],
+        "poly_coords": poly_coords,
+        "poly_offsets": poly_offsets,
+        "sample_poly_offsets": sample_poly_offsets,
+        "positive_indices": np.arange(n_pos),
+        "negative_indices": np.arange(n_pos, len(selected)),
+    }
+
+
+def load_manifest(datadir, seglabeldir, reg_data, cache_dir=None):
+    """Load a dataset manifest from `cache_dir` or build and store it.
+
+    Manifests are keyed by a fingerprint of the image file listing, the
+    segmentation label files and the regression data, so stale manifests
+    are never reused.
+    :param datadir: path to satellite images
+    :param seglabeldir: path to segmentation labels
+    :param reg_data: regression data frame
+    :param cache_dir: directory for manifest files; if `None`, nothing is
+        persisted
+    :return: dict of columnar arrays"""
+    files = list_image_files(datadir)
+    if cache_dir is None:
+        return build_manifest(datadir, seglabeldir, reg_data, files=files)
+
+    fingerprint = manifest_fingerprint(files, seglabeldir, reg_data)
+    path = os.path.join(cache_dir, "manifest_{}.npz".format(fingerprint))
+    if os.path.exists(path):
+        with np.load(path, allow_pickle=False) as data:
+            return {k: data[k] for k in data.files}
+
+    manifest = build_manifest(datadir, seglabeldir, reg_data, files=files)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **manifest)
+    os.replace(tmp_path, path)
+    return manifest
@@ -0,0 +1,162 @@
+import os
+import hashlib
+import numpy as np
+import rasterio as rio
+from rasterio.features import rasterize
+from shapely.geometry import Polygon
+import cv2
+
+from dataset_manifest import seglabel_fingerprint
+
+# how the image has to be treated to match its final mask
+KEEP, CROP, RESIZE = 0, 1, 2
+
+# bump whenever the mask generation logic changes
+MASK_VERSION = 1
+
+
+def plume_mask(polygons, size, native=False):
+    """Rasterize segmentation polygons into a plume mask.
+
+    300x300 tiles are cropped to their centre 120x120 if the crop contains
+    the whole plume; otherwise the mask is resized to 120x120 instead.
+    :param polygons: list of polygon edge coordinate arrays
+    :param size: side length of the squared image
+    :param native: if `True`, keep every tile at its native resolution
+    :return: uint8 mask and one of `KEEP`, `CROP`, `RESIZE`"""
+    fptdata = np.zeros((size, size), dtype=np.uint8)
+    shapes = []
+
+    if len(polygons) > 0:
+        for pol in polygons:
+            try:
+                pol = Polygon(pol)
+                shapes.append(pol)
+            except ValueError:
+                continue
+        fptdata = rasterize(
+            ((g, 1) for g in shapes),
+            out_shape=fptdata.shape,
+            all_touched=True,
+            dtype=np.uint8,
+        )
+
+    if native or size != 300:
+        return fptdata, KEEP
+
+    fptcropped = fptdata[
+        int((fptdata.shape[0] - 120) / 2) : int((fptdata.shape[0] + 120) / 2),
+        int((fptdata.shape[1] - 120) / 2) : int((fptdata.shape[1] + 120) / 2),
+    ]
+    if np.sum(fptcropped) == np.sum(fptdata):
+        return fptcropped, CROP
+    return cv2.resize(fptdata, (120, 120), interpolation=cv2.INTER_CUBIC), RESIZE
+
+
+class MaskCache(object):
+    """Bit-packed plume masks with the image treatment each one implies."""
+
+    def __init__(self, packed, offsets, shapes, modes):
+        """
+        :param packed: concatenated `np.packbits` output of all masks
+        :param offsets: start of every mask in `packed`, plus the total length
+        :param shapes: (n, 2) array of mask shapes
+        :param modes: per-mask image treatment (`KEEP`, `CROP`, `RESIZE`)
+        """
+        self.packed = packed
+        self.offsets = offsets
+        self.shapes = shapes
+        self.modes = modes
+
+    @classmethod
+    def from_packed(cls, packed, shapes, modes):
+        """Build a cache from individually packed masks.
+        :param packed: list of `np.packbits` outputs
+        :param shapes: list of mask shapes
+        :param modes: list of image treatments
+        :return: `MaskCache` instance"""
+        offsets = np.zeros(len(packed) + 1, dtype=np.int64)
+        np.cumsum([len(p) for p in packed], out=offsets[1:])
+        return cls(
+            np.concatenate(packed) if packed else np.zeros(0, dtype=np.uint8),
+            offsets,
+            np.array(shapes, dtype=np.int64).reshape(-1, 2),
+            np.array(modes, dtype=np.int8),
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["packed"], data["offsets"], data["shapes"], data["modes"])
+
+    def save(self, path):
+        """Write the cache atomically to `path`."""
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                packed=self.packed,
+                offsets=self.offsets,
+                shapes=self.shapes,
+                modes=self.modes,
+            )
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self.modes)
+
+    def __getitem__(self, idx):
+        """
+        :param idx: sample index
+        :return: uint8 mask and image treatment"""
+        shape = self.shapes[idx]
+        fptdata = np.unpackbits(
+            self.packed[self.offsets[idx] : self.offsets[idx + 1]],
+            count=shape[0] * shape[1],
+        )
+        return fptdata.reshape(shape), self.modes[idx]
+
+
+def build_mask_cache(dataset):
+    """Rasterize the masks of all distinct samples of a `MultiTaskDataset`.
+
+    Only the raster headers are read to get the squared image size.
+    :param dataset: `MultiTaskDataset` instance
+    :return: `MaskCache` instance"""
+    packed, shapes, modes = [], [], []
+    for idx in range(dataset.n_samples):
+        with rio.open(dataset.imgfiles[idx]) as imgfile:
+            size = imgfile.height
+        fptdata, mode = plume_mask(dataset.seglabels[idx], size, dataset.native)
+        packed.append(np.packbits(fptdata.astype(bool)))
+        shapes.append(fptdata.shape)
+        modes.append(mode)
+    return MaskCache.from_packed(packed, shapes, modes)
+
+
+def load_mask_cache(dataset, cache_dir):
+    """Load the mask cache of a `MultiTaskDataset` or build and store it.
+
+    Caches are keyed by the segmentation label files, the sample list, the
+    polygon scale and the native resolution flag, so any change to the Label
+    Studio JSON files invalidates them.
+    :param dataset: `MultiTaskDataset` instance
+    :param cache_dir: directory for mask cache files
+    :return: `MaskCache` instance"""
+    h = hashlib.sha1()
+    h.update(
+        "{}:{}:{}".format(MASK_VERSION, dataset.size, int(dataset.native)).encode()
+    )
+    h.update(seglabel_fingerprint(dataset.seglabeldir).encode())
+    for imgfile in dataset.imgfiles[: dataset.n_samples]:
+        h.update(imgfile.encode())
+        h.update(b"\0")
+    path = os.path.join(cache_dir, "masks_{}.npz".format(h.hexdigest()))
+
+    if os.path.exists(path):
+        return MaskCache.load(path)
+
+    masks = build_mask_cache(dataset)
+    os.makedirs(cache_dir, exist_ok=True)
+    masks.save(path)
+    return masks
@@ -1,19 +1,63 @@
-import os
-import json
 import numpy as np
 import rasterio as rio
 import torch
-from rasterio.features import rasterize
-from shapely.geometry import Polygon
 from torchvision import transforms
-import cv2
 
-from custom_augmentations import Flip, Mirror, Rotate
-from torch.utils.data import Dataset
+from custom_augmentations import (
+    BatchFlip,
+    BatchMirror,
+    BatchRotate,
+    Flip,
+    Mirror,
+    Rotate,
+)
+from dataset_manifest import Polygons, load_manifest, seglabel_fingerprint
+from dataset_masks import load_mask_cache, plume_mask
+from dataset_reader import as_dtype, read_tile
+from dataset_tilestore import TileStoreDataset
+from torch.utils.data import ConcatDataset, Dataset, Sampler
+
+channels_means = np.array(
+    [
+        960.97437,
+        1110.9012,
+        1250.0942,
+        1259.5178,
+        1500.98,
+        1989.6344,
+        2155.846,
+        2251.6265,
+        2272.9438,
+        2442.6206,
+        1914.3,
+        1512.0585,
+    ]
+)
+channels_stds = np.array(
+    [
+        1302.0157,
+        1418.4988,
+        1381.5366,
+        1406.7112,
+        1387.4155,
+        1438.8479,
+        1497.8815,
+        1604.1998,
+        1516.532,
+        1827.3025,
+        1303.83,
+        1189.9052,
+    ]
+)
 
 
 class MultiTaskDataset(Dataset):
-    """Smoke plumes subset dataset."""
+    """Smoke plumes subset dataset.
+
+    Tiles stay uint16, as stored in the GeoTIFFs, through reading, cropping,
+    resizing and caching; they are converted to float32 exactly once, by
+    `Normalize` on the host or `BatchNormalize` on the device.
+    """
 
     def __init__(
         self,
@@ -24,20 +68,20 @@ class MultiTaskDataset(Dataset):
         seglabeldir=None,
         mult=1,
         transform=None,
+        cache_dir=None,
+        native=False,
     ):
         """
         Args:
             datadir (string): Path to the folder of the images.
+            mult (int): Oversampling factor; samples are repeated virtually.
+            cache_dir (string): Path to the folder for cached dataset
+                manifests and segmentation masks; if `None`, the manifest
+                is rebuilt and masks are rasterized on every access.
+            native (bool): Keep 300x300 tiles at their native resolution
+                instead of cropping or resizing them to 120x120; needs a
+                model with pooled heads.
         """
-        fuel_type_dict = {
-            "Fossil Brown coal/Lignite": 0,
-            "Fossil Hard coal": 1,
-            "Fossil Gas": 2,
-            "Fossil Peat": 3,
-            "Fossil Coal-derived gas": 2,
-            "Fossil Oil": 3,
-        }
-
         self.datadir = datadir
         self.seglabeldir = seglabeldir
         self.reg_data = reg_data
@@ -45,222 +89,105 @@ class MultiTaskDataset(Dataset):
         self.channels = np.array(channels)
 
         self.size = size
+        self.native = native
+        self.mult = mult
+
+        # join image files, segmentation labels and regression data; the
+        # manifest is cached on disk if `cache_dir` is given
+        manifest = load_manifest(
+            self.datadir, self.seglabeldir, self.reg_data, cache_dir=cache_dir
+        )
 
-        # list of image files, labels (positive or negative), segmentation
+        # arrays of image files, labels (positive or negative), segmentation
         # label vector edge coordinates
-        self.imgfiles = []
-        self.labels = []
-        self.weather = []
-        self.gen_outputs = []
-        self.seglabels = []
-        self.fossil_type = []
-
-        # list of indices of positive and negative images
-        self.positive_indices = []
-        self.negative_indices = []
-
-        # read in segmentation label files
-        seglabels = []
-        segfile_lookup = {}
-
-        for i, seglabelfile in enumerate(os.listdir(self.seglabeldir)):
-            segdata = json.load(open(os.path.join(self.seglabeldir, seglabelfile), "r"))
-            seglabels.append(segdata)
-            segfile_lookup[
-                "-".join(segdata["data"]["image"].split("-")[1:]).replace(
-                    ".png", ".tif"
-                )
-            ] = i
-
-        # read in image file names for positive images
-        idx = 0
-        for root, _, files in os.walk(self.datadir):
-            for filename in files:
-                if not filename.endswith(".tif"):
-                    continue
-                if filename not in segfile_lookup.keys():
-                    continue
-                polygons = []
-                for completions in seglabels[segfile_lookup[filename]]["completions"]:
-                    for result in completions["result"]:
-                        polygons.append(
-                            np.array(
-                                result["value"]["points"]
-                                + [result["value"]["points"][0]]
-                            )
-                            * self.size
-                            / 100
-                        )
-                        # factor necessary to scale edge coordinates
-                        # appropriately
-                if "positive" in root and polygons != []:
-                    if (
-                        len(self.reg_data[self.reg_data["filename"] == filename]) != 0
-                        and sum(
-                            self.reg_data[self.reg_data["filename"] == filename][
-                                "gen_output"
-                            ].isna()
-                        )
-                        == 0
-                    ):
-                        self.positive_indices.append(idx)
-                        self.labels.append(True)
-                        self.imgfiles.append(os.path.join(root, filename))
-                        self.seglabels.append(polygons)
-                        self.fossil_type.append(
-                            fuel_type_dict[
-                                self.reg_data[self.reg_data["filename"] == filename][
-                                    "fuel_type"
-                                ].unique()[0]
-                            ]
-                        )
-                        self.gen_outputs.append(
-                            self.reg_data[self.reg_data["filename"] == filename][
-                                "gen_output"
-                            ].values[0]
-                        )
-                        self.weather.append(
-                            self.reg_data[self.reg_data["filename"] == filename][
-                                ["temp", "humidity", "wind-u", "wind-v"]
-                            ].to_numpy()
-                        )
-                        idx += 1
-        # add as many negative example images
-        for root, _, files in os.walk(self.datadir):
-            for filename in files:
-                if not filename.endswith(".tif"):
-                    continue
-                if idx >= len(self.positive_indices) * 2:
-                    break
-                if "negative" in root:
-                    if (
-                        len(self.reg_data[self.reg_data["filename"] == filename]) != 0
-                        and sum(
-                            self.reg_data[self.reg_data["filename"] == filename][
-                                "gen_output"
-                            ].isna()
-                        )
-                        == 0
-                    ):
-                        self.negative_indices.append(idx)
-                        self.labels.append(False)
-                        self.imgfiles.append(os.path.join(root, filename))
-                        self.seglabels.append([])
-                        self.gen_outputs.append(
-                            self.reg_data[self.reg_data["filename"] == filename][
-                                "gen_output"
-                            ].values[0]
-                        )
-                        self.fossil_type.append(
-                            fuel_type_dict[
-                                self.reg_data[self.reg_data["filename"] == filename][
-                                    "fuel_type"
-                                ].unique()[0]
-                            ]
-                        )
-                        self.weather.append(
-                            self.reg_data[self.reg_data["filename"] == filename][
-                                ["temp", "humidity", "wind-u", "wind-v"]
-                            ].to_numpy()
-                        )
-                        idx += 1
-        # turn lists into arrays
-        self.imgfiles = np.array(self.imgfiles)
-        self.gen_outputs = np.array(self.gen_outputs)
-        self.labels = np.array(self.labels)
-        self.fossil_type = np.array(self.fossil_type)
-        self.weather = np.array(self.weather)
-        self.positive_indices = np.array(self.positive_indices)
-        self.negative_indices = np.array(self.negative_indices)
-        if mult > 1:
-            self.imgfiles = np.array([*self.imgfiles] * mult)
-            self.labels = np.array([*self.labels] * mult)
-            self.weather = np.array([*self.weather] * mult)
-            self.gen_outputs = np.array([*self.gen_outputs] * mult)
-            self.positive_indices = np.array([*self.positive_indices] * mult)
-            self.negative_indices = np.array([*self.negative_indices] * mult)
-            self.seglabels = self.seglabels * mult
-            self.fossil_type = np.array([*self.fossil_type] * mult)
+        self.imgfiles = manifest["imgfiles"]
+        self.labels = manifest["labels"]
+        self.weather = manifest["weather"]
+        self.gen_outputs = manifest["gen_outputs"]
+        self.fossil_type = manifest["fossil_type"]
+
+        # polygons stay in the flat buffers of the manifest; indexing returns
+        # views. The factor scales edge coordinates appropriately
+        self.seglabels = Polygons(
+            manifest["poly_coords"],
+            manifest["poly_offsets"],
+            manifest["sample_poly_offsets"],
+        ).scaled(self.size / 100)
+
+        # arrays of indices of positive and negative images
+        self.positive_indices = manifest["positive_indices"]
+        self.negative_indices = manifest["negative_indices"]
+
+        # number of distinct samples before oversampling
+        self.n_samples = len(self.imgfiles)
+
+        # rasterized segmentation masks are cached next to the manifest
+        self.masks = None
+        if cache_dir is not None:
+            self.masks = load_mask_cache(self, cache_dir)
+
+        # shared-memory pool of decoded tiles, see `attach_tile_cache`
+        self.tile_cache = None
 
     def __len__(self):
         """Returns length of data set."""
-        return len(self.imgfiles)
+        return self.n_samples * self.mult
+
+    def load_tile(self, idx):
+        """Read in image data, preprocess, and build segmentation mask.
+        :param idx: sample index
+        :return: image array (channels, height, width) and segmentation mask"""
+        # oversampled indices map back onto the distinct samples
+        idx = idx % self.n_samples
+
+        if self.tile_cache is not None:
+            imgdata = self.tile_cache.get(idx)
+            if imgdata is not None:
+                return imgdata, self.masks[idx][0]
+
+        with rio.open(self.imgfiles[idx]) as imgfile:
+            # look up or rasterize segmentation mask; it decides whether the
+            # image is kept, centre-cropped or resized
+            if self.masks is not None:
+                fptdata, mode = self.masks[idx]
+            else:
+                fptdata, mode = plume_mask(
+                    self.seglabels[idx], imgfile.height, self.native
+                )
+
+            imgdata = read_tile(imgfile, self.channels, mode)
+
+        if self.tile_cache is not None:
+            imgdata = self.tile_cache.put(idx, imgdata)
+        return imgdata, fptdata
+
+    def tile_sizes(self):
+        """Side length of the tile of every sample, without reading images
+        if the masks are cached.
+        :return: int array of length `len(self)`"""
+        if self.masks is not None:
+            sizes = self.masks.shapes[:, 0]
+        elif self.native or self.size != 300:
+            sizes = np.full(self.n_samples, self.size)
+        else:
+            sizes = np.full(self.n_samples, 120)
+        return np.resize(sizes, len(self))
 
     def __getitem__(self, idx):
         """Read in image data, preprocess, build segmentation mask, and apply
         transformations."""
-
-        imgfile = rio.open(self.imgfiles[idx])
-        imgdata = np.array(
-            [imgfile.read(i) for i in [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 12, 13]]
-        )
-        # keep only selected channels
-        imgdata = imgdata[self.channels]
-
-        size = imgdata.shape[1]
-        # force image shape to be square
-        if imgdata.shape[1] != size:
-            newimgdata = np.empty((len(self.channels), size, imgdata.shape[2]))
-            newimgdata[:, : imgdata.shape[1], :] = imgdata[:, : imgdata.shape[1], :]
-            newimgdata[:, imgdata.shape[1] :, :] = imgdata[:, imgdata.shape[1] - 1 :, :]
-            imgdata = newimgdata
-        if imgdata.shape[2] != size:
-            newimgdata = np.empty((len(self.channels), size, size))
-            newimgdata[:, :, : imgdata.shape[2]] = imgdata[:, :, : imgdata.shape[2]]
-            newimgdata[:, :, imgdata.shape[2] :] = imgdata[:, :, imgdata.shape[2] - 1 :]
-            imgdata = newimgdata
-
-        # rasterize segmentation polygons
-        fptdata = np.zeros(imgdata.shape[1:], dtype=np.uint8)
-        polygons = self.seglabels[idx].copy()
-        shapes = []
-
-        if len(polygons) > 0:
-            for pol in polygons:
-                try:
-                    pol = Polygon(pol)
-                    shapes.append(pol)
-                except ValueError:
-                    continue
-            fptdata = rasterize(
-                ((g, 1) for g in shapes), out_shape=fptdata.shape, all_touched=True
-            )
-        list_polygons = [pol.tolist() for pol in polygons]
-
-        if size == 300:
-            fptcropped = fptdata[
-                int((fptdata.shape[0] - 120) / 2) : int((fptdata.shape[0] + 120) / 2),
-                int((fptdata.shape[1] - 120) / 2) : int((fptdata.shape[1] + 120) / 2),
-            ]
-            if np.sum(fptcropped) == np.sum(fptdata):
-                fptdata = fptcropped
-                imgdata = imgdata[
-                    :,
-                    int((imgdata.shape[1] - 120) / 2) : int(
-                        (imgdata.shape[1] + 120) / 2
-                    ),
-                    int((imgdata.shape[2] - 120) / 2) : int(
-                        (imgdata.shape[2] + 120) / 2
-                    ),
-                ]
-            else:
-                imgdata = cv2.resize(
-                    np.transpose(imgdata, (1, 2, 0)).astype("float32"),
-                    (120, 120),
-                    interpolation=cv2.INTER_CUBIC,
-                )
-                imgdata = np.transpose(imgdata, (2, 0, 1))
-                fptdata = cv2.resize(fptdata, (120, 120), interpolation=cv2.INTER_CUBIC)
+        imgdata, fptdata = self.load_tile(idx)
+        base = idx % self.n_samples
 
         sample = {
             "idx": idx,
-            "lbl": self.labels[idx],
+            "lbl": self.labels[base],
             "img": imgdata,
             "fpt": fptdata,
-            "type": self.fossil_type[idx],
-            "gen_output": self.gen_outputs[idx],
-            "weather": self.weather[idx],
-            "imgfile": self.imgfiles[idx],
+            "type": self.fossil_type[base],
+            "gen_output": self.gen_outputs[base],
+            "weather": self.weather[base],
+            "imgfile": self.imgfiles[base],
         }
 
         # apply transformations
@@ -273,18 +200,30 @@ class MultiTaskDataset(Dataset):
 class ToTensor(object):
     """Convert ndarrays in sample to Tensors."""
 
+    def __init__(self, raw=False):
+        """
+        :param raw: if `True`, keep images as uint16 for `BatchNormalize`;
+            they are reinterpreted as int16 since torch lacks uint16 tensors
+        """
+        self.raw = raw
+
     def __call__(self, sample):
         """
         :param sample: sample to be converted to Tensor
         :return: converted Tensor sample
         """
+        if self.raw:
+            imgdata = as_dtype(sample["img"], np.uint16).view(np.int16)
+        else:
+            # already a fresh float32 array from `Normalize`
+            imgdata = np.ascontiguousarray(sample["img"], dtype=np.float32)
 
         out = {
             "idx": sample["idx"],
             "lbl": sample["lbl"],
             "type": sample["type"],
-            "img": torch.from_numpy(sample["img"].copy()),
-            "fpt": torch.from_numpy(sample["fpt"].copy()),
+            "img": torch.from_numpy(imgdata),
+            "fpt": torch.from_numpy(np.ascontiguousarray(sample["fpt"])),
             "gen_output": sample["gen_output"],
             "weather": sample["weather"],
             "imgfile": sample["imgfile"],
@@ -329,77 +268,223 @@ class Randomize(object):
 
 class Normalize(object):
     """Normalize pixel values to zero mean and range [-1, +1] measured in
-    standard deviations."""
+    standard deviations; converts the image to float32 in one multiply-add,
+    like `BatchNormalize`."""
 
     def __init__(self, channels):
-        self.channels_means = np.array(
-            [
-                960.97437,
-                1110.9012,
-                1250.0942,
-                1259.5178,
-                1500.98,
-                1989.6344,
-                2155.846,
-                2251.6265,
-                2272.9438,
-                2442.6206,
-                1914.3,
-                1512.0585,
-            ]
-        )
-        self.channels_stds = np.array(
-            [
-                1302.0157,
-                1418.4988,
-                1381.5366,
-                1406.7112,
-                1387.4155,
-                1438.8479,
-                1497.8815,
-                1604.1998,
-                1516.532,
-                1827.3025,
-                1303.83,
-                1189.9052,
-            ]
-        )
+        self.channels_means = channels_means
+        self.channels_stds = channels_stds
 
         self.channel_means = self.channels_means[channels]
         self.channel_stds = self.channels_stds[channels]
 
+        self.scale = (1 / self.channel_stds).astype(np.float32).reshape(-1, 1, 1)
+        self.shift = (
+            (-self.channel_means / self.channel_stds)
+            .astype(np.float32)
+            .reshape(-1, 1, 1)
+        )
+
     def __call__(self, sample):
         """
         :param sample: sample to be normalized
-        :return: normalized sample
+        :return: normalized sample with a float32 image
         """
-        sample["img"] = (
-            sample["img"] - self.channel_means.reshape(sample["img"].shape[0], 1, 1)
-        ) / self.channel_stds.reshape(sample["img"].shape[0], 1, 1)
+        imgdata = sample["img"].astype(np.float32)
+        imgdata *= self.scale
+        imgdata += self.shift
+        sample["img"] = imgdata
         return sample
 
 
+class BatchRandomize(object):
+    """Randomize orientation of a batch of images and segmentation masks on
+    their device; same transformations as `Randomize`, drawn per sample."""
+
+    def __init__(self):
+        self.funcs = [BatchMirror(), BatchFlip(), BatchRotate()]
+
+    def __call__(self, imgdata, fptdata):
+        """
+        :param imgdata: image batch (batch, channels, height, width)
+        :param fptdata: mask batch (batch, height, width)
+        :return: randomized image and mask batches
+        """
+        for func in self.funcs:
+            imgdata, fptdata = func(imgdata, fptdata)
+        return imgdata, fptdata
+
+
+class BatchNormalize(object):
+    """Normalize a batch of raw images on their device in a single fused
+    float32 multiply-add; same result as `Normalize`."""
+
+    def __init__(self, channels):
+        stds = channels_stds[channels]
+        self.scale = torch.tensor(1 / stds, dtype=torch.float32).view(1, -1, 1, 1)
+        self.shift = torch.tensor(
+            -channels_means[channels] / stds, dtype=torch.float32
+        ).view(1, -1, 1, 1)
+
+    def normalize(self, imgdata):
+        """
+        :param imgdata: raw image batch as returned by `ToTensor(raw=True)`
+        :return: normalized float32 image batch
+        """
+        if self.scale.device != imgdata.device:
+            self.scale = self.scale.to(imgdata.device)
+            self.shift = self.shift.to(imgdata.device)
+        if imgdata.dtype == torch.int16:
+            # uint16 data travels reinterpreted as int16
+            imgdata = imgdata.int() & 0xFFFF
+        return torch.addcmul(self.shift, imgdata.float(), self.scale)
+
+    def __call__(self, imgdata, fptdata):
+        """
+        :param imgdata: raw image batch as returned by `ToTensor(raw=True)`
+        :param fptdata: mask batch
+        :return: normalized float32 image batch and float32 mask batch
+        """
+        return self.normalize(imgdata), fptdata.float()
+
+
+class BatchCompose(object):
+    """Chain batch transformations operating on image and mask batches."""
+
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def __call__(self, imgdata, fptdata):
+        for t in self.transforms:
+            imgdata, fptdata = t(imgdata, fptdata)
+        return imgdata, fptdata
+
+
+def tile_sizes(dataset):
+    """Side length of the tile of every sample of a dataset.
+    :param dataset: `MultiTaskDataset`, `TileStoreDataset` or a
+        `ConcatDataset` of them
+    :return: int array of length `len(dataset)`"""
+    if isinstance(dataset, ConcatDataset):
+        return np.concatenate([tile_sizes(d) for d in dataset.datasets])
+    return dataset.tile_sizes()
+
+
+class BucketBatchSampler(Sampler):
+    """Group the indices drawn by a sampler into batches of equally sized
+    tiles, so that tiles of different native resolutions can be batched
+    without resizing.
+
+    Indices are kept in the order they are drawn; a batch is emitted as soon
+    as its bucket is full and incomplete buckets are emitted at the end.
+    """
+
+    def __init__(self, sampler, batch_size, sizes, drop_last=False):
+        """
+        :param sampler: sampler drawing dataset indices
+        :param batch_size: number of samples per batch
+        :param sizes: tile size of every dataset index, see `tile_sizes`
+        :param drop_last: if `True`, drop incomplete buckets
+        """
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.sizes = np.asarray(sizes)
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        buckets = {}
+        for idx in self.sampler:
+            bucket = buckets.setdefault(self.sizes[idx], [])
+            bucket.append(idx)
+            if len(bucket) == self.batch_size:
+                yield bucket
+                buckets[self.sizes[idx]] = []
+        if not self.drop_last:
+            for bucket in buckets.values():
+                if len(bucket) > 0:
+                    yield bucket
+
+    def __len__(self):
+        # exact for a single bucket; otherwise the number of incomplete
+        # buckets depends on the drawn indices
+        if self.drop_last:
+            return len(self.sampler) // self.batch_size
+        return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+
+
+def create_batch_transform(channels, train=False):
+    """Create the batch transformations matching `create_dataset(...,
+    device_transforms=True)`; apply them after moving a batch to the device.
+    :param channels: list of channels indices
+    :param train: if `True`, randomize orientations
+    :return: callable taking and returning image and mask batches"""
+    if train:
+        return BatchCompose([BatchRandomize(), BatchNormalize(np.array(channels))])
+    return BatchNormalize(np.array(channels))
+
+
 def create_dataset(
     *args,
     apply_transforms=True,
     train=False,
     size=120,
     channels=[0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11],
+    store_dir=None,
+    device_transforms=False,
     **kwargs
 ):
     """Create a dataset; uses same input parameters as PowerPlantDataset.
     :param apply_transforms: if `True`, apply available transformations
+    :param device_transforms: if `True`, only convert samples to raw uint16
+        tensors and leave normalization and randomization to the batch
+        transformations from `create_batch_transform`
+    :param store_dir: if given, serve samples from this materialized tile
+        store instead of the GeoTIFF files; the store must have been
+        written from the current segmentation labels in `seglabeldir`
     :return: data set"""
-    if apply_transforms:
+    data_transforms = None
+    if apply_transforms and device_transforms:
+        data_transforms = ToTensor(raw=True)
+    elif apply_transforms:
         if train:
+            # orientations are randomized on the compact uint16 tiles; they
+            # commute with the per-channel normalization
             data_transforms = transforms.Compose(
-                [Normalize(np.array(channels)), Randomize(), ToTensor()]
+                [Randomize(), Normalize(np.array(channels)), ToTensor()]
             )
         else:
             data_transforms = transforms.Compose(
                 [Normalize(np.array(channels)), ToTensor()]
             )
 
+    if store_dir is not None:
+        data = TileStoreDataset(
+            store_dir, mult=kwargs.get("mult", 1), transform=data_transforms
+        )
+        if data.native != kwargs.get("native", False):
+            raise ValueError(
+                "tile store {} was written with native={}".format(
+                    store_dir, data.native
+                )
+            )
+        if not np.array_equal(data.channels, channels):
+            raise ValueError(
+                "tile store {} holds channels {}, requested {}".format(
+                    store_dir, data.channels.tolist(), list(channels)
+                )
+            )
+        seglabeldir = kwargs.get("seglabeldir")
+        if seglabeldir is not None and data.seglabel_fingerprint != (
+            seglabel_fingerprint(seglabeldir)
+        ):
+            raise ValueError(
+                "segmentation labels in {} changed since tile store {} was "
+                "written; run materialize_multitask.py again".format(
+                    seglabeldir, store_dir
+                )
+            )
+        return data
+
     data = MultiTaskDataset(
         channels=channels, size=size, *args, **kwargs, transform=data_transforms
     )
@@ -0,0 +1,80 @@
+import numpy as np
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+import cv2
+
+from dataset_masks import CROP, RESIZE
+
+# GeoTIFF band indexes of the 12 channels (band 11 is not used)
+BANDS = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 12, 13]
+
+
+def as_dtype(imgdata, dtype):
+    """Convert image data to a storage dtype, rounding and clipping float data
+    (e.g. from cubic resizing) if the target is an integer type.
+    :param imgdata: image array
+    :param dtype: target dtype
+    :return: contiguous image array of the target dtype"""
+    dtype = np.dtype(dtype)
+    if dtype.kind in "ui" and imgdata.dtype.kind == "f":
+        info = np.iinfo(dtype)
+        imgdata = np.clip(np.rint(imgdata), info.min, info.max)
+    return np.ascontiguousarray(imgdata, dtype=dtype)
+
+
+def square(imgdata):
+    """Force image shape to be square by repeating the last column.
+    :param imgdata: image array (channels, height, width)
+    :return: image array (channels, height, height)"""
+    pad = imgdata.shape[1] - imgdata.shape[2]
+    if pad == 0:
+        return imgdata
+    return np.pad(imgdata, ((0, 0), (0, 0), (0, pad)), mode="edge")
+
+
+def read_tile(imgfile, channels, mode, out_size=120):
+    """Read the selected channels of a GeoTIFF as a square tile in the
+    raster dtype (uint16 for Sentinel-2).
+
+    Only the requested bands are read, in a single call. Centre crops are
+    read through a window and downscaling uses a decimated read, so the full
+    raster is only decoded when it is kept as is or is not square.
+    :param imgfile: open rasterio dataset
+    :param channels: list of channels indices
+    :param mode: image treatment from the segmentation mask (`KEEP`, `CROP`,
+        `RESIZE`)
+    :param out_size: side length of cropped and resized tiles
+    :return: image array (channels, size, size)"""
+    indexes = [BANDS[c] for c in channels]
+    height, width = imgfile.height, imgfile.width
+
+    if mode == CROP:
+        offset = int((height - out_size) / 2)
+        # columns beyond the raster are filled like the squaring does
+        col_off = min(offset, width - 1)
+        n_cols = min(offset + out_size, width) - col_off
+        imgdata = imgfile.read(
+            indexes, window=Window(col_off, offset, n_cols, out_size)
+        )
+        return np.pad(imgdata, ((0, 0), (0, 0), (0, out_size - n_cols)), mode="edge")
+
+    if mode == RESIZE and height == width:
+        return imgfile.read(
+            indexes,
+            out_shape=(len(indexes), out_size, out_size),
+            resampling=Resampling.cubic,
+        )
+
+    imgdata = square(imgfile.read(indexes))
+    if mode == RESIZE:
+        # resized in the raster dtype; cv2 rounds and saturates uint16
+        imgdata = cv2.resize(
+            np.ascontiguousarray(np.transpose(imgdata, (1, 2, 0))),
+            (out_size, out_size),
+            interpolation=cv2.INTER_CUBIC,
+        )
+        if imgdata.ndim == 2:
+            # cv2 drops the axis of single channel images
+            imgdata = imgdata[:, :, None]
+        imgdata = np.transpose(imgdata, (2, 0, 1))
+    return imgdata
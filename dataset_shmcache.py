@@ -0,0 +1,127 @@
+import copy
+import numpy as np
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from tqdm.autonotebook import tqdm
+
+from dataset_reader import as_dtype
+
+CACHE_MODES = ["none", "lazy", "eager"]
+
+# torch lacks uint16 tensors; uint16 tiles are stored reinterpreted as int16
+_TORCH_DTYPES = {"uint16": torch.int16, "float32": torch.float32}
+
+
+class SharedTileCache(object):
+    """Pool of decoded tiles in shared memory.
+
+    All tiles of one or more datasets live in one flat shared-memory tensor,
+    allocated in the main process before the DataLoader workers start. Every
+    worker, and every dataset attached to the pool, reads and fills the same
+    copy, so the GeoTIFFs are decoded once per run instead of once per
+    worker and epoch. Tiles are stored after channel selection and
+    cropping/resizing, as `MultiTaskDataset.load_tile` returns them;
+    resized tiles are rounded when stored as `uint16`, as in tile stores.
+
+    Samples are filled on first access. Two workers may decode the same
+    sample concurrently; both write the same data and the sample is marked
+    as filled after writing.
+    """
+
+    def __init__(self, shapes, dtype="uint16"):
+        """
+        :param shapes: (n, 3) shape of the tile of every sample in the pool
+        :param dtype: storage dtype, `uint16` or `float32`
+        """
+        self.dtype = np.dtype(dtype)
+        self.shapes = np.array(shapes, dtype=np.int64).reshape(-1, 3)
+        self.offsets = np.zeros(len(self.shapes) + 1, dtype=np.int64)
+        np.cumsum(np.prod(self.shapes, axis=1), out=self.offsets[1:])
+
+        self.data = torch.zeros(
+            int(self.offsets[-1]), dtype=_TORCH_DTYPES[self.dtype.name]
+        ).share_memory_()
+        self.filled = torch.zeros(len(self.shapes), dtype=torch.uint8).share_memory_()
+        # first slot of the dataset this view belongs to, see `for_dataset`
+        self.start = 0
+
+    def for_dataset(self, start):
+        """View of the pool for a dataset whose samples start at `start`;
+        the shared tensors are not copied.
+        :param start: first slot of the dataset
+        :return: `SharedTileCache` view"""
+        view = copy.copy(self)
+        view.start = start
+        return view
+
+    @property
+    def nbytes(self):
+        return int(self.offsets[-1]) * self.dtype.itemsize
+
+    def get(self, idx):
+        """Tile of a sample; a view into shared memory that must not be
+        modified.
+        :param idx: sample index within the dataset
+        :return: image array (channels, height, width) or `None` if the
+            sample has not been filled yet"""
+        slot = self.start + idx
+        if not self.filled[slot]:
+            return None
+        data = self.data.numpy().view(self.dtype)
+        return data[self.offsets[slot] : self.offsets[slot + 1]].reshape(
+            self.shapes[slot]
+        )
+
+    def put(self, idx, imgdata):
+        """Store the tile of a sample.
+        :param idx: sample index within the dataset
+        :param imgdata: image array (channels, height, width)
+        :return: stored tile as returned by `get`"""
+        slot = self.start + idx
+        if tuple(imgdata.shape) != tuple(self.shapes[slot]):
+            raise ValueError(
+                "tile of shape {} does not fit cache slot of shape {}".format(
+                    imgdata.shape, tuple(self.shapes[slot])
+                )
+            )
+        data = self.data.numpy().view(self.dtype)
+        tile = data[self.offsets[slot] : self.offsets[slot + 1]]
+        tile[:] = as_dtype(imgdata, self.dtype).ravel()
+        self.filled[slot] = 1
+        return tile.reshape(self.shapes[slot])
+
+
+def attach_tile_cache(datasets, dtype="uint16", eager=False, num_threads=8):
+    """Allocate one shared tile pool for several `MultiTaskDataset`s and
+    attach it to them; call before creating the data loaders.
+    :param datasets: list of `MultiTaskDataset` instances created with a
+        `cache_dir`, so their tile sizes are known without reading images
+    :param dtype: storage dtype, `uint16` or `float32`
+    :param eager: if `True`, decode all tiles now instead of on first access
+    :param num_threads: number of threads decoding tiles if `eager`
+    :return: `SharedTileCache` instance"""
+    shapes = []
+    for dataset in datasets:
+        if dataset.masks is None:
+            raise ValueError("the tile cache needs datasets with a cache_dir")
+        sizes = dataset.tile_sizes()[: dataset.n_samples]
+        shapes += [(len(dataset.channels), size, size) for size in sizes]
+
+    cache = SharedTileCache(shapes, dtype=dtype)
+    start = 0
+    for dataset in datasets:
+        dataset.tile_cache = cache.for_dataset(start)
+        start += dataset.n_samples
+
+    if eager:
+        # rasterio releases the GIL while decoding
+        jobs = [(d, idx) for d in datasets for idx in range(d.n_samples)]
+        with ThreadPoolExecutor(num_threads) as pool:
+            list(
+                tqdm(
+                    pool.map(lambda job: job[0].load_tile(job[1]), jobs),
+                    total=len(jobs),
+                    desc="Filling tile cache",
+                )
+            )
+    return cache
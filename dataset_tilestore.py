@@ -0,0 +1,166 @@
+import os
+import numpy as np
+from tqdm.autonotebook import tqdm
+from torch.utils.data import Dataset
+
+from dataset_manifest import seglabel_fingerprint
+from dataset_masks import KEEP, MaskCache
+from dataset_reader import as_dtype
+
+TILES_FILE = "tiles.bin"
+MASKS_FILE = "masks.npz"
+INDEX_FILE = "index.npz"
+
+
+def materialize(dataset, store_dir, dtype="uint16"):
+    """Write the preprocessed tiles of a `MultiTaskDataset` into a
+    memory-mapped tile store.
+
+    Tiles are stored after channel selection, squaring and cropping/resizing,
+    i.e. exactly as `MultiTaskDataset.load_tile` returns them. All tiles of a
+    dataset go into one contiguous flat array; segmentation masks are stored
+    bit-packed next to it. An index file holds per-sample offsets and shapes
+    together with the sample metadata and a fingerprint of the segmentation
+    labels. The index is written last, so an interrupted run never leaves a
+    readable store.
+    :param dataset: `MultiTaskDataset` instance
+    :param store_dir: output directory for this split
+    :param dtype: storage dtype of the image data, `uint16` or `float32`;
+        resized tiles are rounded and clipped when stored as `uint16`
+    :return: path to the index file"""
+    dtype = np.dtype(dtype)
+    os.makedirs(store_dir, exist_ok=True)
+
+    n = dataset.n_samples
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    shapes = np.zeros((n, 3), dtype=np.int64)
+    masks = []
+
+    with open(os.path.join(store_dir, TILES_FILE), "wb") as tiles:
+        for idx in tqdm(range(n), desc="Materializing {}".format(store_dir)):
+            imgdata, fptdata = dataset.load_tile(idx)
+            imgdata = as_dtype(imgdata, dtype)
+
+            tiles.write(imgdata.tobytes())
+            masks.append(np.packbits(np.asarray(fptdata, dtype=bool)))
+            shapes[idx] = imgdata.shape
+            offsets[idx + 1] = offsets[idx] + imgdata.size
+
+    # tiles are already cropped/resized, so every mask is used as is
+    MaskCache.from_packed(masks, shapes[:, 1:], [KEEP] * n).save(
+        os.path.join(store_dir, MASKS_FILE)
+    )
+
+    index_path = os.path.join(store_dir, INDEX_FILE)
+    tmp_path = "{}.{}.tmp".format(index_path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        np.savez(
+            f,
+            dtype=np.array(dtype.str),
+            offsets=offsets,
+            shapes=shapes,
+            channels=dataset.channels,
+            native=np.array(dataset.native),
+            seglabel_fingerprint=np.array(seglabel_fingerprint(dataset.seglabeldir)),
+            imgfiles=dataset.imgfiles[:n],
+            labels=dataset.labels[:n],
+            fossil_type=dataset.fossil_type[:n],
+            gen_outputs=dataset.gen_outputs[:n],
+            weather=dataset.weather[:n],
+        )
+    os.replace(tmp_path, index_path)
+    return index_path
+
+
+class TileStoreDataset(Dataset):
+    """Smoke plumes dataset served from a materialized tile store."""
+
+    def __init__(self, store_dir, mult=1, transform=None):
+        """
+        Args:
+            store_dir (string): Path to a tile store written by `materialize`.
+            mult (int): Oversampling factor; samples are repeated virtually.
+        """
+        self.store_dir = store_dir
+        self.mult = mult
+        self.transform = transform
+
+        with np.load(os.path.join(store_dir, INDEX_FILE), allow_pickle=False) as index:
+            self.dtype = np.dtype(str(index["dtype"]))
+            self.offsets = index["offsets"]
+            self.shapes = index["shapes"]
+            self.channels = index["channels"]
+            self.native = bool(index["native"])
+            self.seglabel_fingerprint = str(index["seglabel_fingerprint"])
+            self.imgfiles = index["imgfiles"]
+            self.labels = index["labels"]
+            self.fossil_type = index["fossil_type"]
+            self.gen_outputs = index["gen_outputs"]
+            self.weather = index["weather"]
+
+        self.n_samples = len(self.imgfiles)
+        self.positive_indices = np.flatnonzero(self.labels)
+        self.negative_indices = np.flatnonzero(~self.labels)
+
+        self.masks = MaskCache.load(os.path.join(store_dir, MASKS_FILE))
+
+        # the memory map is opened lazily so that every DataLoader worker maps
+        # the file itself instead of receiving a pickled copy
+        self._tiles = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_tiles"] = None
+        return state
+
+    def _open(self):
+        self._tiles = np.memmap(
+            os.path.join(self.store_dir, TILES_FILE),
+            dtype=self.dtype,
+            mode="r",
+            shape=(int(self.offsets[-1]),),
+        )
+
+    def __len__(self):
+        """Returns length of data set."""
+        return self.n_samples * self.mult
+
+    def tile_sizes(self):
+        """Side length of the tile of every sample.
+        :return: int array of length `len(self)`"""
+        return np.resize(self.shapes[:, 1], len(self))
+
+    def load_tile(self, idx):
+        """Return a view of the stored image data and the segmentation mask.
+        :param idx: sample index
+        :return: image array (channels, height, width) and segmentation mask"""
+        if self._tiles is None:
+            self._open()
+        idx = idx % self.n_samples
+        shape = tuple(self.shapes[idx])
+        imgdata = self._tiles[self.offsets[idx] : self.offsets[idx + 1]].reshape(shape)
+        fptdata, _ = self.masks[idx]
+        return imgdata, fptdata
+
+    def __getitem__(self, idx):
+        """Read in image data and segmentation mask, and apply
+        transformations."""
+        imgdata, fptdata = self.load_tile(idx)
+        base = idx % self.n_samples
+
+        sample = {
+            "idx": idx,
+            "lbl": self.labels[base],
+            "img": imgdata,
+            "fpt": fptdata,
+            "type": self.fossil_type[base],
+            "gen_output": self.gen_outputs[base],
+            "weather": self.weather[base],
+            "imgfile": self.imgfiles[base],
+        }
+
+        # apply transformations
+        if self.transform:
+            sample = self.transform(sample)
+
+        return sample
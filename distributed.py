@@ -0,0 +1,233 @@
+import os
+import math
+import torch
+import torch.distributed as dist
+from torch import nn
+from torch.utils.data import Sampler
+
+DIST_BACKENDS = ["gloo", "nccl"]
+
+
+def init_distributed(backend="gloo", rank=None, world_size=None):
+    """Join the process group of a distributed run. Rank and world size
+    default to the `RANK` and `WORLD_SIZE` environment variables set by
+    `torchrun`; `MASTER_ADDR` and `MASTER_PORT` have to be set as well.
+    A single process does not create a process group.
+    :param backend: `gloo` (CPU) or `nccl` (CUDA)
+    :param rank: rank of this process
+    :param world_size: number of processes
+    :return: rank and world size"""
+    if rank is None:
+        rank = int(os.environ.get("RANK", 0))
+    if world_size is None:
+        world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size > 1:
+        dist.init_process_group(backend, rank=rank, world_size=world_size)
+    return rank, world_size
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    """Whether this process saves checkpoints and logs."""
+    return get_rank() == 0
+
+
+class DistributedRandomSampler(Sampler):
+    """Shard of a `RandomSampler(replacement=True, num_samples=...)` for
+    one rank of a distributed run.
+
+    All ranks draw the same indices from a generator seeded with the seed
+    and the epoch and keep every `world_size`-th of them, so together they
+    draw `num_samples` samples per epoch, rounded up to a multiple of the
+    world size. Call `set_epoch` before every epoch to draw new samples.
+    """
+
+    def __init__(self, data_source, num_samples, rank=None, world_size=None, seed=0):
+        """
+        :param data_source: dataset to sample from
+        :param num_samples: number of samples drawn by all ranks per epoch
+        :param rank: rank of this process, by default from the process group
+        :param world_size: number of processes, by default from the process group
+        :param seed: random seed shared by all ranks
+        """
+        self.data_source = data_source
+        self.rank = get_rank() if rank is None else rank
+        self.world_size = get_world_size() if world_size is None else world_size
+        self.num_samples = int(math.ceil(num_samples / self.world_size))
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        indices = torch.randint(
+            len(self.data_source),
+            (self.num_samples * self.world_size,),
+            dtype=torch.int64,
+            generator=generator,
+        )
+        return iter(indices[self.rank :: self.world_size].tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+class DistributedShardSampler(Sampler):
+    """Every `world_size`-th index of a dataset, in order, for one rank of a
+    distributed run.
+
+    Unlike `DistributedSampler` shards are not padded to equal length, so
+    every sample is seen exactly once and metrics summed over all ranks
+    equal those of a single process. Only for loops without collectives
+    per batch, such as evaluation.
+    """
+
+    def __init__(self, data_source, rank=None, world_size=None):
+        """
+        :param data_source: dataset to shard
+        :param rank: rank of this process, by default from the process group
+        :param world_size: number of processes, by default from the process group
+        """
+        self.data_source = data_source
+        self.rank = get_rank() if rank is None else rank
+        self.world_size = get_world_size() if world_size is None else world_size
+
+    def __iter__(self):
+        return iter(range(self.rank, len(self.data_source), self.world_size))
+
+    def __len__(self):
+        return len(range(self.rank, len(self.data_source), self.world_size))
+
+
+def even_batches(batches, device):
+    """Iterate over batches until any rank runs out of them. Every training
+    step needs all ranks for the gradient all-reduce, so ranks with
+    unequal numbers of batches, e.g. from `BucketBatchSampler`, would hang.
+    Costs one small all-reduce per batch.
+    :param batches: iterable of batches, e.g. a data loader
+    :param device: device of the process group's tensors
+    :return: generator of batches"""
+    iterator = iter(batches)
+    while True:
+        batch = next(iterator, None)
+        if is_distributed():
+            has_batch = torch.tensor([int(batch is not None)], device=device)
+            dist.all_reduce(has_batch, op=dist.ReduceOp.MIN)
+            if has_batch.item() == 0:
+                return
+        elif batch is None:
+            return
+        yield batch
+
+
+class _AllReduceSum(torch.autograd.Function):
+    """Differentiable sum over all ranks; the gradient of every rank's input
+    is the sum of the output gradients of all ranks."""
+
+    @staticmethod
+    def forward(ctx, tensor):
+        tensor = tensor.clone()
+        dist.all_reduce(tensor)
+        return tensor
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_output = grad_output.clone()
+        dist.all_reduce(grad_output)
+        return grad_output
+
+
+class SyncBatchNorm(nn.modules.batchnorm._BatchNorm):
+    """Batch normalization with statistics over the batches of all ranks.
+
+    Unlike `nn.SyncBatchNorm` this also runs on the CPU with the gloo
+    backend: per-channel sums are all-reduced with a differentiable
+    collective, so autograd derives the backward pass. Outside of
+    distributed training it is a regular batch norm.
+    """
+
+    def _check_input_dim(self, input):
+        if input.dim() < 2:
+            raise ValueError(
+                "expected at least 2D input (got {}D input)".format(input.dim())
+            )
+
+    def forward(self, input):
+        if not (self.training and is_distributed() and get_world_size() > 1):
+            return super(SyncBatchNorm, self).forward(input)
+        self._check_input_dim(input)
+        dims = [0] + list(range(2, input.dim()))
+        count = torch.full(
+            (1,),
+            input.numel() // input.shape[1],
+            dtype=input.dtype,
+            device=input.device,
+        )
+        stats = _AllReduceSum.apply(
+            torch.cat([input.sum(dims), (input * input).sum(dims), count])
+        )
+        n_channels = input.shape[1]
+        total = stats[-1]
+        mean = stats[:n_channels] / total
+        # E[x^2] - E[x]^2 may cancel to slightly below zero in float32
+        var = (stats[n_channels:-1] / total - mean * mean).clamp(min=0)
+
+        if self.track_running_stats:
+            with torch.no_grad():
+                self.num_batches_tracked.add_(1)
+                if self.momentum is None:
+                    momentum = 1.0 / float(self.num_batches_tracked)
+                else:
+                    momentum = self.momentum
+                unbiased = var * total / (total - 1).clamp(min=1)
+                self.running_mean.mul_(1 - momentum).add_(momentum * mean)
+                self.running_var.mul_(1 - momentum).add_(momentum * unbiased)
+
+        shape = [1, n_channels] + [1] * (input.dim() - 2)
+        output = (input - mean.view(shape)) * torch.rsqrt(var + self.eps).view(shape)
+        if self.affine:
+            output = output * self.weight.view(shape) + self.bias.view(shape)
+        return output
+
+
+def convert_sync_batchnorm(module):
+    """Replace all batch normalization layers of a model by `SyncBatchNorm`
+    layers sharing their parameters and running statistics; state dicts
+    keep their keys.
+    :param module: model instance
+    :return: converted model"""
+    converted = module
+    if isinstance(module, nn.modules.batchnorm._BatchNorm) and not isinstance(
+        module, SyncBatchNorm
+    ):
+        converted = SyncBatchNorm(
+            module.num_features,
+            module.eps,
+            module.momentum,
+            module.affine,
+            module.track_running_stats,
+        )
+        if module.affine:
+            converted.weight = module.weight
+            converted.bias = module.bias
+        converted.running_mean = module.running_mean
+        converted.running_var = module.running_var
+        converted.num_batches_tracked = module.num_batches_tracked
+        converted.train(module.training)
+    for name, child in module.named_children():
+        converted.add_module(name, convert_sync_batchnorm(child))
+    return converted
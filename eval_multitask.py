@@ -1,37 +1,40 @@
 import os
-import numpy as np
 import pandas as pd
 import torch
 from torch import nn
 from tqdm.autonotebook import tqdm
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, SequentialSampler
 
 import argparse
-from sklearn.metrics import jaccard_score
 
-from models.model_multitask import MultiTaskModel
-from dataset_multitask import create_dataset
+from models.model_multitask import HEADS, MultiTaskModel, device
+from models.pruning import load_pruned_model
+from models.model_onnx import BACKENDS, OnnxMultiTaskModel
+from dataset_multitask import (
+    BucketBatchSampler,
+    create_batch_transform,
+    create_dataset,
+    tile_sizes,
+)
+from dataset_collate import DevicePrefetcher, collate_samples
+from metrics_multitask import MultiTaskMetrics
+from mixed_precision import PRECISIONS, autocast, check_precision, keep_batchnorm_fp32
 
 print("running on...", device)
 
 
-def multi_acc(y_pred, y_test):
-    y_pred_softmax = torch.log_softmax(y_pred, dim=1)
-    _, y_pred_tags = torch.max(y_pred_softmax, dim=1)
-
-    correct_pred = (y_pred_tags == y_test).float()
-    acc = correct_pred.sum() / len(correct_pred)
-
-    return acc
-
-
-def eval_model(model, params, datadir, seglabeldir, reg_data):
+def eval_model(
+    model, params, datadir, seglabeldir, reg_data, cache_dir=None, device=device
+):
     """Wrapper function for model evaluation.
     :param model: model instance
     :param params: parameters
     :param datadir: path to satellite images
     :param seglabeldir: path to segmentation labels
-    :param reg_data: path to csv file for regression"""
+    :param reg_data: path to csv file for regression
+    :param cache_dir: path to cached dataset manifests
+    :param device: device to evaluate on, e.g. the CPU for quantized models
+    :return: dict of metrics"""
 
     reg_data = pd.read_csv(os.path.join(reg_data, "reg_co2_data.csv"))
 
@@ -41,9 +44,33 @@ def eval_model(model, params, datadir, seglabeldir, reg_data):
         seglabeldir=os.path.join(seglabeldir, "validation/"),
         reg_data=reg_data,
         mult=1,
+        cache_dir=cache_dir,
+        device_transforms=params.device_transforms,
+        native=params.heads == "pooled",
     )
 
-    val_dl = DataLoader(data_val, batch_size=params.bs)
+    if data_val.native:
+        # tiles of different sizes cannot be stacked, so batch them by size
+        val_dl = DataLoader(
+            data_val,
+            batch_sampler=BucketBatchSampler(
+                SequentialSampler(data_val), params.bs, tile_sizes(data_val)
+            ),
+            collate_fn=collate_samples,
+            pin_memory=device.type == "cuda",
+        )
+    else:
+        val_dl = DataLoader(
+            data_val,
+            batch_size=params.bs,
+            collate_fn=collate_samples,
+            pin_memory=device.type == "cuda",
+        )
+
+    # normalize on the device if the dataset ships raw tiles
+    val_transform = None
+    if params.device_transforms:
+        val_transform = create_batch_transform(data_val.channels)
 
     # define losses
     loss_r = nn.L1Loss()  # regression loss
@@ -53,68 +80,76 @@ def eval_model(model, params, datadir, seglabeldir, reg_data):
     # evaluation
     model.eval()
 
-    val_loss_total, val_bin_acc_total = 0, 0
-    val_ious = []
-    val_image_loss_total, val_gen_loss_total, val_bin_loss_total = 0, 0, 0
+    # metrics are accumulated on the device and only synced at the end
+    val_metrics = MultiTaskMetrics(
+        device, loss_names=["loss", "image_loss", "gen_loss", "bin_loss"]
+    )
 
-    progress = tqdm(enumerate(val_dl), desc="val Loss: ", total=len(val_dl))
+    # batches arrive in their compute dtypes and are copied to the device
+    # ahead of use
+    progress = tqdm(
+        enumerate(DevicePrefetcher(val_dl, device)),
+        desc="val Loss: ",
+        total=len(val_dl),
+    )
 
     for j, batch in progress:
-        x = batch["img"].float().to(device)
-        y = batch["fpt"].float().to(device)
-        w = batch["weather"].float().to(device)
-        e = batch["gen_output"].float().to(device)
-        t = batch["type"].long().to(device)
-
-        output, reg_output, logits = model(x, w)
+        if val_transform is not None:
+            x, y = val_transform(batch.img, batch.fpt)
+        else:
+            x, y = batch.img, batch.fpt.float()
+        w, e, t = batch.weather, batch.gen_output, batch.type
 
-        bin_acc = multi_acc(logits, t)
-        val_bin_acc_total += bin_acc
+        with torch.no_grad(), autocast(device, params.precision):
+            output, reg_output, logits = model(x, w)
+        output, reg_output, logits = output.float(), reg_output.float(), logits.float()
 
         # derive loss
         loss_image = loss_s(output, y.unsqueeze(dim=1))
         loss_bin = loss_c(logits, t)
         loss_gen = loss_r(reg_output, e.unsqueeze(dim=1))
 
-        val_image_loss_total += loss_image.item()
-        val_bin_loss_total += loss_bin.item()
-        val_gen_loss_total += loss_gen.item()
-
         loss_epoch = (
             params.weight_segmentation * loss_image
             + params.weight_regression * loss_gen
             + params.weight_classification * loss_bin
         )
-        val_loss_total += loss_epoch.item()
 
-        # derive binary segmentation map from prediction
-        output_binary = np.zeros(output.shape)
-        output_binary[output.cpu().detach().numpy() >= 0] = 1
+        # IoU, classification accuracy and losses
+        val_metrics.update(
+            output,
+            y,
+            reg_output,
+            e,
+            logits,
+            t,
+            loss=loss_epoch,
+            image_loss=loss_image,
+            gen_loss=loss_gen,
+            bin_loss=loss_bin,
+        )
 
-        # derive IoU values
-        for k in range(y.shape[0]):
-            z = jaccard_score(
-                y[k].flatten().cpu().detach().numpy(), output_binary[k][0].flatten()
-            )
-            if (
-                np.sum(output_binary[k][0]) != 0
-                and np.sum(y[k].cpu().detach().numpy()) != 0
-            ):
-                val_ious.append(z)
+    val = val_metrics.compute()
 
     print(
         (
             "total loss={:.3f}, segmentation loss={:.3f}, "
-            "regression loss={:.3f}, classification loss={:.3f}, iou={:.3f}, classification acc={:.3f}"
+            "regression loss={:.3f}, classification loss={:.3f}, iou={:.3f}, "
+            "classification acc={:.3f}, generation mae={:.3f}"
         ).format(
-            val_loss_total / (j + 1),
-            val_image_loss_total / (j + 1),
-            val_gen_loss_total / (j + 1),
-            val_bin_loss_total / (j + 1),
-            np.average(val_ious),
-            val_bin_acc_total / (j + 1),
+            val["loss"],
+            val["image_loss"],
+            val["gen_loss"],
+            val["bin_loss"],
+            val["iou"],
+            val["bin_acc"],
+            val["mae"],
         )
     )
+    print("classification confusion matrix (rows: true, columns: predicted):")
+    print(val["confusion"])
+
+    return val
 
 
 def main():
@@ -156,16 +191,79 @@ def main():
     parser.add_argument(
         "--reg_data", type=str, default="", help="Path to regression data directory"
     )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=PRECISIONS,
+        help="Mixed precision mode (bf16 works on CPU, fp16 needs CUDA)",
+    )
+    parser.add_argument(
+        "--device_transforms",
+        action="store_true",
+        help="Normalize batches on the evaluation device",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default="cache",
+        help="Path to dataset cache directory",
+    )
+    parser.add_argument(
+        "--heads",
+        type=str,
+        default="dense",
+        choices=HEADS,
+        help="Task heads of the checkpoint; pooled heads take native tiles",
+    )
+    parser.add_argument(
+        "--width", type=float, default=1.0, help="Channel width multiplier"
+    )
+    parser.add_argument(
+        "--depth", type=int, default=4, help="Number of U-Net down/up stages"
+    )
+    parser.add_argument(
+        "--pruned",
+        action="store_true",
+        help="Checkpoint written by prune_multitask.py; shapes are read from it",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="torch",
+        choices=BACKENDS,
+        help="Inference backend; onnx takes a file from export_multitask.py",
+    )
     args = parser.parse_args()
 
-    model = MultiTaskModel(n_channels=12, n_classes=1)
-    model.to(device)
+    check_precision(device, args.precision)
+    if args.backend == "onnx" and args.precision != "fp32":
+        parser.error("the onnx backend runs in fp32")
+    if args.backend == "onnx" and args.heads == "pooled":
+        # exports have a fixed tile size, native tiles vary in size
+        parser.error("the onnx backend does not support pooled heads")
 
     checkpoint_path = "path/to/model/checkpoint"
-    model.load_state_dict(
-        torch.load("{}".format(checkpoint_path), map_location=torch.device("cpu"))
-    )
-    model.to(device)
+    if args.backend == "onnx":
+        model = OnnxMultiTaskModel(checkpoint_path)
+    else:
+        state_dict = torch.load(
+            "{}".format(checkpoint_path), map_location=torch.device("cpu")
+        )
+        if args.pruned:
+            model = load_pruned_model(state_dict)
+        else:
+            model = MultiTaskModel(
+                n_channels=12,
+                n_classes=1,
+                heads=args.heads,
+                width=args.width,
+                depth=args.depth,
+            )
+            model.load_state_dict(state_dict)
+        if args.precision != "fp32":
+            keep_batchnorm_fp32(model)
+        model.to(device)
 
     # evaluate model
     eval_model(
@@ -174,6 +272,7 @@ def main():
         datadir=args.data_dir,
         seglabeldir=args.seg_label_dir,
         reg_data=args.reg_data,
+        cache_dir=args.cache_dir,
     )
 
 
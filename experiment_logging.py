@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import queue
+import importlib.util
+import sqlite3
+import threading
+import numpy as np
+
+LOGGERS = ["jsonl", "sqlite", "comet", "none"]
+
+
+def _jsonable(value):
+    """Convert numpy scalars and arrays to plain python values."""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, dict):
+        return {k: _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    return value
+
+
+class ExperimentLogger(object):
+    """Log the parameters and metrics of a run from a background thread.
+
+    Logging calls only queue their records, so the training loop never waits
+    for disk or network; `close` writes what is left. Subclasses implement
+    `_write`.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def _worker(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            try:
+                if self._error is None:
+                    self._write(*record)
+            except Exception as e:
+                # a failing logger must not stop training; reported on close
+                self._error = e
+        self._flush()
+
+    def _write(self, kind, payload, step):
+        raise NotImplementedError
+
+    def _flush(self):
+        pass
+
+    def set_name(self, name):
+        self._queue.put(("name", name, None))
+
+    def log_parameters(self, params):
+        """
+        :param params: dict or `argparse.Namespace`
+        """
+        if not isinstance(params, dict):
+            params = vars(params)
+        self._queue.put(("parameters", _jsonable(params), None))
+
+    def log_metrics(self, metrics, epoch=None):
+        """
+        :param metrics: dict of scalars
+        :param epoch: epoch the metrics belong to
+        """
+        self._queue.put(("metrics", _jsonable(metrics), epoch))
+
+    def close(self):
+        """Write all queued records and stop the background thread."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self._error is not None:
+            print("experiment logging failed:", repr(self._error))
+
+
+class NullLogger(ExperimentLogger):
+    """Discard all records."""
+
+    def __init__(self):
+        pass
+
+    def set_name(self, name):
+        pass
+
+    def log_parameters(self, params):
+        pass
+
+    def log_metrics(self, metrics, epoch=None):
+        pass
+
+    def close(self):
+        pass
+
+
+class JSONLinesLogger(ExperimentLogger):
+    """Append one JSON object per record to `<log_dir>/log.jsonl`."""
+
+    def __init__(self, log_dir):
+        os.makedirs(log_dir, exist_ok=True)
+        self.path = os.path.join(log_dir, "log.jsonl")
+        self._file = open(self.path, "a")
+        super(JSONLinesLogger, self).__init__()
+
+    def _write(self, kind, payload, step):
+        record = {"time": time.time(), "kind": kind, "epoch": step, "data": payload}
+        self._file.write(json.dumps(record) + "\n")
+        # visible to readers after every epoch
+        self._file.flush()
+
+    def _flush(self):
+        self._file.close()
+
+
+class SQLiteLogger(ExperimentLogger):
+    """Write records to `<log_dir>/log.sqlite`; metrics go to a long table
+    with one row per epoch and metric."""
+
+    def __init__(self, log_dir):
+        os.makedirs(log_dir, exist_ok=True)
+        self.path = os.path.join(log_dir, "log.sqlite")
+        super(SQLiteLogger, self).__init__()
+
+    def _connect(self):
+        # the connection belongs to the background thread
+        if not hasattr(self, "_db"):
+            self._db = sqlite3.connect(self.path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS runs "
+                "(time REAL, name TEXT, parameters TEXT)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS metrics "
+                "(time REAL, run INTEGER, epoch INTEGER, name TEXT, value REAL)"
+            )
+            self._run = self._db.execute(
+                "INSERT INTO runs VALUES (?, NULL, NULL)", (time.time(),)
+            ).lastrowid
+        return self._db
+
+    def _write(self, kind, payload, step):
+        db = self._connect()
+        if kind == "name":
+            db.execute(
+                "UPDATE runs SET name = ? WHERE rowid = ?", (payload, self._run)
+            )
+        elif kind == "parameters":
+            db.execute(
+                "UPDATE runs SET parameters = ? WHERE rowid = ?",
+                (json.dumps(payload), self._run),
+            )
+        else:
+            now = time.time()
+            db.executemany(
+                "INSERT INTO metrics VALUES (?, ?, ?, ?, ?)",
+                [(now, self._run, step, k, v) for k, v in payload.items()],
+            )
+        db.commit()
+
+    def _flush(self):
+        if hasattr(self, "_db"):
+            self._db.close()
+
+
+class CometLogger(ExperimentLogger):
+    """Log to Comet; `comet_ml` is only imported when this logger is used,
+    and both the import and the connection happen in the background thread.
+    The API key, project and workspace are read from the `COMET_API_KEY`,
+    `COMET_PROJECT_NAME` and `COMET_WORKSPACE` environment variables."""
+
+    def __init__(self):
+        if importlib.util.find_spec("comet_ml") is None:
+            raise ImportError("the comet logger needs comet_ml to be installed")
+        self.experiment = None
+        super(CometLogger, self).__init__()
+
+    def _write(self, kind, payload, step):
+        if self.experiment is None:
+            from comet_ml import Experiment
+
+            self.experiment = Experiment(
+                api_key=os.environ.get("COMET_API_KEY"),
+                project_name=os.environ.get("COMET_PROJECT_NAME"),
+                workspace=os.environ.get("COMET_WORKSPACE"),
+            )
+        if kind == "name":
+            self.experiment.set_name(payload)
+        elif kind == "parameters":
+            self.experiment.log_parameters(payload)
+        else:
+            self.experiment.log_metrics(payload, epoch=step)
+
+    def _flush(self):
+        if self.experiment is not None:
+            self.experiment.end()
+
+
+def create_logger(backend, log_dir=None):
+    """Create an experiment logger.
+    :param backend: one of `LOGGERS`
+    :param log_dir: directory of the local log files
+    :return: `ExperimentLogger` instance"""
+    if backend == "jsonl":
+        return JSONLinesLogger(log_dir)
+    if backend == "sqlite":
+        return SQLiteLogger(log_dir)
+    if backend == "comet":
+        return CometLogger()
+    if backend == "none":
+        return NullLogger()
+    raise ValueError("unknown logger {}, expected one of {}".format(backend, LOGGERS))
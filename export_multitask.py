@@ -0,0 +1,119 @@
+import time
+import torch
+
+import argparse
+
+from models.model_multitask import HEADS, MultiTaskModel
+from models.pruning import load_pruned_model
+from models.model_onnx import OnnxMultiTaskModel, check_parity, export_onnx
+
+
+def latency(model, x, w, repeats=10):
+    """Median wall time of a forward pass.
+    :return: seconds"""
+    times = []
+    with torch.no_grad():
+        model(x, w)
+        for _ in range(repeats):
+            start = time.perf_counter()
+            model(x, w)
+            times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def main():
+    # setup argument parser
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-channels", type=str, default="0,1,2,3,4,5,6,7,8,9,10,11", help="Channels"
+    )
+    parser.add_argument(
+        "--checkpoint", type=str, required=True, help="Path to model checkpoint"
+    )
+    parser.add_argument(
+        "--output", type=str, default="model.onnx", help="Path to the ONNX file"
+    )
+    parser.add_argument(
+        "--heads",
+        type=str,
+        default="dense",
+        choices=HEADS,
+        help="Task heads of the checkpoint",
+    )
+    parser.add_argument(
+        "--width", type=float, default=1.0, help="Channel width multiplier"
+    )
+    parser.add_argument(
+        "--depth", type=int, default=4, help="Number of U-Net down/up stages"
+    )
+    parser.add_argument(
+        "--pruned",
+        action="store_true",
+        help="Checkpoint written by prune_multitask.py; shapes are read from it",
+    )
+    parser.add_argument(
+        "--size", type=int, default=120, help="Side length of the input tiles"
+    )
+    parser.add_argument("--opset", type=int, default=13, help="ONNX opset version")
+    parser.add_argument(
+        "--rtol", type=float, default=1e-3, help="Relative parity tolerance"
+    )
+    parser.add_argument(
+        "--atol", type=float, default=1e-3, help="Absolute parity tolerance"
+    )
+    parser.add_argument(
+        "-bs", type=int, default=32, help="Batch size of the parity and latency check"
+    )
+    args = parser.parse_args()
+
+    channels = [int(c) for c in args.channels.split(",")]
+
+    state_dict = torch.load(args.checkpoint, map_location=torch.device("cpu"))
+    if args.pruned:
+        model = load_pruned_model(state_dict)
+    else:
+        model = MultiTaskModel(
+            n_channels=len(channels),
+            n_classes=1,
+            heads=args.heads,
+            width=args.width,
+            depth=args.depth,
+        )
+        model.load_state_dict(state_dict)
+    model.eval()
+
+    export_onnx(model, args.output, len(channels), args.size, args.opset)
+    print("exported to", args.output)
+
+    onnx_model = OnnxMultiTaskModel(args.output)
+
+    # check a single sample and a full batch to cover the dynamic batch size
+    torch.manual_seed(0)
+    ok = True
+    for bs in [1, args.bs]:
+        x = torch.randn(bs, len(channels), args.size, args.size)
+        w = torch.randn(bs, 1, 4)
+        diffs, batch_ok = check_parity(
+            model, onnx_model, x, w, rtol=args.rtol, atol=args.atol
+        )
+        ok = ok and batch_ok
+        print(
+            "batch size {}: max abs diff ".format(bs)
+            + ", ".join("{}={:.2e}".format(k, v) for k, v in diffs.items())
+        )
+
+    print(
+        "latency for batch size {}: torch {:.1f} ms, onnx {:.1f} ms".format(
+            args.bs, 1000 * latency(model, x, w), 1000 * latency(onnx_model, x, w)
+        )
+    )
+
+    if not ok:
+        raise SystemExit(
+            "ONNX outputs differ beyond rtol={} atol={}".format(args.rtol, args.atol)
+        )
+    print("parity check passed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import os
+import pandas as pd
+
+import argparse
+
+from dataset_multitask import MultiTaskDataset
+from dataset_tilestore import materialize
+
+# (tile store name, image/label subdirectory, tile size)
+SPLITS = [
+    ("training_120x120", "training/120x120/", 120),
+    ("training_300x300", "training/300x300/", 300),
+    ("validation", "validation/", 120),
+]
+
+
+def materialize_splits(
+    channels,
+    datadir,
+    seglabeldir,
+    reg_file,
+    store_dir,
+    cache_dir=None,
+    dtype="uint16",
+    native=False,
+):
+    """Write tile stores for all splits used by `train_model`.
+    :param channels: list of channels indices
+    :param datadir: path to satellite images
+    :param seglabeldir: path to segmentation labels
+    :param reg_file: path to csv file for regression
+    :param store_dir: output path for the tile stores
+    :param cache_dir: path to cached dataset manifests
+    :param dtype: storage dtype of the image data
+    :param native: if `True`, store 300x300 tiles at native resolution"""
+    reg_data = pd.read_csv(reg_file)
+
+    for name, subdir, size in SPLITS:
+        data = MultiTaskDataset(
+            channels=channels,
+            size=size,
+            reg_data=reg_data,
+            datadir=os.path.join(datadir, subdir),
+            seglabeldir=os.path.join(seglabeldir, subdir),
+            cache_dir=cache_dir,
+            native=native,
+        )
+        materialize(data, os.path.join(store_dir, name), dtype=dtype)
+
+
+def main():
+    # setup argument parser
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-channels", type=str, default="0,1,2,3,4,5,6,7,8,9,10,11", help="Channels"
+    )
+    parser.add_argument(
+        "--data_dir", type=str, default="data/images/", help="Path to data directory"
+    )
+    parser.add_argument(
+        "--seg_label_dir",
+        type=str,
+        default="data/segmentation_labels/",
+        help="Path to segmentation label directory",
+    )
+    parser.add_argument(
+        "--reg_file",
+        type=str,
+        default="labels.csv",
+        help="Path to regression data directory",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default="cache",
+        help="Path to dataset cache directory",
+    )
+    parser.add_argument(
+        "--store_dir",
+        type=str,
+        default="data/tiles/",
+        help="Output path for the tile stores",
+    )
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        default="uint16",
+        choices=["uint16", "float32"],
+        help="Storage dtype of the image data",
+    )
+    parser.add_argument(
+        "--native",
+        action="store_true",
+        help="Keep 300x300 tiles at native resolution (for pooled heads)",
+    )
+
+    args = parser.parse_args()
+
+    channels = [int(c) for c in args.channels.split(",")]
+
+    materialize_splits(
+        channels,
+        datadir=args.data_dir,
+        seglabeldir=args.seg_label_dir,
+        reg_file=args.reg_file,
+        store_dir=args.store_dir,
+        cache_dir=args.cache_dir,
+        dtype=args.dtype,
+        native=args.native,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+class MultiTaskMetrics(object):
+    """Accumulate losses and metrics of the multitask model as tensor
+    reductions on the training device.
+
+    Nothing is transferred to the host until `compute` (or `mean_loss`) is
+    called, so updating the metrics never forces a device sync.
+
+    IoU follows the previous `jaccard_score` loop: samples with an empty
+    predicted or empty true plume mask are skipped. Classification accuracy
+    and losses are averaged over batches, as before.
+    """
+
+    def __init__(self, device, n_classes=4, loss_names=("loss",)):
+        """
+        :param device: device the model outputs live on
+        :param n_classes: number of fuel type classes
+        :param loss_names: names of the losses passed to `update`
+        """
+        self.device = device
+        self.n_classes = n_classes
+        self.loss_names = list(loss_names)
+        # scalar accumulators live in one vector so that `compute` needs a
+        # single transfer
+        self.names = [
+            "iou_sum",
+            "iou_count",
+            "bin_acc_sum",
+            "abs_err_sum",
+            "n_samples",
+            "n_batches",
+        ] + self.loss_names
+        self.reset()
+
+    def reset(self):
+        """Clear all accumulators, e.g. at the start of an epoch."""
+        self.sums = torch.zeros(
+            len(self.names), dtype=torch.float64, device=self.device
+        )
+        self.confusion = torch.zeros(
+            (self.n_classes, self.n_classes), dtype=torch.int64, device=self.device
+        )
+
+    @torch.no_grad()
+    def update(self, seg_output, y, reg_output, e, cls_output, t, **losses):
+        """Add one batch.
+        :param seg_output: segmentation logits (batch, 1, height, width)
+        :param y: segmentation masks (batch, height, width)
+        :param reg_output: power generation predictions (batch, 1)
+        :param e: power generation targets (batch,)
+        :param cls_output: fuel type logits (batch, n_classes)
+        :param t: fuel type targets (batch,)
+        :param losses: scalar loss tensors named as in `loss_names`"""
+        pred = seg_output[:, 0] >= 0
+        target = y > 0.5
+        intersection = (pred & target).flatten(1).sum(1)
+        union = (pred | target).flatten(1).sum(1)
+        valid = pred.flatten(1).any(1) & target.flatten(1).any(1)
+        iou = intersection.double() / union.clamp(min=1).double()
+
+        cls_pred = cls_output.argmax(dim=1)
+        self.confusion += torch.bincount(
+            t * self.n_classes + cls_pred, minlength=self.n_classes**2
+        ).view(self.n_classes, self.n_classes)
+
+        batch = torch.stack(
+            [
+                (iou * valid).sum(),
+                valid.sum().double(),
+                (cls_pred == t).double().mean(),
+                (reg_output.detach().view(-1).double() - e.double()).abs().sum(),
+                torch.tensor(float(len(t)), dtype=torch.float64, device=t.device),
+                torch.ones((), dtype=torch.float64, device=t.device),
+            ]
+            + [losses[name].detach().double() for name in self.loss_names]
+        )
+        self.sums += batch
+
+    def all_reduce(self):
+        """Sum the accumulators over all ranks of a distributed run, so that
+        `compute` covers the batches of every rank; a no-op otherwise."""
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(self.sums)
+            dist.all_reduce(self.confusion)
+
+    def mean_loss(self, name="loss"):
+        """Average of a loss over the batches seen so far; forces a sync.
+        :param name: loss name
+        :return: float"""
+        total = self.sums[self.names.index(name)]
+        n_batches = self.sums[self.names.index("n_batches")]
+        return (total / n_batches.clamp(min=1)).item()
+
+    def compute(self):
+        """Transfer the accumulators and derive the metrics.
+        :return: dict with `iou`, `bin_acc`, `mae`, `confusion` and the mean
+            of every loss"""
+        sums = dict(zip(self.names, self.sums.cpu().numpy()))
+        n_batches = max(sums["n_batches"], 1)
+        out = {
+            "iou": (
+                sums["iou_sum"] / sums["iou_count"] if sums["iou_count"] > 0 else np.nan
+            ),
+            "bin_acc": sums["bin_acc_sum"] / n_batches,
+            "mae": sums["abs_err_sum"] / max(sums["n_samples"], 1),
+            "confusion": self.confusion.cpu().numpy(),
+        }
+        for name in self.loss_names:
+            out[name] = sums[name] / n_batches
+        return out
@@ -0,0 +1,55 @@
+import contextlib
+import torch
+from torch import nn
+
+PRECISIONS = ["fp32", "bf16", "fp16"]
+
+
+def check_precision(device, precision):
+    """Raise if a precision mode is not usable on a device.
+    :param device: torch device
+    :param precision: one of `PRECISIONS`"""
+    if precision not in PRECISIONS:
+        raise ValueError(
+            "unknown precision {}, expected one of {}".format(precision, PRECISIONS)
+        )
+    if precision == "fp16" and device.type != "cuda":
+        raise ValueError("fp16 mixed precision requires a CUDA device, use bf16")
+
+
+def autocast(device, precision):
+    """Context manager running the enclosed forward pass in mixed precision.
+    :param device: torch device
+    :param precision: one of `PRECISIONS`; `fp32` disables autocasting
+    :return: context manager"""
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    dtype = torch.bfloat16 if precision == "bf16" else torch.float16
+    return torch.autocast(device_type=device.type, dtype=dtype)
+
+
+def grad_scaler(device, precision):
+    """Loss scaler for the precision mode; only float16 needs scaling, for
+    all other modes the scaler passes losses and steps through unchanged.
+    :param device: torch device
+    :param precision: one of `PRECISIONS`
+    :return: `GradScaler` instance"""
+    return torch.cuda.amp.GradScaler(
+        enabled=precision == "fp16" and device.type == "cuda"
+    )
+
+
+def _float32_inputs(module, inputs):
+    return tuple(x.float() for x in inputs)
+
+
+def keep_batchnorm_fp32(model):
+    """Make all BatchNorm layers of a model compute in float32 under
+    autocast by casting their inputs; the layers' parameters and running
+    statistics stay float32 anyway.
+    :param model: model instance
+    :return: model"""
+    for module in model.modules():
+        if isinstance(module, nn.modules.batchnorm._BatchNorm):
+            module.register_forward_pre_hook(_float32_inputs)
+    return model
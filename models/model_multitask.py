@@ -4,12 +4,18 @@
 #
 # Copyright (C) 2017 https://github.com/milesial
 
+import inspect
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
+# non-reentrant checkpointing (torch >= 1.11) also keeps the gradients of
+# blocks whose inputs need none, such as the first block
+NON_REENTRANT = "use_reentrant" in inspect.signature(checkpoint).parameters
+
 
 class Identity(nn.Module):
     def __init__(self):
@@ -53,7 +59,59 @@ class ConvRegression(nn.Module):
         x1 = x1.view(-1, 120 * 120)
         x2 = w.view(-1, 4)
         x3 = torch.cat((x1, x2), dim=1)
-        x_out = self.fc(x3)
+        # regress the generation in MW in float32 under mixed precision
+        with torch.autocast(device_type=x3.device.type, enabled=False):
+            x_out = self.fc(x3.float())
+        return x_out
+
+
+class PooledClassification(nn.Module):
+    """Classification head for any input resolution; the projected feature
+    map is average-pooled to a fixed grid before the linear layer."""
+
+    def __init__(self, in_channels, out_channels, num_class, pool_size=8):
+        super(PooledClassification, self).__init__()
+        self.out_conv = nn.Conv2d(in_channels, out_channels, kernel_size=1)
+        self.pool = nn.AdaptiveAvgPool2d(pool_size)
+
+        self.fc = nn.Sequential(
+            nn.Dropout(p=0.1), nn.Linear(out_channels * pool_size**2, num_class)
+        )
+
+    def forward(self, x):
+        x1 = self.pool(self.out_conv(x))
+        x2 = torch.flatten(x1, 1)
+        x_out = self.fc(x2)
+        return x_out
+
+
+class PooledRegression(nn.Module):
+    """Regression head for any input resolution; the projected feature map is
+    average-pooled to a fixed grid before the fully connected layers."""
+
+    def __init__(self, in_channels, out_channels, pool_size=8):
+        super(PooledRegression, self).__init__()
+        self.out_conv = nn.Conv2d(in_channels, out_channels, kernel_size=1)
+        self.pool = nn.AdaptiveAvgPool2d(pool_size)
+        self.fc = nn.Sequential(
+            nn.Linear(out_channels * pool_size**2 + 4, 64),
+            nn.BatchNorm1d(64),
+            nn.ReLU(inplace=True),
+            nn.Linear(64, 32),
+            nn.BatchNorm1d(32),
+            nn.ReLU(inplace=True),
+            nn.Linear(32, 1),
+            nn.ReLU(inplace=True),
+        )
+
+    def forward(self, x, w):
+        x1 = self.pool(self.out_conv(x))
+        x1 = torch.flatten(x1, 1)
+        x2 = w.view(-1, 4)
+        x3 = torch.cat((x1, x2), dim=1)
+        # regress the generation in MW in float32 under mixed precision
+        with torch.autocast(device_type=x3.device.type, enabled=False):
+            x_out = self.fc(x3.float())
         return x_out
 
 
@@ -127,38 +185,109 @@ class OutConv(nn.Module):
         return x_out
 
 
+HEADS = ["dense", "pooled"]
+
+
+def _recomputable(block):
+    """Wrap a block for `checkpoint`. The first call is the forward pass;
+    later calls recompute it in the backward pass and restore the BatchNorm
+    running statistics afterwards, so they are updated once per step as
+    without checkpointing.
+    :param block: module
+    :return: function"""
+    calls = []
+
+    def run(*inputs):
+        if not calls:
+            calls.append(1)
+            return block(*inputs)
+        buffers = [
+            buffer
+            for module in block.modules()
+            if isinstance(module, nn.modules.batchnorm._BatchNorm)
+            for buffer in module.buffers(recurse=False)
+        ]
+        saved = [buffer.clone() for buffer in buffers]
+        try:
+            return block(*inputs)
+        finally:
+            with torch.no_grad():
+                for buffer, value in zip(buffers, saved):
+                    buffer.copy_(value)
+
+    return run
+
+
 class MultiTaskModel(nn.Module):
-    def __init__(self, n_channels, n_classes, bilinear=True):
+    def __init__(
+        self, n_channels, n_classes, bilinear=True, heads="dense", width=1.0, depth=4
+    ):
+        """
+        :param heads: "dense" heads need 120x120 inputs, "pooled" heads
+            accept any input resolution
+        :param width: multiplier of the channel widths (64 to 1024 for 1.0)
+        :param depth: number of down- and upscaling stages
+        """
         super(MultiTaskModel, self).__init__()
         self.n_channels = n_channels
         self.n_classes = n_classes
         self.bilinear = bilinear
-
-        self.inc = DoubleConv(n_channels, 64)
-        self.down1 = Down(64, 128)
-        self.down2 = Down(128, 256)
-        self.down3 = Down(256, 512)
+        self.heads = heads
+        self.width = width
+        self.depth = depth
+        # recompute the activations of the U-Net blocks in the backward pass
+        # instead of storing them, see `_run`
+        self.checkpoint_activations = False
+
+        # channels of the encoder stages; the default configuration keeps
+        # the module names and shapes of the original U-Net
+        channels = [max(int(64 * width), 1) * 2**i for i in range(depth + 1)]
         factor = 2 if bilinear else 1
-        self.down4 = Down(512, 1024 // factor)
-        self.up1 = Up(1024, 512 // factor, bilinear)
-        self.up2 = Up(512, 256 // factor, bilinear)
-        self.up3 = Up(256, 128 // factor, bilinear)
-        self.up4 = Up(128, 64, bilinear)
 
-        self.outc = OutConv(64, n_classes)
-        self.outr = ConvRegression(64, 1)
-        self.outb = MulticlassClassification(64, 1, 4)
+        self.inc = DoubleConv(n_channels, channels[0])
+        for i in range(1, depth + 1):
+            out_channels = channels[i] // factor if i == depth else channels[i]
+            setattr(self, "down{}".format(i), Down(channels[i - 1], out_channels))
+        for i in range(1, depth + 1):
+            out_channels = channels[depth - i]
+            if i < depth:
+                out_channels = out_channels // factor
+            setattr(
+                self,
+                "up{}".format(i),
+                Up(channels[depth - i + 1], out_channels, bilinear),
+            )
+
+        self.outc = OutConv(channels[0], n_classes)
+        if heads == "pooled":
+            self.outr = PooledRegression(channels[0], 1)
+            self.outb = PooledClassification(channels[0], 1, 4)
+        elif heads == "dense":
+            self.outr = ConvRegression(channels[0], 1)
+            self.outb = MulticlassClassification(channels[0], 1, 4)
+        else:
+            raise ValueError(
+                "unknown heads {}, expected one of {}".format(heads, HEADS)
+            )
+
+    def _run(self, block, *inputs):
+        """Apply a U-Net block; with activation checkpointing during training
+        only its inputs are kept and its forward pass is repeated in the
+        backward pass, see `_recomputable`."""
+        if self.checkpoint_activations and self.training and torch.is_grad_enabled():
+            if NON_REENTRANT:
+                return checkpoint(_recomputable(block), *inputs, use_reentrant=False)
+            if any(t.requires_grad for t in inputs):
+                return checkpoint(_recomputable(block), *inputs)
+        return block(*inputs)
 
     def forward(self, x, w):
-        x1 = self.inc(x)
-        x2 = self.down1(x1)
-        x3 = self.down2(x2)
-        x4 = self.down3(x3)
-        x5 = self.down4(x4)
-        x = self.up1(x5, x4)
-        x = self.up2(x, x3)
-        x = self.up3(x, x2)
-        x = self.up4(x, x1)
+        xs = [self._run(self.inc, x)]
+        for i in range(1, self.depth + 1):
+            xs.append(self._run(getattr(self, "down{}".format(i)), xs[-1]))
+        x = xs[-1]
+        for i in range(1, self.depth + 1):
+            x = self._run(getattr(self, "up{}".format(i)), x, xs[self.depth - i])
 
         x_out_c = self.outc(x)
         x_out_r = self.outr(x, w)
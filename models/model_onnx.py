@@ -0,0 +1,98 @@
+import numpy as np
+import torch
+
+BACKENDS = ["torch", "onnx"]
+
+INPUT_NAMES = ["x", "w"]
+OUTPUT_NAMES = ["segmentation", "regression", "classification"]
+
+
+def export_onnx(model, path, n_channels, size=120, opset_version=13):
+    """Export a `MultiTaskModel` to ONNX with a dynamic batch dimension.
+
+    The spatial size is fixed to `size`; dense heads only work with 120x120
+    inputs anyway, and scripts reject native tiles for ONNX models.
+    :param model: model instance
+    :param path: output path of the ONNX file
+    :param n_channels: number of input channels
+    :param size: side length of the input tiles
+    :param opset_version: ONNX opset
+    :return: path"""
+    model = model.cpu().eval()
+    x = torch.zeros((2, n_channels, size, size))
+    w = torch.zeros((2, 1, 4))
+    dynamic_axes = {name: {0: "batch"} for name in INPUT_NAMES + OUTPUT_NAMES}
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (x, w),
+            path,
+            input_names=INPUT_NAMES,
+            output_names=OUTPUT_NAMES,
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+            do_constant_folding=True,
+        )
+    return path
+
+
+class OnnxMultiTaskModel(object):
+    """Exported `MultiTaskModel` run with ONNX Runtime on the CPU.
+
+    Called like the PyTorch model with image and weather tensors and returns
+    segmentation logits, power generation and fuel type logits as tensors on
+    the device of the inputs, so it can stand in for `MultiTaskModel` in the
+    evaluation and inference scripts.
+    """
+
+    def __init__(self, path, num_threads=None):
+        """
+        :param path: path to an ONNX file written by `export_onnx`
+        :param num_threads: number of intra-op threads, all cores if `None`
+        """
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+        # exports have a fixed spatial size, see `export_onnx`
+        self.size = self.session.get_inputs()[0].shape[-1]
+
+    def eval(self):
+        return self
+
+    def to(self, device):
+        return self
+
+    def __call__(self, x, w):
+        inputs = {
+            "x": x.detach().float().cpu().numpy(),
+            "w": w.detach().float().cpu().numpy(),
+        }
+        outputs = self.session.run(OUTPUT_NAMES, inputs)
+        return tuple(torch.from_numpy(o).to(x.device) for o in outputs)
+
+
+def check_parity(model, onnx_model, x, w, rtol=1e-3, atol=1e-3):
+    """Compare the outputs of a PyTorch model and its ONNX export.
+    :param model: `MultiTaskModel` instance on the CPU
+    :param onnx_model: `OnnxMultiTaskModel` instance
+    :param x: image batch
+    :param w: weather batch
+    :return: dict mapping output names to the maximum absolute difference and
+        whether all outputs agree within tolerance"""
+    model.eval()
+    with torch.no_grad():
+        expected = model(x, w)
+    actual = onnx_model(x, w)
+
+    diffs, ok = {}, True
+    for name, e, a in zip(OUTPUT_NAMES, expected, actual):
+        e, a = e.numpy(), a.numpy()
+        diffs[name] = float(np.abs(e - a).max())
+        ok = ok and np.allclose(a, e, rtol=rtol, atol=atol)
+    return diffs, ok
@@ -0,0 +1,175 @@
+import math
+import torch
+import torch.nn as nn
+
+from models.model_multitask import MultiTaskModel
+
+
+def double_convs(model):
+    """All `DoubleConv` blocks of a `MultiTaskModel` by name.
+    :param model: model instance
+    :return: dict mapping `inc`, `downN` and `upN` to `DoubleConv` blocks"""
+    blocks = {"inc": model.inc}
+    for i in range(1, model.depth + 1):
+        blocks["down{}".format(i)] = getattr(model, "down{}".format(i)).maxpool_conv[1]
+    for i in range(1, model.depth + 1):
+        blocks["up{}".format(i)] = getattr(model, "up{}".format(i)).conv
+    return blocks
+
+
+def encoder(i):
+    """Name of the encoder block producing the features of stage `i`."""
+    return "inc" if i == 0 else "down{}".format(i)
+
+
+def _conv_bn(block):
+    layers = block.double_conv
+    return (layers[0], layers[1]), (layers[3], layers[4])
+
+
+def filter_importance(conv, bn):
+    """L1 norm of every filter of a convolution after folding in the
+    following batch normalization, i.e. its effective output scale.
+    :param conv: `nn.Conv2d` layer
+    :param bn: `nn.BatchNorm2d` layer following it
+    :return: tensor of importances per output channel"""
+    scale = bn.weight.abs() / torch.sqrt(bn.running_var + bn.eps)
+    return conv.weight.abs().sum(dim=(1, 2, 3)) * scale
+
+
+def n_keep(n_channels, amount, round_to=1):
+    """Number of channels left after pruning.
+    :param n_channels: number of channels
+    :param amount: fraction of channels to remove
+    :param round_to: keep a multiple of this many channels
+    :return: int"""
+    keep = math.ceil(n_channels * (1 - amount) / round_to) * round_to
+    return max(min(keep, n_channels), 1)
+
+
+def _keep_indices(conv, bn, amount, round_to):
+    importance = filter_importance(conv, bn)
+    keep = torch.argsort(importance, descending=True)
+    return torch.sort(keep[: n_keep(len(importance), amount, round_to)])[0]
+
+
+def _select_outputs(conv, bn, keep):
+    conv.weight = nn.Parameter(conv.weight.data[keep].clone())
+    if conv.bias is not None:
+        conv.bias = nn.Parameter(conv.bias.data[keep].clone())
+    conv.out_channels = len(keep)
+    if bn is not None:
+        bn.weight = nn.Parameter(bn.weight.data[keep].clone())
+        bn.bias = nn.Parameter(bn.bias.data[keep].clone())
+        bn.running_mean = bn.running_mean[keep].clone()
+        bn.running_var = bn.running_var[keep].clone()
+        bn.num_features = len(keep)
+
+
+def _select_inputs(conv, keep):
+    conv.weight = nn.Parameter(conv.weight.data[:, keep].clone())
+    conv.in_channels = len(keep)
+
+
+@torch.no_grad()
+def prune_model(model, amount=0.5, round_to=1):
+    """Remove the least important filters of every `DoubleConv` block in
+    place, both the inner channels and the block outputs.
+
+    Block outputs feed the next stage and, in the encoder, the skip
+    connection of the matching decoder stage. Every consumer of a block is
+    pruned with the same channel selection, so the concatenations in the
+    `Up` blocks stay consistent. Afterwards the model only consists of
+    regular, smaller layers.
+    :param model: `MultiTaskModel` instance with bilinear upscaling
+    :param amount: fraction of channels to remove per layer
+    :param round_to: keep a multiple of this many channels per layer
+    :return: model"""
+    if not model.bilinear:
+        raise NotImplementedError("pruning needs a model with bilinear upscaling")
+
+    blocks = double_convs(model)
+    depth = model.depth
+
+    # the inputs of every block and head as list of producing blocks, in
+    # concatenation order
+    inputs = {"down{}".format(i): [encoder(i - 1)] for i in range(1, depth + 1)}
+    for i in range(1, depth + 1):
+        previous = "up{}".format(i - 1) if i > 1 else encoder(depth)
+        inputs["up{}".format(i)] = [encoder(depth - i), previous]
+    head_input = "up{}".format(depth)
+
+    # select the channels to keep from the unpruned weights
+    keep_mid, keep_out, n_out = {}, {}, {}
+    for name, block in blocks.items():
+        (conv1, bn1), (conv2, bn2) = _conv_bn(block)
+        keep_mid[name] = _keep_indices(conv1, bn1, amount, round_to)
+        keep_out[name] = _keep_indices(conv2, bn2, amount, round_to)
+        n_out[name] = conv2.out_channels
+
+    for name, block in blocks.items():
+        (conv1, bn1), (conv2, bn2) = _conv_bn(block)
+        if name in inputs:
+            keep, offset = [], 0
+            for producer in inputs[name]:
+                keep.append(keep_out[producer] + offset)
+                offset += n_out[producer]
+            _select_inputs(conv1, torch.cat(keep))
+        _select_outputs(conv1, bn1, keep_mid[name])
+        _select_inputs(conv2, keep_mid[name])
+        _select_outputs(conv2, bn2, keep_out[name])
+
+    for conv in [model.outc.conv[0], model.outr.out_conv, model.outb.out_conv]:
+        _select_inputs(conv, keep_out[head_input])
+
+    return model
+
+
+def resize_to_state_dict(model, state_dict):
+    """Resize the convolution and batch normalization layers of a model to
+    the shapes stored in a state dict, e.g. of a pruned model.
+    :param model: model instance
+    :param state_dict: state dict to be loaded
+    :return: model"""
+    for name, module in model.named_modules():
+        prefix = name + "." if name else ""
+        if isinstance(module, nn.Conv2d):
+            weight = state_dict[prefix + "weight"]
+            if weight.shape != module.weight.shape:
+                module.weight = nn.Parameter(torch.empty_like(weight))
+                if module.bias is not None:
+                    module.bias = nn.Parameter(torch.empty_like(weight[:, 0, 0, 0]))
+                module.out_channels, module.in_channels = weight.shape[:2]
+        elif isinstance(module, nn.BatchNorm2d):
+            n_features = len(state_dict[prefix + "weight"])
+            if n_features != module.num_features:
+                module.weight = nn.Parameter(torch.empty(n_features))
+                module.bias = nn.Parameter(torch.empty(n_features))
+                module.running_mean = torch.zeros(n_features)
+                module.running_var = torch.ones(n_features)
+                module.num_features = n_features
+    return model
+
+
+def load_pruned_model(state_dict, n_classes=1):
+    """Build a `MultiTaskModel` for a pruned state dict; the number of input
+    channels, the depth and the type of heads are read from it.
+    :param state_dict: state dict of a pruned model
+    :param n_classes: number of segmentation classes
+    :return: model with loaded weights"""
+    depth = 0
+    while "down{}.maxpool_conv.1.double_conv.0.weight".format(depth + 1) in state_dict:
+        depth += 1
+    heads = "dense"
+    if state_dict["outr.fc.0.weight"].shape[1] != 120 * 120 + 4:
+        heads = "pooled"
+
+    model = MultiTaskModel(
+        n_channels=state_dict["inc.double_conv.0.weight"].shape[1],
+        n_classes=n_classes,
+        heads=heads,
+        depth=depth,
+    )
+    resize_to_state_dict(model, state_dict)
+    model.load_state_dict(state_dict)
+    return model
@@ -0,0 +1,453 @@
+import os
+import itertools
+import numpy as np
+import pandas as pd
+import rasterio as rio
+import torch
+from tqdm.autonotebook import tqdm
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
+
+import argparse
+
+from models.model_multitask import HEADS, MultiTaskModel, device
+from models.pruning import load_pruned_model
+from models.model_onnx import BACKENDS, OnnxMultiTaskModel
+from dataset_manifest import weather_columns
+from dataset_masks import KEEP, RESIZE
+from dataset_multitask import BatchNormalize
+from dataset_reader import as_dtype, read_tile
+from mixed_precision import PRECISIONS, autocast, check_precision, keep_batchnorm_fp32
+
+# fuel type classes of the model, see `fuel_type_dict`
+FUEL_TYPES = ["lignite", "hard_coal", "gas", "peat_oil"]
+
+# CO2 emission factors per fuel type class in t CO2 per MWh generated
+EMISSION_FACTORS = [1.1, 0.95, 0.4, 0.8]
+
+print("running on...", device)
+
+
+def iter_image_paths(inputs):
+    """Iterate over GeoTIFF paths without collecting them first.
+    :param inputs: list of directories (searched recursively), GeoTIFF files
+        and text files listing one GeoTIFF path per line
+    :return: generator of paths"""
+    for path in inputs:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for filename in sorted(files):
+                    if filename.endswith(".tif"):
+                        yield os.path.join(root, filename)
+        elif path.endswith(".tif"):
+            yield path
+        else:
+            with open(path, "r") as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        yield line
+
+
+def read_weather(weather_file):
+    """Read weather data per image file name.
+    :param weather_file: csv file with `filename` and weather columns, e.g.
+        the regression labels file
+    :return: dict mapping file names to float32 arrays (1, 4)"""
+    weather = pd.read_csv(weather_file, usecols=["filename"] + weather_columns)
+    weather = weather.drop_duplicates("filename").dropna()
+    values = weather[weather_columns].to_numpy(dtype=np.float32).reshape(-1, 1, 4)
+    return dict(zip(weather["filename"], values))
+
+
+class SceneStream(IterableDataset):
+    """Stream batches of raw image tiles for inference.
+
+    Every DataLoader worker process decodes every n-th scene and batches the
+    tiles itself, so the main process only receives stacked uint16 batches
+    (reinterpreted as int16, see `ToTensor(raw=True)`). Tiles are batched by
+    size; without native resolution all tiles are resized to 120x120.
+    """
+
+    def __init__(self, inputs, weather, channels, batch_size, native=False, done=()):
+        """
+        :param inputs: inputs as accepted by `iter_image_paths`
+        :param weather: dict mapping file names to weather arrays
+        :param channels: list of channels indices
+        :param batch_size: number of scenes per batch
+        :param native: if `True`, keep tiles at native resolution
+        :param done: set of paths to skip
+        """
+        self.inputs = inputs
+        self.weather = weather
+        self.channels = np.array(channels)
+        self.batch_size = batch_size
+        self.native = native
+        self.done = done
+
+    def load(self, path):
+        """Read one scene.
+        :param path: GeoTIFF path
+        :return: uint16 image array and weather array, or `None` if the scene
+            cannot be processed"""
+        weather = self.weather.get(os.path.basename(path))
+        if weather is None:
+            print("skipping {}: no weather data".format(path))
+            return None
+        try:
+            with rio.open(path) as imgfile:
+                mode = KEEP if self.native or imgfile.height == 120 else RESIZE
+                imgdata = read_tile(imgfile, self.channels, mode)
+            imgdata = as_dtype(imgdata, np.uint16)
+        except Exception as e:
+            # one broken scene must not stop a run over millions of scenes
+            print("skipping {}: {!r}".format(path, e))
+            return None
+        return imgdata, weather
+
+    def collate(self, bucket):
+        paths, imgdata, weather = zip(*bucket)
+        return {
+            "path": list(paths),
+            "img": torch.from_numpy(np.stack(imgdata).view(np.int16)),
+            "weather": torch.from_numpy(np.stack(weather)),
+        }
+
+    def __iter__(self):
+        paths = iter_image_paths(self.inputs)
+        worker = get_worker_info()
+        if worker is not None:
+            paths = itertools.islice(paths, worker.id, None, worker.num_workers)
+
+        buckets = {}
+        for path in paths:
+            if path in self.done:
+                continue
+            sample = self.load(path)
+            if sample is None:
+                continue
+            imgdata, weather = sample
+            bucket = buckets.setdefault(imgdata.shape[1], [])
+            bucket.append((path, imgdata, weather))
+            if len(bucket) == self.batch_size:
+                yield self.collate(bucket)
+                bucket.clear()
+        for bucket in buckets.values():
+            if len(bucket) > 0:
+                yield self.collate(bucket)
+
+
+class CsvWriter(object):
+    """Append prediction rows to a csv file."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _drop_partial_line(self):
+        # an interrupted run may have left an incomplete last row
+        with open(self.path, "rb+") as f:
+            size = f.seek(0, os.SEEK_END)
+            if size == 0:
+                return
+            f.seek(max(size - 2**20, 0))
+            tail = f.read()
+            if tail.endswith(b"\n"):
+                return
+            f.truncate(size - len(tail) + tail.rfind(b"\n") + 1)
+
+    def done(self):
+        """:return: set of paths already written"""
+        if not os.path.exists(self.path):
+            return set()
+        self._drop_partial_line()
+        if os.path.getsize(self.path) == 0:
+            return set()
+        return set(pd.read_csv(self.path, usecols=["path"])["path"])
+
+    def write(self, rows):
+        """:param rows: data frame of predictions"""
+        header = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        rows.to_csv(self.path, mode="a", header=header, index=False)
+
+
+class ParquetWriter(object):
+    """Write prediction rows as numbered Parquet part files into a directory;
+    parts are written atomically, so a partial run never leaves a corrupt
+    part behind."""
+
+    def __init__(self, path):
+        # fail before any work is done if there is no Parquet engine
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError("Parquet output requires pyarrow")
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.n_parts = len(self._parts())
+
+    def _parts(self):
+        return sorted(
+            f
+            for f in os.listdir(self.path)
+            if f.startswith("part-") and f.endswith(".parquet")
+        )
+
+    def done(self):
+        """:return: set of paths already written"""
+        done = set()
+        for part in self._parts():
+            rows = pd.read_parquet(os.path.join(self.path, part), columns=["path"])
+            done.update(rows["path"])
+        return done
+
+    def write(self, rows):
+        """:param rows: data frame of predictions"""
+        part_path = os.path.join(self.path, "part-{:05d}.parquet".format(self.n_parts))
+        tmp_path = "{}.{}.tmp".format(part_path, os.getpid())
+        rows.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, part_path)
+        self.n_parts += 1
+
+
+def predict(
+    model,
+    params,
+    inputs,
+    weather_file,
+    writer,
+    channels,
+    emission_factors=EMISSION_FACTORS,
+):
+    """Run the model over a stream of scenes and write one row per scene.
+
+    Rows hold the plume area in pixels of the model input, the fuel type
+    probabilities, the power generation estimate in MW and the CO2 emission
+    rate in t/h derived from it with the emission factor of the most likely
+    fuel type. Scenes already present in the output are skipped, so an
+    interrupted run can be resumed by running the same command again.
+    :param model: model instance
+    :param params: parameters
+    :param inputs: inputs as accepted by `iter_image_paths`
+    :param weather_file: csv file with weather data per image file name
+    :param writer: `CsvWriter` or `ParquetWriter` instance
+    :param channels: list of channels indices
+    :param emission_factors: t CO2 per MWh for every fuel type class
+    :return: number of scenes processed"""
+    done = writer.done()
+    if len(done) > 0:
+        print("resuming, skipping {} scenes".format(len(done)))
+
+    stream = SceneStream(
+        inputs,
+        read_weather(weather_file),
+        channels,
+        params.bs,
+        native=params.heads == "pooled",
+        done=done,
+    )
+    dl = DataLoader(
+        stream,
+        batch_size=None,
+        num_workers=params.num_workers,
+        pin_memory=device.type == "cuda",
+    )
+
+    normalize = BatchNormalize(np.array(channels)).normalize
+    factors = torch.tensor(emission_factors, dtype=torch.float32, device=device)
+
+    model.eval()
+
+    rows, n_rows, n_scenes = [], 0, 0
+    progress = tqdm(desc="Predicting", unit="scenes")
+
+    for batch in dl:
+        x = normalize(batch["img"].to(device, non_blocking=True))
+        w = batch["weather"].to(device, non_blocking=True)
+
+        with torch.no_grad(), autocast(device, params.precision):
+            output, reg_output, logits = model(x, w)
+
+        probs = torch.softmax(logits.float(), dim=1)
+        gen_output = reg_output.float()[:, 0]
+        fuel_type = probs.argmax(dim=1)
+        # a single transfer per batch
+        out = (
+            torch.cat(
+                [
+                    (output[:, 0] >= 0).flatten(1).sum(1, keepdim=True).float(),
+                    probs,
+                    gen_output.unsqueeze(1),
+                    (gen_output * factors[fuel_type]).unsqueeze(1),
+                    fuel_type.unsqueeze(1).float(),
+                ],
+                dim=1,
+            )
+            .cpu()
+            .numpy()
+        )
+
+        paths = batch["path"]
+        result = pd.DataFrame(
+            {
+                "path": paths,
+                "filename": [os.path.basename(p) for p in paths],
+                "tile_size": x.shape[-1],
+                "plume_pixels": out[:, 0].astype(np.int64),
+            }
+        )
+        for c, fuel in enumerate(FUEL_TYPES):
+            result["prob_{}".format(fuel)] = out[:, 1 + c]
+        result["fuel_type"] = [FUEL_TYPES[int(f)] for f in out[:, -1]]
+        result["gen_output"] = out[:, -3]
+        result["co2_rate"] = out[:, -2]
+        rows.append(result)
+        n_rows += len(result)
+        n_scenes += len(result)
+        progress.update(len(result))
+
+        # bound memory and the work lost on interruption
+        if n_rows >= params.flush_rows:
+            writer.write(pd.concat(rows, ignore_index=True))
+            rows, n_rows = [], 0
+
+    if n_rows > 0:
+        writer.write(pd.concat(rows, ignore_index=True))
+    progress.close()
+
+    return n_scenes
+
+
+def main():
+    # setup argument parser
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "inputs",
+        type=str,
+        nargs="+",
+        help="GeoTIFF files, directories or text files listing GeoTIFF paths",
+    )
+    parser.add_argument("-bs", type=int, nargs="?", default=32, help="Batch size")
+    parser.add_argument(
+        "-channels", type=str, default="0,1,2,3,4,5,6,7,8,9,10,11", help="Channels"
+    )
+    parser.add_argument(
+        "--checkpoint", type=str, required=True, help="Path to model checkpoint"
+    )
+    parser.add_argument(
+        "--weather_file",
+        type=str,
+        required=True,
+        help="Csv file with weather data per image file name",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="predictions.csv",
+        help="Output csv file or Parquet directory; existing rows are kept",
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        default="csv",
+        choices=["csv", "parquet"],
+        help="Output format",
+    )
+    parser.add_argument(
+        "--heads",
+        type=str,
+        default="dense",
+        choices=HEADS,
+        help="Task heads of the checkpoint; pooled heads take native tiles",
+    )
+    parser.add_argument(
+        "--width", type=float, default=1.0, help="Channel width multiplier"
+    )
+    parser.add_argument(
+        "--depth", type=int, default=4, help="Number of U-Net down/up stages"
+    )
+    parser.add_argument(
+        "--pruned",
+        action="store_true",
+        help="Checkpoint written by prune_multitask.py; shapes are read from it",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=PRECISIONS,
+        help="Mixed precision mode (bf16 works on CPU, fp16 needs CUDA)",
+    )
+    parser.add_argument(
+        "--num_workers", type=int, default=6, help="Number of decoding processes"
+    )
+    parser.add_argument(
+        "--flush_rows",
+        type=int,
+        default=10000,
+        help="Number of rows buffered before writing to the output",
+    )
+    parser.add_argument(
+        "--emission_factors",
+        type=str,
+        default=",".join(str(f) for f in EMISSION_FACTORS),
+        help="t CO2 per MWh for the fuel types {}".format(",".join(FUEL_TYPES)),
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="torch",
+        choices=BACKENDS,
+        help="Inference backend; onnx takes a file from export_multitask.py",
+    )
+    args = parser.parse_args()
+
+    channels = [int(c) for c in args.channels.split(",")]
+    emission_factors = [float(f) for f in args.emission_factors.split(",")]
+    if len(emission_factors) != len(FUEL_TYPES):
+        parser.error("--emission_factors needs {} values".format(len(FUEL_TYPES)))
+
+    check_precision(device, args.precision)
+    if args.backend == "onnx" and args.precision != "fp32":
+        parser.error("the onnx backend runs in fp32")
+    if args.backend == "onnx" and args.heads == "pooled":
+        # exports have a fixed tile size, native tiles vary in size
+        parser.error("the onnx backend does not support pooled heads")
+
+    if args.backend == "onnx":
+        model = OnnxMultiTaskModel(args.checkpoint)
+    else:
+        state_dict = torch.load(args.checkpoint, map_location=torch.device("cpu"))
+        if args.pruned:
+            model = load_pruned_model(state_dict)
+        else:
+            model = MultiTaskModel(
+                n_channels=len(channels),
+                n_classes=1,
+                heads=args.heads,
+                width=args.width,
+                depth=args.depth,
+            )
+            model.load_state_dict(state_dict)
+        if args.precision != "fp32":
+            keep_batchnorm_fp32(model)
+        model.to(device)
+
+    if args.format == "parquet":
+        writer = ParquetWriter(args.output)
+    else:
+        writer = CsvWriter(args.output)
+
+    n_scenes = predict(
+        model,
+        args,
+        args.inputs,
+        args.weather_file,
+        writer,
+        channels,
+        emission_factors=emission_factors,
+    )
+    print("wrote predictions for {} scenes to {}".format(n_scenes, args.output))
+
+
+if __name__ == "__main__":
+    main()
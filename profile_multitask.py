@@ -0,0 +1,132 @@
+import torch
+from torch import nn
+
+import argparse
+
+from models.model_multitask import HEADS, MultiTaskModel
+from export_multitask import latency
+
+
+def count_flops(model, x, w):
+    """Count the floating point operations of a forward pass, taking two
+    operations per multiply-accumulate of the convolution and linear layers;
+    the cheap elementwise, pooling and normalization layers are ignored.
+    :param model: model instance
+    :param x: image batch
+    :param w: weather batch
+    :return: FLOPs per sample"""
+    macs = []
+
+    def conv_hook(module, inputs, output):
+        kernel = module.weight[0].numel()
+        macs.append(output.numel() * kernel)
+
+    def transposed_conv_hook(module, inputs, output):
+        kernel = module.weight[0].numel()
+        macs.append(inputs[0].numel() * kernel)
+
+    def linear_hook(module, inputs, output):
+        macs.append(output.numel() * module.in_features)
+
+    hooks = []
+    for module in model.modules():
+        if isinstance(module, nn.ConvTranspose2d):
+            hooks.append(module.register_forward_hook(transposed_conv_hook))
+        elif isinstance(module, nn.Conv2d):
+            hooks.append(module.register_forward_hook(conv_hook))
+        elif isinstance(module, nn.Linear):
+            hooks.append(module.register_forward_hook(linear_hook))
+
+    with torch.no_grad():
+        model(x, w)
+    for hook in hooks:
+        hook.remove()
+
+    return 2 * sum(macs) / len(x)
+
+
+def profile_model(model, bs=8, size=120, repeats=10):
+    """Cost of a model configuration on the CPU.
+    :param model: model instance
+    :param bs: batch size for the latency measurement
+    :param size: side length of the input tiles
+    :param repeats: number of timed forward passes
+    :return: dict with parameter count, GFLOPs per sample and latency in ms"""
+    model = model.cpu().eval()
+    x = torch.randn(bs, model.n_channels, size, size)
+    w = torch.randn(bs, 1, 4)
+    return {
+        "params": sum(p.numel() for p in model.parameters()),
+        "gflops": count_flops(model, x, w) / 1e9,
+        "latency": 1000 * latency(model, x, w, repeats=repeats),
+    }
+
+
+def main():
+    # setup argument parser
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--configs",
+        type=str,
+        default="1.0:4,0.5:4,0.25:4,0.5:3",
+        help="Comma-separated width:depth model configurations",
+    )
+    parser.add_argument(
+        "-channels", type=str, default="0,1,2,3,4,5,6,7,8,9,10,11", help="Channels"
+    )
+    parser.add_argument(
+        "--heads",
+        type=str,
+        default="dense",
+        choices=HEADS,
+        help="Task heads",
+    )
+    parser.add_argument("-bs", type=int, default=8, help="Batch size for latency")
+    parser.add_argument(
+        "--size", type=int, default=120, help="Side length of the input tiles"
+    )
+    parser.add_argument(
+        "--repeats", type=int, default=10, help="Number of timed forward passes"
+    )
+    parser.add_argument(
+        "--num_threads", type=int, default=None, help="Number of CPU threads"
+    )
+    args = parser.parse_args()
+
+    channels = [int(c) for c in args.channels.split(",")]
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    print(
+        "{:>6} {:>6} {:>12} {:>10} {:>12} {:>8}".format(
+            "width", "depth", "params", "GFLOPs", "latency ms", "cost"
+        )
+    )
+    reference = None
+    for config in args.configs.split(","):
+        width, depth = config.split(":")
+        model = MultiTaskModel(
+            n_channels=len(channels),
+            n_classes=1,
+            heads=args.heads,
+            width=float(width),
+            depth=int(depth),
+        )
+        stats = profile_model(model, bs=args.bs, size=args.size, repeats=args.repeats)
+        # cost relative to the first configuration
+        if reference is None:
+            reference = stats["gflops"]
+        print(
+            "{:>6} {:>6} {:>12,d} {:>10.2f} {:>12.1f} {:>7.2f}x".format(
+                width,
+                depth,
+                stats["params"],
+                stats["gflops"],
+                stats["latency"],
+                stats["gflops"] / reference,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
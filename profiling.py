@@ -0,0 +1,255 @@
+import os
+import json
+import time
+import contextlib
+import torch
+from torch.utils.data import Dataset
+
+# returned by disabled profilers, so timing a stage costs one call
+_NULL_CONTEXT = contextlib.nullcontext()
+
+# key of the sample load times that `TimedDataset` adds to every sample
+LOAD_TIME = "load_time"
+
+
+class TimedDataset(Dataset):
+    """Record how long a DataLoader worker takes to load every sample; the
+    time travels with the sample, so it is measured in the worker."""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        start = time.perf_counter()
+        sample = self.dataset[idx]
+        sample[LOAD_TIME] = time.perf_counter() - start
+        return sample
+
+
+def parse_steps(steps):
+    """Parse a `start:end` window of training steps.
+    :param steps: string or `None`
+    :return: tuple of ints or `None`"""
+    if steps is None:
+        return None
+    start, end = (int(s) for s in steps.split(":"))
+    if not 0 <= start < end:
+        raise ValueError("invalid step window {}".format(steps))
+    return start, end
+
+
+class StageProfiler(object):
+    """Wall time of the stages of every training step.
+
+    Stages are timed with `stage` and the wait for the next batch with
+    `loader`; on CUDA the device is synchronized at the end of every stage,
+    so asynchronous kernels are counted where they are launched. Every
+    epoch yields a report of the time per stage, the data loader wait and
+    the utilization of its workers, and all stages can be written as a
+    Chrome trace (chrome://tracing, Perfetto). A window of steps can also be
+    recorded with `torch.profiler`.
+
+    A disabled profiler records nothing and leaves loaders and datasets
+    untouched.
+    """
+
+    def __init__(self, enabled=False, device=None, out_dir=None, torch_steps=None):
+        """
+        :param enabled: if `False`, all methods are no-ops
+        :param device: device to synchronize before stages end
+        :param out_dir: directory of the traces
+        :param torch_steps: `(start, end)` window of global steps to record
+            with `torch.profiler`, see `parse_steps`
+        """
+        self.enabled = enabled
+        self.sync = enabled and device is not None and device.type == "cuda"
+        self.device = device
+        self.out_dir = out_dir
+        self.events = []
+        self.global_step = 0
+        self.step_in_epoch = 0
+        self.epoch = 0
+        self.load_time = 0.0
+        self.epoch_start = None
+        self.origin = time.perf_counter()
+
+        self.torch_profiler = None
+        if enabled and torch_steps is not None:
+            start, end = torch_steps
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.sync:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.torch_profiler = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(
+                    wait=max(start - 1, 0),
+                    warmup=min(start, 1),
+                    active=end - start,
+                    repeat=1,
+                ),
+                on_trace_ready=self._export_torch_trace,
+                record_shapes=True,
+                profile_memory=True,
+            )
+            self.torch_profiler.start()
+
+    def _export_torch_trace(self, profiler):
+        os.makedirs(self.out_dir, exist_ok=True)
+        profiler.export_chrome_trace(os.path.join(self.out_dir, "torch_trace.json"))
+
+    def _record(self, name, start):
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        self.events.append(
+            (name, start, time.perf_counter() - start, self.epoch, self.step_in_epoch)
+        )
+
+    @contextlib.contextmanager
+    def _stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(name, start)
+
+    def stage(self, name):
+        """Context manager timing a stage of the current step.
+        :param name: stage name
+        :return: context manager"""
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return self._stage(name)
+
+    def wrap_dataset(self, dataset):
+        """Time the loading of every sample, see `TimedDataset`.
+        :param dataset: dataset returning dict samples
+        :return: dataset"""
+        if not self.enabled:
+            return dataset
+        return TimedDataset(dataset)
+
+    def loader(self, batches):
+        """Time the wait for every batch as the `data` stage.
+        :param batches: iterable of batches, e.g. a data loader over a
+            dataset from `wrap_dataset`
+        :return: iterable of batches"""
+        if not self.enabled:
+            return batches
+        return self._timed_batches(batches)
+
+    def _timed_batches(self, batches):
+        iterator = iter(batches)
+        while True:
+            start = time.perf_counter()
+            batch = next(iterator, None)
+            if batch is None:
+                return
+            self._record("data", start)
+            # collated by `collate_samples` or the default collate
+            meta = getattr(batch, "meta", batch)
+            if isinstance(meta, dict) and LOAD_TIME in meta:
+                self.load_time += float(sum(meta.pop(LOAD_TIME)))
+            yield batch
+
+    def step(self):
+        """Mark the end of a training step."""
+        if not self.enabled:
+            return
+        self.global_step += 1
+        self.step_in_epoch += 1
+        if self.torch_profiler is not None:
+            self.torch_profiler.step()
+
+    def start_epoch(self, epoch):
+        if not self.enabled:
+            return
+        self.epoch = epoch
+        self.step_in_epoch = 0
+        self.load_time = 0.0
+        self.epoch_start = time.perf_counter()
+        self.first_event = len(self.events)
+
+    def end_epoch(self, num_workers=0, peak_memory=None):
+        """Summarize the stages of the epoch.
+        :param num_workers: number of DataLoader workers of the timed loader
+        :param peak_memory: peak memory of the epoch in MiB
+        :return: dict with the epoch time, steps, seconds per stage and share
+            of the epoch time, the data wait share and worker utilization,
+            or `None` if disabled"""
+        if not self.enabled:
+            return None
+        wall = time.perf_counter() - self.epoch_start
+        stages = {}
+        for name, _, duration, _, _ in self.events[self.first_event :]:
+            stages[name] = stages.get(name, 0.0) + duration
+        # samples are loaded in the main process without workers
+        capacity = wall * max(num_workers, 1)
+        return {
+            "epoch": self.epoch,
+            "time": wall,
+            "steps": self.step_in_epoch,
+            "stages": stages,
+            "shares": {name: t / wall for name, t in stages.items()},
+            "data_wait": stages.get("data", 0.0) / wall,
+            "worker_utilization": self.load_time / capacity,
+            "peak_memory": peak_memory,
+        }
+
+    def format_report(self, report):
+        """Render an epoch report as a table.
+        :param report: dict returned by `end_epoch`
+        :return: string"""
+        lines = [
+            "Epoch {:d} profile: {:.1f} s, {:d} steps, data wait {:.1%}, "
+            "worker utilization {:.1%}".format(
+                report["epoch"] + 1,
+                report["time"],
+                report["steps"],
+                report["data_wait"],
+                report["worker_utilization"],
+            )
+        ]
+        if report["peak_memory"] is not None:
+            lines[0] += ", peak memory {:.0f} MiB".format(report["peak_memory"])
+        steps = max(report["steps"], 1)
+        for name, total in sorted(report["stages"].items(), key=lambda s: -s[1]):
+            lines.append(
+                "  {:<12} {:>9.2f} s {:>9.2f} ms/step {:>7.1%}".format(
+                    name, total, 1000 * total / steps, report["shares"][name]
+                )
+            )
+        return "\n".join(lines)
+
+    def save_trace(self, path=None):
+        """Write all recorded stages as a Chrome trace.
+        :param path: path to the JSON file; `stage_trace.json` in `out_dir`
+            by default"""
+        if not self.enabled:
+            return
+        if path is None:
+            os.makedirs(self.out_dir, exist_ok=True)
+            path = os.path.join(self.out_dir, "stage_trace.json")
+        events = [
+            {
+                "name": name,
+                "ph": "X",
+                "ts": 1e6 * (start - self.origin),
+                "dur": 1e6 * duration,
+                "pid": os.getpid(),
+                "tid": 0,
+                "args": {"epoch": epoch, "step": step},
+            }
+            for name, start, duration, epoch, step in self.events
+        ]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def close(self):
+        """Stop `torch.profiler` and write the stage trace."""
+        if self.torch_profiler is not None:
+            self.torch_profiler.stop()
+            self.torch_profiler = None
+        self.save_trace()
@@ -0,0 +1,233 @@
+import os
+import torch
+from torch import optim
+
+import argparse
+
+from models.model_multitask import HEADS, MultiTaskModel, device
+from models.pruning import prune_model
+from profile_multitask import profile_model
+from train_multitask import train_model
+from mixed_precision import PRECISIONS, check_precision, keep_batchnorm_fp32
+from experiment_logging import LOGGERS
+from dataset_shmcache import CACHE_MODES
+
+
+def main():
+    # setup argument parser
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--checkpoint", type=str, required=True, help="Path to model checkpoint"
+    )
+    parser.add_argument(
+        "--amount",
+        type=float,
+        default=0.5,
+        help="Fraction of the channels to remove from every layer",
+    )
+    parser.add_argument(
+        "--round_to",
+        type=int,
+        default=8,
+        help="Keep a multiple of this many channels per layer",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="pruned.model",
+        help="Path to the pruned checkpoint before fine-tuning",
+    )
+    parser.add_argument("-ep", type=int, default=2, help="Number of fine-tuning epochs")
+    parser.add_argument("-bs", type=int, nargs="?", default=32, help="Batch size")
+    parser.add_argument(
+        "-lr", type=float, nargs="?", default=0.01, help="Learning rate"
+    )
+    parser.add_argument("-mo", type=float, nargs="?", default=0.7, help="Momentum")
+    parser.add_argument("-exp_name", type=str, default="", help="Name of experiment")
+    parser.add_argument(
+        "-channels", type=str, default="0,1,2,3,4,5,6,7,8,9,10,11", help="Channels"
+    )
+    parser.add_argument(
+        "--weight_segmentation",
+        type=float,
+        default=1.0,
+        help="Weight for segmentation loss",
+    )
+    parser.add_argument(
+        "--weight_regression",
+        type=float,
+        default=1.0,
+        help="Weight for regression loss",
+    )
+    parser.add_argument(
+        "--weight_classification",
+        type=float,
+        default=1.0,
+        help="Weight for classification loss",
+    )
+    parser.add_argument(
+        "--data_dir", type=str, default="data/images/", help="Path to data directory"
+    )
+    parser.add_argument(
+        "--seg_label_dir",
+        type=str,
+        default="data/segmentation_labels/",
+        help="Path to segmentation label directory",
+    )
+    parser.add_argument(
+        "--reg_file",
+        type=str,
+        default="labels.csv",
+        help="Path to regression data directory",
+    )
+    parser.add_argument(
+        "--checkpoint_dir",
+        type=str,
+        default="checkpoints/",
+        help="Path to fine-tuned model checkpoints",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default="cache",
+        help="Path to dataset cache directory",
+    )
+    parser.add_argument(
+        "--store_dir",
+        type=str,
+        default=None,
+        help="Path to materialized tile stores (see materialize_multitask.py)",
+    )
+    parser.add_argument(
+        "--tile_cache",
+        type=str,
+        default="none",
+        choices=CACHE_MODES,
+        help="Keep decoded tiles in shared memory, filled on first access (lazy) "
+        "or at startup (eager)",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=PRECISIONS,
+        help="Mixed precision mode (bf16 works on CPU, fp16 needs CUDA)",
+    )
+    parser.add_argument(
+        "--device_transforms",
+        action="store_true",
+        help="Normalize and randomize batches on the training device",
+    )
+    parser.add_argument(
+        "--heads",
+        type=str,
+        default="dense",
+        choices=HEADS,
+        help="Task heads of the checkpoint",
+    )
+    parser.add_argument(
+        "--width", type=float, default=1.0, help="Channel width multiplier"
+    )
+    parser.add_argument(
+        "--depth", type=int, default=4, help="Number of U-Net down/up stages"
+    )
+    parser.add_argument(
+        "--micro_bs",
+        type=int,
+        default=None,
+        help="Micro-batch size; gradients are accumulated up to the batch size",
+    )
+    parser.add_argument(
+        "--checkpoint_activations",
+        action="store_true",
+        help="Recompute U-Net activations in the backward pass to save memory",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the fine-tuning from its last checkpoint",
+    )
+    parser.add_argument(
+        "--keep_checkpoints",
+        type=int,
+        default=None,
+        help="Number of best checkpoints to keep per task; all by default",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Time the stages of every training step and write a trace",
+    )
+    parser.add_argument(
+        "--profile_steps",
+        type=str,
+        default=None,
+        help="start:end window of training steps to record with torch.profiler",
+    )
+    parser.add_argument(
+        "--logger",
+        type=str,
+        default="comet",
+        choices=LOGGERS,
+        help="Experiment logger; jsonl and sqlite write to "
+        "<checkpoint_dir>/<exp_name>/logs",
+    )
+    args = parser.parse_args()
+
+    channels = [int(c) for c in args.channels.split(",")]
+
+    check_precision(device, args.precision)
+    if args.keep_checkpoints is not None and args.keep_checkpoints < 1:
+        parser.error("--keep_checkpoints must be at least 1")
+
+    model = MultiTaskModel(
+        n_channels=len(channels),
+        n_classes=1,
+        heads=args.heads,
+        width=args.width,
+        depth=args.depth,
+    )
+    model.load_state_dict(torch.load(args.checkpoint, map_location=torch.device("cpu")))
+
+    before = profile_model(model, repeats=3)
+    prune_model(model, amount=args.amount, round_to=args.round_to)
+    after = profile_model(model, repeats=3)
+    print(
+        "pruned: params {:,d} -> {:,d}, GFLOPs {:.2f} -> {:.2f}, "
+        "CPU latency {:.1f} ms -> {:.1f} ms".format(
+            before["params"],
+            after["params"],
+            before["gflops"],
+            after["gflops"],
+            before["latency"],
+            after["latency"],
+        )
+    )
+
+    # pruned checkpoints load with `load_pruned_model`
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    torch.save(model.state_dict(), args.output)
+
+    model.checkpoint_activations = args.checkpoint_activations
+    if args.precision != "fp32":
+        keep_batchnorm_fp32(model)
+    model.to(device)
+
+    # fine-tune briefly; the best checkpoints are saved as in training
+    opt = optim.SGD(model.parameters(), lr=args.lr, momentum=args.mo)
+    train_model(
+        model,
+        args,
+        opt,
+        channels,
+        datadir=args.data_dir,
+        seglabeldir=args.seg_label_dir,
+        reg_file=args.reg_file,
+        checkpoint_dir=args.checkpoint_dir,
+        cache_dir=args.cache_dir,
+        store_dir=args.store_dir,
+    )
+
+
+if __name__ == "__main__":
+    main()
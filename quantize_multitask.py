@@ -0,0 +1,269 @@
+import io
+import os
+import copy
+import inspect
+import itertools
+import pandas as pd
+import torch
+from torch import nn
+from torch.quantization import get_default_qconfig, quantize_dynamic
+from torch.quantization.quantize_fx import convert_fx, prepare_fx
+from torch.utils.data import DataLoader
+
+import argparse
+
+from models.model_multitask import (
+    HEADS,
+    ConvRegression,
+    MulticlassClassification,
+    MultiTaskModel,
+    PooledClassification,
+    PooledRegression,
+)
+from models.pruning import load_pruned_model
+from dataset_multitask import create_dataset
+from eval_multitask import eval_model
+from export_multitask import latency
+
+QUANTIZATION_MODES = ["dynamic", "static"]
+
+cpu = torch.device("cpu")
+
+
+def quantize_heads(model):
+    """Quantize the weights of all linear layers to int8; activations are
+    quantized on the fly, so no calibration is needed. This only covers the
+    fully connected task heads.
+    :param model: float or statically quantized model
+    :return: quantized model"""
+    return quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def quantize_static(model, calibration_batches, qengine):
+    """Quantize weights and activations of the U-Net to int8 with FX graph
+    mode quantization, then quantize the task heads dynamically.
+
+    The heads stay float modules in the traced graph: they mix in the weather
+    data and run the regression in float32, so the U-Net output is
+    dequantized before them.
+    :param model: float model in eval mode on the CPU
+    :param calibration_batches: list of (image, weather) batches used to
+        observe activation ranges
+    :param qengine: quantized engine, `fbgemm` (x86) or `qnnpack` (ARM)
+    :return: quantized model"""
+    torch.backends.quantized.engine = qengine
+    qconfig_dict = {
+        "": get_default_qconfig(qengine),
+        "module_name": [("outr", None), ("outb", None)],
+    }
+    custom_config_dict = {
+        "non_traceable_module_class": [
+            ConvRegression,
+            MulticlassClassification,
+            PooledRegression,
+            PooledClassification,
+        ]
+    }
+
+    # newer torch versions need example inputs for tracing
+    kwargs = {}
+    parameters = inspect.signature(prepare_fx).parameters
+    if "example_inputs" in parameters:
+        kwargs["example_inputs"] = calibration_batches[0]
+        kwargs["prepare_custom_config"] = custom_config_dict
+    else:
+        kwargs["prepare_custom_config_dict"] = custom_config_dict
+
+    prepared = prepare_fx(copy.deepcopy(model), qconfig_dict, **kwargs)
+    with torch.no_grad():
+        for x, w in calibration_batches:
+            prepared(x, w)
+    return quantize_heads(convert_fx(prepared))
+
+
+def calibration_data(params, datadir, seglabeldir, reg_data, cache_dir=None):
+    """Draw calibration batches from the validation dataset, as used by
+    `eval_model`.
+    :return: list of (image, weather) batches"""
+    data_val = create_dataset(
+        datadir=datadir,
+        seglabeldir=os.path.join(seglabeldir, "validation/"),
+        reg_data=pd.read_csv(os.path.join(reg_data, "reg_co2_data.csv")),
+        mult=1,
+        cache_dir=cache_dir,
+        native=params.heads == "pooled",
+    )
+    # native tiles of different sizes cannot be batched; calibrating on
+    # single tiles avoids that
+    bs = 1 if data_val.native else params.bs
+    dl = DataLoader(data_val, batch_size=bs, shuffle=True)
+    return [
+        (batch["img"].float(), batch["weather"].float())
+        for batch in itertools.islice(dl, params.calibration_batches)
+    ]
+
+
+def model_size(model):
+    """Size of the serialized state dict.
+    :return: bytes"""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+
+def main():
+    # setup argument parser
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-bs", type=int, nargs="?", default=32, help="Batch size")
+    parser.add_argument(
+        "--checkpoint", type=str, required=True, help="Path to model checkpoint"
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="model_int8.pt",
+        help="Path to the quantized TorchScript model",
+    )
+    parser.add_argument(
+        "--mode",
+        type=str,
+        default="static",
+        choices=QUANTIZATION_MODES,
+        help="static quantizes the U-Net and the heads, dynamic only the heads",
+    )
+    parser.add_argument(
+        "--qengine",
+        type=str,
+        default="fbgemm",
+        choices=["fbgemm", "qnnpack"],
+        help="Quantized engine (fbgemm for x86, qnnpack for ARM)",
+    )
+    parser.add_argument(
+        "--calibration_batches",
+        type=int,
+        default=10,
+        help="Number of validation batches for static calibration",
+    )
+    parser.add_argument(
+        "--heads",
+        type=str,
+        default="dense",
+        choices=HEADS,
+        help="Task heads of the checkpoint",
+    )
+    parser.add_argument(
+        "--width", type=float, default=1.0, help="Channel width multiplier"
+    )
+    parser.add_argument(
+        "--depth", type=int, default=4, help="Number of U-Net down/up stages"
+    )
+    parser.add_argument(
+        "--pruned",
+        action="store_true",
+        help="Checkpoint written by prune_multitask.py; shapes are read from it",
+    )
+    parser.add_argument(
+        "--weight_segmentation",
+        type=float,
+        default=1.0,
+        help="Weight for segmentation loss",
+    )
+    parser.add_argument(
+        "--weight_regression",
+        type=float,
+        default=1.0,
+        help="Weight for regression loss",
+    )
+    parser.add_argument(
+        "--weight_classification",
+        type=float,
+        default=1.0,
+        help="Weight for classification loss",
+    )
+    parser.add_argument(
+        "--data_dir", type=str, default="", help="Path to data directory"
+    )
+    parser.add_argument(
+        "--seg_label_dir",
+        type=str,
+        default="",
+        help="Path to segmentation label directory",
+    )
+    parser.add_argument(
+        "--reg_data", type=str, default="", help="Path to regression data directory"
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default="cache",
+        help="Path to dataset cache directory",
+    )
+    # quantized models run on the CPU in float32 from raw dataset samples
+    parser.set_defaults(precision="fp32", device_transforms=False)
+    args = parser.parse_args()
+
+    state_dict = torch.load(args.checkpoint, map_location=torch.device("cpu"))
+    if args.pruned:
+        model = load_pruned_model(state_dict)
+    else:
+        model = MultiTaskModel(
+            n_channels=12,
+            n_classes=1,
+            heads=args.heads,
+            width=args.width,
+            depth=args.depth,
+        )
+        model.load_state_dict(state_dict)
+    model.eval()
+
+    data_kwargs = dict(
+        datadir=args.data_dir,
+        seglabeldir=args.seg_label_dir,
+        reg_data=args.reg_data,
+        cache_dir=args.cache_dir,
+    )
+    batches = calibration_data(args, **data_kwargs)
+
+    if args.mode == "static":
+        qmodel = quantize_static(model, batches, args.qengine)
+    else:
+        torch.backends.quantized.engine = args.qengine
+        qmodel = quantize_heads(model)
+    qmodel.eval()
+
+    print("float32 model:")
+    float_metrics = eval_model(model, args, device=cpu, **data_kwargs)
+    print("int8 model ({}):".format(args.mode))
+    int8_metrics = eval_model(qmodel, args, device=cpu, **data_kwargs)
+
+    x, w = batches[0]
+    float_latency, int8_latency = latency(model, x, w), latency(qmodel, x, w)
+    float_size, int8_size = model_size(model), model_size(qmodel)
+
+    print(
+        (
+            "drift: iou {:+.4f}, classification acc {:+.4f}, generation mae {:+.3f}\n"
+            "latency for batch size {}: {:.1f} ms -> {:.1f} ms ({:.2f}x)\n"
+            "size: {:.1f} MB -> {:.1f} MB ({:.2f}x)"
+        ).format(
+            int8_metrics["iou"] - float_metrics["iou"],
+            int8_metrics["bin_acc"] - float_metrics["bin_acc"],
+            int8_metrics["mae"] - float_metrics["mae"],
+            len(x),
+            1000 * float_latency,
+            1000 * int8_latency,
+            float_latency / int8_latency,
+            float_size / 2**20,
+            int8_size / 2**20,
+            float_size / int8_size,
+        )
+    )
+
+    # TorchScript keeps the quantized graph loadable with `torch.jit.load`
+    with torch.no_grad():
+        torch.jit.save(torch.jit.trace(qmodel, (x, w)), args.output)
+    print("saved quantized model to", args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+import os
+import numpy as np
+import rasterio as rio
+from rasterio.windows import Window
+import torch
+from tqdm.autonotebook import tqdm
+
+import argparse
+
+from models.model_multitask import HEADS, MultiTaskModel, device
+from models.pruning import load_pruned_model
+from models.model_onnx import BACKENDS, OnnxMultiTaskModel
+from dataset_multitask import BatchNormalize
+from dataset_reader import BANDS, as_dtype
+from mixed_precision import PRECISIONS, autocast, check_precision, keep_batchnorm_fp32
+
+print("running on...", device)
+
+
+def window_offsets(length, size, stride):
+    """Start offsets of windows covering a raster dimension; the last window
+    is aligned to the end, so it may overlap its neighbour more.
+    :param length: raster height or width
+    :param size: window side length
+    :param stride: distance between windows
+    :return: sorted list of offsets"""
+    if length <= size:
+        return [0]
+    offsets = list(range(0, length - size + 1, stride))
+    if offsets[-1] != length - size:
+        offsets.append(length - size)
+    return offsets
+
+
+def blend_weights(size, overlap):
+    """Weights of the pixels of a window when blending overlapping windows;
+    they ramp up linearly over the overlap, so window borders contribute
+    least.
+    :param size: window side length
+    :param overlap: overlap of neighbouring windows in pixels
+    :return: float32 array (size, size)"""
+    ramp = np.minimum(np.arange(size) + 1, np.arange(size)[::-1] + 1)
+    ramp = np.minimum(ramp, overlap + 1).astype(np.float32)
+    return np.outer(ramp, ramp)
+
+
+class SceneScan(object):
+    """Cut a scene into overlapping windows and assemble the segmentation
+    logits of these windows into a plume probability GeoTIFF.
+
+    The scene is read one strip of window rows at a time. Blended logits are
+    accumulated in a buffer of one window height; as soon as all windows of
+    a window row are added, the rows no later window covers are converted to
+    probabilities and written out, so memory stays bounded by the scene
+    width.
+    """
+
+    def __init__(self, path, out_path, channels, size, overlap):
+        """
+        :param path: path to the scene GeoTIFF
+        :param out_path: path to the probability GeoTIFF to write
+        :param channels: list of channels indices
+        :param size: window side length
+        :param overlap: overlap of neighbouring windows in pixels
+        """
+        self.indexes = [BANDS[c] for c in channels]
+        self.size = size
+        self.weights = blend_weights(size, overlap)
+
+        self.src = rio.open(path)
+        self.height, self.width = self.src.height, self.src.width
+        self.rows = window_offsets(self.height, size, size - overlap)
+        self.cols = window_offsets(self.width, size, size - overlap)
+
+        # scenes smaller than a window are padded
+        buffer_shape = (size, max(self.width, size))
+        self.logit_sum = np.zeros(buffer_shape, dtype=np.float32)
+        self.weight_sum = np.zeros(buffer_shape, dtype=np.float32)
+        # first scene row not yet written
+        self.top = 0
+
+        profile = self.src.profile.copy()
+        for key in ["blockxsize", "blockysize", "tiled", "photometric"]:
+            profile.pop(key, None)
+        profile.update(
+            driver="GTiff", count=1, dtype="float32", nodata=None, compress="deflate"
+        )
+        self.dst = rio.open(out_path, "w", **profile)
+
+    def read_strip(self, row):
+        """Read all bands of one window row.
+        :param row: row offset
+        :return: uint16 array (channels, size, padded width)"""
+        n_rows = min(self.size, self.height - row)
+        strip = self.src.read(self.indexes, window=Window(0, row, self.width, n_rows))
+        pad_rows = self.size - n_rows
+        pad_cols = self.logit_sum.shape[1] - self.width
+        if pad_rows > 0 or pad_cols > 0:
+            strip = np.pad(strip, ((0, 0), (0, pad_rows), (0, pad_cols)), mode="edge")
+        return as_dtype(strip, np.uint16)
+
+    def windows(self):
+        """Iterate over all windows, row by row.
+        :return: generator of (window row, column offset, uint16 tile)"""
+        for k, row in enumerate(self.rows):
+            strip = self.read_strip(row)
+            for col in self.cols:
+                yield k, col, strip[:, :, col : col + self.size]
+
+    def add(self, k, col, logits):
+        """Blend the segmentation logits of a window into the scene; windows
+        have to be added in the order `windows` yields them.
+        :param k: window row
+        :param col: column offset
+        :param logits: float32 array (size, size)"""
+        self.logit_sum[:, col : col + self.size] += logits * self.weights
+        self.weight_sum[:, col : col + self.size] += self.weights
+        if col == self.cols[-1]:
+            self.finish_row(k)
+
+    def finish_row(self, k):
+        # rows above the next window row are final
+        if k + 1 < len(self.rows):
+            end = self.rows[k + 1]
+        else:
+            end = self.height
+        n_rows = end - self.top
+
+        logits = (
+            self.logit_sum[:n_rows, : self.width]
+            / self.weight_sum[:n_rows, : self.width]
+        )
+        probs = torch.sigmoid(torch.from_numpy(logits)).numpy()
+        self.dst.write(
+            probs[np.newaxis], window=Window(0, self.top, self.width, n_rows)
+        )
+
+        self.logit_sum[:-n_rows] = self.logit_sum[n_rows:]
+        self.logit_sum[-n_rows:] = 0
+        self.weight_sum[:-n_rows] = self.weight_sum[n_rows:]
+        self.weight_sum[-n_rows:] = 0
+        self.top = end
+
+        if k + 1 == len(self.rows):
+            self.close()
+
+    def close(self):
+        self.src.close()
+        self.dst.close()
+
+
+def scan_scenes(model, params, scenes, output_dir, channels):
+    """Write a plume probability map for every scene.
+
+    Windows are batched across scene boundaries, so small scenes do not
+    leave batches half empty.
+    :param model: model instance
+    :param params: parameters
+    :param scenes: list of paths to scene GeoTIFFs
+    :param output_dir: path to write `<scene>_plume.tif` files to
+    :param channels: list of channels indices
+    :return: list of written paths"""
+    os.makedirs(output_dir, exist_ok=True)
+    normalize = BatchNormalize(np.array(channels)).normalize
+
+    model.eval()
+
+    def run(batch):
+        x = np.stack([tile for _, _, _, tile in batch]).view(np.int16)
+        x = normalize(torch.from_numpy(x).to(device))
+        # weather only enters the regression head
+        w = torch.zeros((len(batch), 1, 4), device=device)
+        with torch.no_grad(), autocast(device, params.precision):
+            output, _, _ = model(x, w)
+        logits = output[:, 0].float().cpu().numpy()
+        for (scan, k, col, _), window_logits in zip(batch, logits):
+            scan.add(k, col, window_logits)
+
+    batch, out_paths = [], []
+    for path in tqdm(scenes, desc="Scanning scenes"):
+        out_path = os.path.join(
+            output_dir, os.path.splitext(os.path.basename(path))[0] + "_plume.tif"
+        )
+        scan = SceneScan(path, out_path, channels, params.window, params.overlap)
+        for k, col, tile in scan.windows():
+            batch.append((scan, k, col, tile))
+            if len(batch) == params.bs:
+                run(batch)
+                batch = []
+        out_paths.append(out_path)
+    if len(batch) > 0:
+        run(batch)
+
+    return out_paths
+
+
+def main():
+    # setup argument parser
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenes", type=str, nargs="+", help="Scene GeoTIFF files")
+    parser.add_argument("-bs", type=int, nargs="?", default=32, help="Batch size")
+    parser.add_argument(
+        "-channels", type=str, default="0,1,2,3,4,5,6,7,8,9,10,11", help="Channels"
+    )
+    parser.add_argument(
+        "--checkpoint", type=str, required=True, help="Path to model checkpoint"
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        default="plume_maps",
+        help="Path to write plume probability maps to",
+    )
+    parser.add_argument(
+        "--window", type=int, default=120, help="Window side length in pixels"
+    )
+    parser.add_argument(
+        "--overlap",
+        type=int,
+        default=30,
+        help="Overlap of neighbouring windows in pixels",
+    )
+    parser.add_argument(
+        "--heads",
+        type=str,
+        default="dense",
+        choices=HEADS,
+        help="Task heads of the checkpoint; dense heads need 120 pixel windows",
+    )
+    parser.add_argument(
+        "--width", type=float, default=1.0, help="Channel width multiplier"
+    )
+    parser.add_argument(
+        "--depth", type=int, default=4, help="Number of U-Net down/up stages"
+    )
+    parser.add_argument(
+        "--pruned",
+        action="store_true",
+        help="Checkpoint written by prune_multitask.py; shapes are read from it",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=PRECISIONS,
+        help="Mixed precision mode (bf16 works on CPU, fp16 needs CUDA)",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="torch",
+        choices=BACKENDS,
+        help="Inference backend; onnx takes a file from export_multitask.py",
+    )
+    args = parser.parse_args()
+
+    if args.heads == "dense" and args.window != 120:
+        parser.error("dense heads need --window 120, use pooled heads")
+    if not 0 <= args.overlap < args.window:
+        parser.error("--overlap must be smaller than --window")
+
+    channels = [int(c) for c in args.channels.split(",")]
+
+    check_precision(device, args.precision)
+    if args.backend == "onnx" and args.precision != "fp32":
+        parser.error("the onnx backend runs in fp32")
+
+    if args.backend == "onnx":
+        model = OnnxMultiTaskModel(args.checkpoint)
+        if model.size != args.window:
+            parser.error(
+                "the onnx model was exported for --window {}".format(model.size)
+            )
+    else:
+        state_dict = torch.load(args.checkpoint, map_location=torch.device("cpu"))
+        if args.pruned:
+            model = load_pruned_model(state_dict)
+        else:
+            model = MultiTaskModel(
+                n_channels=len(channels),
+                n_classes=1,
+                heads=args.heads,
+                width=args.width,
+                depth=args.depth,
+            )
+            model.load_state_dict(state_dict)
+        if args.precision != "fp32":
+            keep_batchnorm_fp32(model)
+        model.to(device)
+
+    scan_scenes(model, args, args.scenes, args.output_dir, channels)
+
+
+if __name__ == "__main__":
+    main()
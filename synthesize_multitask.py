@@ -0,0 +1,181 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import rasterio as rio
+from rasterio.transform import from_origin
+
+import argparse
+
+from dataset_multitask import channels_means, channels_stds
+from dataset_manifest import fuel_type_dict, weather_columns
+from dataset_reader import BANDS
+
+# split directories below the image and label directories, with tile sizes
+SPLITS = {
+    "training/120x120": 120,
+    "training/300x300": 300,
+    "validation": 120,
+}
+
+
+def synthetic_polygon(rng, size):
+    """Random plume outline in the percent coordinates of Label Studio; the
+    plumes of 300x300 tiles fall inside or outside the centre crop.
+    :param rng: numpy random generator
+    :param size: side length of the tile
+    :return: list of [x, y] points"""
+    spread = 40 if size == 300 else 20
+    centre = rng.uniform(50 - spread, 50 + spread, size=2)
+    n_points = rng.integers(5, 12)
+    angles = np.sort(rng.uniform(0, 2 * np.pi, n_points))
+    radii = rng.uniform(3, 12, n_points)
+    points = centre + np.stack([np.cos(angles), np.sin(angles)], axis=1) * radii[
+        :, None
+    ]
+    return np.clip(points, 0, 100).round(3).tolist()
+
+
+def write_tile(path, rng, size, polygons):
+    """Write a 13-band uint16 GeoTIFF with pixel statistics like the real
+    tiles; pixels inside the plumes are brightened.
+    :param path: path to the GeoTIFF
+    :param rng: numpy random generator
+    :param size: side length of the tile
+    :param polygons: plume outlines in percent coordinates"""
+    n_bands = max(BANDS)
+    means = np.zeros(n_bands)
+    stds = np.ones(n_bands)
+    means[np.array(BANDS) - 1] = channels_means
+    stds[np.array(BANDS) - 1] = channels_stds
+    imgdata = rng.normal(
+        means[:, None, None], stds[:, None, None] / 4, (n_bands, size, size)
+    )
+
+    yy, xx = np.mgrid[0:size, 0:size] * 100 / size
+    for pol in polygons:
+        # bounding box of the plume is close enough for benchmarks
+        pol = np.array(pol)
+        inside = (
+            (xx >= pol[:, 0].min())
+            & (xx <= pol[:, 0].max())
+            & (yy >= pol[:, 1].min())
+            & (yy <= pol[:, 1].max())
+        )
+        imgdata[:, inside] += stds[:, None]
+
+    imgdata = np.clip(np.rint(imgdata), 0, np.iinfo(np.uint16).max).astype(np.uint16)
+    with rio.open(
+        path,
+        "w",
+        driver="GTiff",
+        height=size,
+        width=size,
+        count=n_bands,
+        dtype="uint16",
+        transform=from_origin(0, 0, 10, 10),
+    ) as dst:
+        dst.write(imgdata)
+
+
+def write_seglabel(path, task_id, filename, polygons):
+    """Write a Label Studio annotation in the exported JSON layout.
+    :param path: path to the JSON file
+    :param task_id: Label Studio task id, prefixed to the image name
+    :param filename: GeoTIFF file name
+    :param polygons: plume outlines in percent coordinates"""
+    segdata = {
+        "id": task_id,
+        "data": {"image": "{}-{}".format(task_id, filename.replace(".tif", ".png"))},
+        "completions": [
+            {
+                "result": [
+                    {
+                        "type": "polygonlabels",
+                        "value": {"points": points, "polygonlabels": ["plume"]},
+                    }
+                    for points in polygons
+                ]
+            }
+        ],
+    }
+    with open(path, "w") as f:
+        json.dump(segdata, f)
+
+
+def synthesize(out_dir, n_samples=16, seed=0):
+    """Write a synthetic dataset in the layout `train_multitask.py` reads:
+    `images/<split>/{positive,negative}/*.tif`, Label Studio JSON files in
+    `segmentation_labels/<split>/` and the regression table `labels.csv`.
+    :param out_dir: output directory
+    :param n_samples: number of positive and of negative tiles per split
+    :param seed: random seed
+    :return: dict with the image directory, label directory and table path"""
+    rng = np.random.default_rng(seed)
+    datadir = os.path.join(out_dir, "images")
+    seglabeldir = os.path.join(out_dir, "segmentation_labels")
+    fuel_types = sorted(fuel_type_dict)
+
+    rows = []
+    task_id = 0
+    for split, size in SPLITS.items():
+        os.makedirs(os.path.join(seglabeldir, split), exist_ok=True)
+        for label in ["positive", "negative"]:
+            os.makedirs(os.path.join(datadir, split, label), exist_ok=True)
+            for i in range(n_samples):
+                filename = "{}_{}_{:04d}.tif".format(
+                    split.replace("/", "_"), label, i
+                )
+                polygons = []
+                if label == "positive":
+                    polygons = [
+                        synthetic_polygon(rng, size)
+                        for _ in range(rng.integers(1, 4))
+                    ]
+                    task_id += 1
+                    write_seglabel(
+                        os.path.join(seglabeldir, split, "{}.json".format(task_id)),
+                        task_id,
+                        filename,
+                        polygons,
+                    )
+                write_tile(
+                    os.path.join(datadir, split, label, filename), rng, size, polygons
+                )
+                row = {
+                    "filename": filename,
+                    "gen_output": rng.uniform(0, 2000) if label == "positive" else 0.0,
+                    "fuel_type": fuel_types[rng.integers(len(fuel_types))],
+                }
+                row.update(zip(weather_columns, rng.normal(size=len(weather_columns))))
+                rows.append(row)
+
+    reg_file = os.path.join(out_dir, "labels.csv")
+    pd.DataFrame(rows).to_csv(reg_file, index=False)
+    return {"datadir": datadir, "seglabeldir": seglabeldir, "reg_file": reg_file}
+
+
+def main():
+    # setup argument parser
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--out_dir", type=str, default="data/synthetic", help="Output directory"
+    )
+    parser.add_argument(
+        "--n_samples",
+        type=int,
+        default=16,
+        help="Number of positive and of negative tiles per split",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    paths = synthesize(args.out_dir, n_samples=args.n_samples, seed=args.seed)
+    print(
+        "wrote --data_dir {datadir} --seg_label_dir {seglabeldir} "
+        "--reg_file {reg_file}".format(**paths)
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,123 @@
-from comet_ml import Experiment
 import os
+import contextlib
+import resource
 import numpy as np
 import pandas as pd
 import torch
 from torch import nn, optim
+import torch.distributed as dist
+import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel
 from tqdm.autonotebook import tqdm
-from torch.utils.data import DataLoader, ConcatDataset, RandomSampler
+from torch.utils.data import (
+    DataLoader,
+    ConcatDataset,
+    RandomSampler,
+    SequentialSampler,
+)
 
 import argparse
-from sklearn.metrics import jaccard_score
 
 from models.model_multitask import *
-from dataset_multitask import create_dataset
+from dataset_multitask import (
+    BucketBatchSampler,
+    create_batch_transform,
+    create_dataset,
+    tile_sizes,
+)
+from checkpointing import LAST_CHECKPOINT, CheckpointManager, load_checkpoint
+from experiment_logging import LOGGERS, create_logger
+from dataset_collate import DevicePrefetcher, collate_samples
+from dataset_shmcache import CACHE_MODES, attach_tile_cache
+from distributed import (
+    DIST_BACKENDS,
+    DistributedRandomSampler,
+    DistributedShardSampler,
+    convert_sync_batchnorm,
+    even_batches,
+    init_distributed,
+    is_distributed,
+    is_main_process,
+)
+from metrics_multitask import MultiTaskMetrics
+from profiling import StageProfiler, parse_steps
+from mixed_precision import (
+    PRECISIONS,
+    autocast,
+    check_precision,
+    grad_scaler,
+    keep_batchnorm_fp32,
+)
 
 print("running on...", device)
 
+# update the progress bar every this many steps; reading the running loss
+# forces a device sync
+PROGRESS_INTERVAL = 10
 
-def multi_acc(y_pred, y_test):
-    y_pred_softmax = torch.log_softmax(y_pred, dim=1)
-    _, y_pred_tags = torch.max(y_pred_softmax, dim=1)
 
-    correct_pred = (y_pred_tags == y_test).float()
-    acc = correct_pred.sum() / len(correct_pred)
+def distillation_loss(outputs, teacher_outputs, params):
+    """Loss of a student model matching a teacher on all three tasks.
+
+    Segmentation and classification logits are softened with the
+    temperature and the losses rescaled by its square, so gradients keep
+    their magnitude; the generation estimate is matched directly.
+    :param outputs: student segmentation, regression and classification outputs
+    :param teacher_outputs: teacher outputs
+    :param params: parameters
+    :return: weighted distillation loss"""
+    seg_output, reg_output, cls_output = outputs
+    seg_teacher, reg_teacher, cls_teacher = (o.float() for o in teacher_outputs)
+    temperature = params.distill_temperature
+
+    loss_image = F.binary_cross_entropy_with_logits(
+        seg_output / temperature, torch.sigmoid(seg_teacher / temperature)
+    )
+    loss_gen = F.l1_loss(reg_output, reg_teacher)
+    loss_bin = F.kl_div(
+        F.log_softmax(cls_output / temperature, dim=1),
+        F.softmax(cls_teacher / temperature, dim=1),
+        reduction="batchmean",
+    )
+
+    return (
+        params.weight_segmentation * loss_image * temperature**2
+        + params.weight_regression * loss_gen
+        + params.weight_classification * loss_bin * temperature**2
+    )
+
+
+def reset_peak_memory(device):
+    """Start measuring the peak memory of a device anew; the peak resident
+    memory of the process on the CPU cannot be reset."""
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
 
-    return acc
+
+def peak_memory(device):
+    """Peak memory allocated by tensors on a CUDA device since the last
+    `reset_peak_memory`, or the peak resident memory of the process.
+    :param device: torch device
+    :return: MiB"""
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
 
 
 def train_model(
-    model, params, opt, channels, datadir, seglabeldir, reg_file, checkpoint_dir
+    model,
+    params,
+    opt,
+    channels,
+    datadir,
+    seglabeldir,
+    reg_file,
+    checkpoint_dir,
+    cache_dir=None,
+    store_dir=None,
+    teacher=None,
+    device=device,
 ):
     """Wrapper function for model training.
     :param model: model instance
@@ -37,27 +127,59 @@ def train_model(
     :param datadir: path to satellite images
     :param seglabeldir: path to segmentation labels
     :param reg_file: path to csv file for regression
-    :param checkpoint_dir: path to model checkpoints"""
+    :param checkpoint_dir: path to model checkpoints
+    :param cache_dir: path to cached dataset manifests
+    :param store_dir: path to materialized tile stores; if given, samples are
+        served from the stores instead of the GeoTIFF files
+    :param teacher: trained model to distill into `model`; the loss is then
+        blended with `distillation_loss` by `params.distill_alpha`
+    :param device: device of the model; in distributed runs the model is
+        wrapped in `DistributedDataParallel`, every rank trains on its shard
+        of the samples and only rank 0 saves checkpoints and logs"""
+
+    # unwrapped model for evaluation and checkpoints
+    distributed = isinstance(model, DistributedDataParallel)
+    net = model.module if distributed else model
+    main_process = is_main_process()
 
     exp_out_dir = os.path.join(checkpoint_dir, params.exp_name)
 
-    os.makedirs(os.path.join(exp_out_dir, "regression_checkpoints"), exist_ok=True)
-    os.makedirs(os.path.join(exp_out_dir, "segmentation_checkpoints"), exist_ok=True)
-    os.makedirs(os.path.join(exp_out_dir, "classification_checkpoints"), exist_ok=True)
-
-    comet_api_key = os.environ.get("COMET_API_KEY")
-    comet_project_name = os.environ.get("COMET_PROJECT_NAME")
-    comet_workspace = os.environ.get("COMET_WORKSPACE")
-    experiment = Experiment(
-        api_key=comet_api_key,
-        project_name=comet_project_name,
-        workspace=comet_workspace,
+    # opt-in timing of the training steps of rank 0
+    profiler = StageProfiler(
+        params.profile and main_process,
+        device,
+        out_dir=os.path.join(exp_out_dir, "profile"),
+        torch_steps=parse_steps(params.profile_steps),
     )
-    experiment.set_name(params.exp_name)
-    experiment.log_parameters(params)
+
+    if main_process:
+        # checkpoints are written in the background while training continues
+        checkpoints = CheckpointManager(
+            exp_out_dir,
+            "ep{:0d}_lr{:.0e}_bs{:02d}_mo{:.1f}_".format(
+                params.ep, params.lr, params.bs, params.mo
+            )
+            + "{:03d}.model",
+            keep=params.keep_checkpoints,
+        )
+
+        # logs are written in the background; comet_ml is only imported if
+        # selected
+        experiment = create_logger(params.logger, os.path.join(exp_out_dir, "logs"))
+        experiment.set_name(params.exp_name)
+        experiment.log_parameters(params)
 
     reg_data = pd.read_csv(reg_file)
 
+    # batches are split into micro-batches of this size to bound memory,
+    # the optimizer still steps once per batch
+    micro_bs = params.micro_bs or params.bs
+    if micro_bs > params.bs:
+        raise ValueError("micro batch size must not exceed the batch size")
+
+    # pooled heads take tiles at their native resolution
+    native = params.heads == "pooled"
+
     # create dataset
     data_train_120x120 = create_dataset(
         datadir=os.path.join(datadir, "training/120x120/"),
@@ -66,6 +188,10 @@ def train_model(
         mult=4,
         train=True,
         channels=channels,
+        cache_dir=cache_dir,
+        device_transforms=params.device_transforms,
+        store_dir=store_dir and os.path.join(store_dir, "training_120x120"),
+        native=native,
     )
 
     data_train_300x300 = create_dataset(
@@ -76,6 +202,10 @@ def train_model(
         train=True,
         channels=channels,
         size=300,
+        cache_dir=cache_dir,
+        device_transforms=params.device_transforms,
+        store_dir=store_dir and os.path.join(store_dir, "training_300x300"),
+        native=native,
     )
 
     data_val = create_dataset(
@@ -84,25 +214,84 @@ def train_model(
         reg_data=reg_data,
         mult=1,
         channels=channels,
+        cache_dir=cache_dir,
+        device_transforms=params.device_transforms,
+        store_dir=store_dir and os.path.join(store_dir, "validation"),
+        native=native,
     )
 
+    if params.tile_cache != "none" and store_dir is None:
+        # one copy of the decoded tiles shared by all workers and datasets
+        tile_cache = attach_tile_cache(
+            [data_train_120x120, data_train_300x300, data_val],
+            eager=params.tile_cache == "eager",
+        )
+        if main_process:
+            print("tile cache: {:.0f} MiB".format(tile_cache.nbytes / 2**20))
+
     data_train = ConcatDataset([data_train_120x120, data_train_300x300])
 
-    # draw random subsamples
-    train_sampler = RandomSampler(
-        data_train, replacement=True, num_samples=int(2 * len(data_train) / 3)
-    )
+    # draw random subsamples; in distributed runs every rank draws its share
+    if distributed:
+        train_sampler = DistributedRandomSampler(
+            data_train, num_samples=int(2 * len(data_train) / 3)
+        )
+        # unpadded, so summed validation metrics do not depend on world size
+        val_sampler = DistributedShardSampler(data_val)
+    else:
+        train_sampler = RandomSampler(
+            data_train, replacement=True, num_samples=int(2 * len(data_train) / 3)
+        )
+        val_sampler = SequentialSampler(data_val)
+
+    # initialize data loaders; pinned batches go to the device without
+    # another host copy, see `DevicePrefetcher`
+    if native:
+        # tiles of different sizes cannot be stacked, so batch them by size
+        train_dl = DataLoader(
+            profiler.wrap_dataset(data_train),
+            num_workers=6,
+            # incomplete buckets may hold a single sample, which BatchNorm1d
+            # rejects in training
+            batch_sampler=BucketBatchSampler(
+                train_sampler, params.bs, tile_sizes(data_train), drop_last=True
+            ),
+            collate_fn=collate_samples,
+            pin_memory=device.type == "cuda",
+        )
+        val_dl = DataLoader(
+            data_val,
+            batch_sampler=BucketBatchSampler(
+                val_sampler, micro_bs, tile_sizes(data_val)
+            ),
+            collate_fn=collate_samples,
+            pin_memory=device.type == "cuda",
+        )
+    else:
+        train_dl = DataLoader(
+            profiler.wrap_dataset(data_train),
+            batch_size=params.bs,
+            num_workers=6,
+            sampler=train_sampler,
+            collate_fn=collate_samples,
+            # a trailing batch of one sample would fail in BatchNorm1d
+            drop_last=True,
+            pin_memory=device.type == "cuda",
+        )
 
-    # initialize data loaders
-    train_dl = DataLoader(
-        data_train,
-        batch_size=params.bs,
-        num_workers=6,
-        pin_memory=True,
-        sampler=train_sampler,
-    )
+        val_dl = DataLoader(
+            data_val,
+            batch_size=micro_bs,
+            sampler=val_sampler,
+            collate_fn=collate_samples,
+            pin_memory=device.type == "cuda",
+        )
 
-    val_dl = DataLoader(data_val, batch_size=params.bs)
+    # normalize and randomize on the device if the datasets ship raw tiles
+    train_transform, val_transform = None, None
+    if params.device_transforms:
+        train_transform = create_batch_transform(channels, train=True)
+        val_transform = create_batch_transform(channels)
 
     best_mse, best_val_iou, best_val_acc = np.inf, 0.0, 0.0
 
@@ -111,41 +300,34 @@ def train_model(
     loss_c = nn.CrossEntropyLoss()  # classification loss
     loss_s = nn.BCEWithLogitsLoss()  # segmentation loss
 
-    for epoch in range(params.ep):
-
-        model.train()
-
-        train_loss_total, train_bin_acc_total = 0, 0
-        train_ious = []
-        train_image_loss_total, train_gen_loss_total, train_bin_loss_total = 0, 0, 0
-
-        progress = tqdm(enumerate(train_dl), desc="Train Loss: ", total=len(train_dl))
-        for i, batch in progress:
-            x = batch["img"].float().to(device)
-            w = batch["weather"].float().to(device)
-            y = batch["fpt"].float().to(device)
-            e = batch["gen_output"].float().to(device)
-            t = batch["type"].long().to(device)
-
-            seg_output, reg_output, cls_output = model(x, w)
-
-            output_binary = np.zeros(seg_output.shape)
-            output_binary[seg_output.cpu().detach().numpy() >= 0] = 1
-
-            # derive IoU values
-            for j in range(y.shape[0]):
-                z = jaccard_score(
-                    y[j].flatten().cpu().detach().numpy(), output_binary[j][0].flatten()
-                )
-                if (
-                    np.sum(output_binary[j][0]) != 0
-                    and np.sum(y[j].cpu().detach().numpy()) != 0
-                ):
-                    train_ious.append(z)
-
-            # classification accuracy
-            bin_acc = multi_acc(cls_output, t)
-            train_bin_acc_total += bin_acc
+    # mixed precision: losses are computed from float32 outputs, float16
+    # needs loss scaling
+    scaler = grad_scaler(device, params.precision)
+
+    # metrics are accumulated on the device and only synced per epoch
+    loss_names = ["loss", "image_loss", "gen_loss", "bin_loss"]
+    train_loss_names = loss_names + (["distill_loss"] if teacher is not None else [])
+    train_metrics = MultiTaskMetrics(device, loss_names=train_loss_names)
+
+    if teacher is not None:
+        teacher.eval()
+    val_metrics = MultiTaskMetrics(device, loss_names=loss_names)
+
+    def train_step(batch):
+        """Forward pass and metrics of one (micro-)batch on the device.
+        :return: weighted loss"""
+        with profiler.stage("transform"):
+            if train_transform is not None:
+                x, y = train_transform(batch.img, batch.fpt)
+            else:
+                x, y = batch.img, batch.fpt.float()
+            w, e, t = batch.weather, batch.gen_output, batch.type
+
+        with profiler.stage("forward"):
+            with autocast(device, params.precision):
+                seg_output, reg_output, cls_output = model(x, w)
+            seg_output, reg_output = seg_output.float(), reg_output.float()
+            cls_output = cls_output.float()
 
             # derive loss
             loss_image = loss_s(seg_output, y.unsqueeze(dim=1))
@@ -158,44 +340,133 @@ def train_model(
                 + params.weight_classification * loss_bin
             )
 
-            train_image_loss_total += loss_image.item()
-            train_gen_loss_total += loss_gen.item()
-            train_bin_loss_total += loss_bin.item()
-
-            train_loss_total += loss_epoch.item()
-            progress.set_description(
-                "Train Loss: {:.4f}".format(train_loss_total / (i + 1))
+        distill_losses = {}
+        if teacher is not None:
+            with profiler.stage("teacher"):
+                with torch.no_grad(), autocast(device, params.precision):
+                    teacher_outputs = teacher(x, w)
+            loss_distill = distillation_loss(
+                (seg_output, reg_output, cls_output), teacher_outputs, params
             )
+            loss_epoch = (
+                1 - params.distill_alpha
+            ) * loss_epoch + params.distill_alpha * loss_distill
+            distill_losses["distill_loss"] = loss_distill
+
+        # IoU, classification accuracy and losses
+        with profiler.stage("metrics"):
+            train_metrics.update(
+                seg_output,
+                y,
+                reg_output,
+                e,
+                cls_output,
+                t,
+                loss=loss_epoch,
+                image_loss=loss_image,
+                gen_loss=loss_gen,
+                bin_loss=loss_bin,
+                **distill_losses,
+            )
+        return loss_epoch
+
+    start_epoch = 0
+    if params.resume:
+        # every rank loads the weights, only rank 0 saved its RNG state
+        state = load_checkpoint(
+            os.path.join(exp_out_dir, LAST_CHECKPOINT),
+            net,
+            opt,
+            scaler,
+            restore_rng=main_process,
+        )
+        start_epoch = state["epoch"] + 1
+        best_mse = state["best"]["gen_loss"]
+        best_val_iou = state["best"]["iou"]
+        best_val_acc = state["best"]["bin_acc"]
+        if main_process:
+            checkpoints.restore(state)
+            print("resuming from epoch", start_epoch + 1)
 
-            # learning
+    for epoch in range(start_epoch, params.ep):
+
+        model.train()
+        train_metrics.reset()
+        reset_peak_memory(device)
+        profiler.start_epoch(epoch)
+
+        batches = train_dl
+        if distributed:
+            train_sampler.set_epoch(epoch)
+            if native:
+                # ranks may fill different numbers of size buckets
+                batches = even_batches(train_dl, device)
+        # batches are copied to the device while the previous one computes
+        batches = profiler.loader(DevicePrefetcher(batches, device))
+
+        progress = tqdm(
+            enumerate(batches),
+            desc="Train Loss: ",
+            total=len(train_dl),
+            disable=not main_process,
+        )
+        for i, batch in progress:
             opt.zero_grad()
-            loss_epoch.backward()
-            opt.step()
+            n_batch = len(batch)
+            # accumulate the gradients of micro-batches; the loss of each is
+            # weighted by its share of the batch. Gradients are only
+            # all-reduced across ranks after the last micro-batch
+            starts = list(range(0, n_batch, micro_bs))
+            if len(starts) > 1 and n_batch - starts[-1] == 1:
+                # BatchNorm1d of the heads needs two samples in training
+                starts.pop()
+            stops = starts[1:] + [n_batch]
+            for start, stop in zip(starts, stops):
+                micro = batch.slice(start, stop)
+                sync = not distributed or stop == n_batch
+                with contextlib.nullcontext() if sync else model.no_sync():
+                    loss_epoch = train_step(micro)
+                    with profiler.stage("backward"):
+                        scaler.scale(loss_epoch * len(micro) / n_batch).backward()
+
+            if i % PROGRESS_INTERVAL == 0:
+                with profiler.stage("progress"):
+                    progress.set_description(
+                        "Train Loss: {:.4f}".format(train_metrics.mean_loss())
+                    )
 
+            # learning
+            with profiler.stage("optimizer"):
+                scaler.step(opt)
+                scaler.update()
+            profiler.step()
+
+        train_memory = peak_memory(device)
         torch.cuda.empty_cache()
 
         # evaluation
         model.eval()
+        val_metrics.reset()
 
-        val_loss_total, val_bin_acc_total = 0, 0
-        val_ious = []
-        val_image_loss_total, val_gen_loss_total, val_bin_loss_total = 0, 0, 0
-
-        progress = tqdm(enumerate(val_dl), desc="val Loss: ", total=len(val_dl))
+        progress = tqdm(
+            enumerate(DevicePrefetcher(val_dl, device)),
+            desc="val Loss: ",
+            total=len(val_dl),
+            disable=not main_process,
+        )
 
-        with torch.no_grad():
+        with torch.no_grad(), profiler.stage("validation"):
             for j, batch in progress:
-                x = batch["img"].float().to(device)
-                w = batch["weather"].float().to(device)
-                y = batch["fpt"].float().to(device)
-                e = batch["gen_output"].float().to(device)
-                t = batch["type"].long().to(device)
+                if val_transform is not None:
+                    x, y = val_transform(batch.img, batch.fpt)
+                else:
+                    x, y = batch.img, batch.fpt.float()
+                w, e, t = batch.weather, batch.gen_output, batch.type
 
-                seg_output, reg_output, cls_output = model(x, w)
-
-                # classification accuracy
-                bin_acc = multi_acc(cls_output, t)
-                val_bin_acc_total += bin_acc
+                with autocast(device, params.precision):
+                    seg_output, reg_output, cls_output = net(x, w)
+                seg_output, reg_output = seg_output.float(), reg_output.float()
+                cls_output = cls_output.float()
 
                 # derive losses
                 loss_image = loss_s(seg_output, y.unsqueeze(dim=1))
@@ -208,108 +479,117 @@ def train_model(
                     + params.weight_classification * loss_bin
                 )
 
-                val_loss_total += loss_epoch.item()
-                val_image_loss_total += loss_image.item()
-                val_bin_loss_total += loss_bin.item()
-                val_gen_loss_total += loss_gen.item()
-
-                # derive binary segmentation map from prediction
-                output_binary = np.zeros(seg_output.shape)
-                output_binary[seg_output.cpu().detach().numpy() >= 0] = 1
-
-                # derive IoU values
-                for k in range(y.shape[0]):
-                    z = jaccard_score(
-                        y[k].flatten().cpu().detach().numpy(),
-                        output_binary[k][0].flatten(),
-                    )
-                    if (
-                        np.sum(output_binary[k][0]) != 0
-                        and np.sum(y[k].cpu().detach().numpy()) != 0
-                    ):
-                        val_ious.append(z)
-
-                progress.set_description(
-                    "val Loss: {:.4f}".format(val_loss_total / (j + 1))
+                # IoU, classification accuracy and losses
+                val_metrics.update(
+                    seg_output,
+                    y,
+                    reg_output,
+                    e,
+                    cls_output,
+                    t,
+                    loss=loss_epoch,
+                    image_loss=loss_image,
+                    gen_loss=loss_gen,
+                    bin_loss=loss_bin,
                 )
+                if j % PROGRESS_INTERVAL == 0:
+                    progress.set_description(
+                        "val Loss: {:.4f}".format(val_metrics.mean_loss())
+                    )
 
-        print(
-            (
-                "Epoch {:d}: total train loss={:.3f}, seg loss={:.3f}, reg loss={:.3f}, cls loss={:.3f}, total val loss={:.3f}, "
-                " seg loss={:.3f}, reg loss={:.3f}, cls loss={:.3f}, train iou={:.3f}, val iou={:.3f}, train cls acc={:.3f}, val cls acc={:.3f}"
-            ).format(
-                epoch + 1,
-                train_loss_total / (i + 1),
-                train_image_loss_total / (i + 1),
-                train_gen_loss_total / (i + 1),
-                train_bin_loss_total / (i + 1),
-                val_loss_total / (j + 1),
-                val_image_loss_total / (j + 1),
-                val_gen_loss_total / (j + 1),
-                val_bin_loss_total / (j + 1),
-                np.average(train_ious),
-                np.average(val_ious),
-                train_bin_acc_total / (i + 1),
-                val_bin_acc_total / (j + 1),
-            )
-        )
-
-        experiment.log_metrics(
-            dict(
-                train_loss=train_loss_total / (i + 1),
-                train_image_loss=train_image_loss_total / (i + 1),
-                train_gen_loss=train_gen_loss_total / (i + 1),
-                train_bin_loss=train_bin_loss_total / (i + 1),
-                val_loss=val_loss_total / (j + 1),
-                val_image_loss=val_image_loss_total / (j + 1),
-                val_gen_loss=val_gen_loss_total / (j + 1),
-                val_bin_loss=val_bin_loss_total / (j + 1),
-                train_iou=np.average(train_ious),
-                val_iou=np.average(val_ious),
-                train_acc=train_acc_total / (i + 1),
-                val_acc=val_acc_total / (j + 1),
-                train_bin_acc=train_bin_acc_total / (i + 1),
-                val_bin_acc=val_bin_acc_total / (j + 1),
+        with profiler.stage("metrics_sync"):
+            train_metrics.all_reduce()
+            val_metrics.all_reduce()
+            train = train_metrics.compute()
+            val = val_metrics.compute()
+
+        # all ranks hold the same weights and metrics
+        if not main_process:
+            continue
+
+        with profiler.stage("logging"):
+            print(
+                (
+                    "Epoch {:d}: total train loss={:.3f}, seg loss={:.3f}, "
+                    "reg loss={:.3f}, cls loss={:.3f}, total val loss={:.3f}, "
+                    " seg loss={:.3f}, reg loss={:.3f}, cls loss={:.3f}, "
+                    "train iou={:.3f}, val iou={:.3f}, train cls acc={:.3f}, "
+                    "val cls acc={:.3f}, peak memory={:.0f} MiB"
+                ).format(
+                    epoch + 1,
+                    train["loss"],
+                    train["image_loss"],
+                    train["gen_loss"],
+                    train["bin_loss"],
+                    val["loss"],
+                    val["image_loss"],
+                    val["gen_loss"],
+                    val["bin_loss"],
+                    train["iou"],
+                    val["iou"],
+                    train["bin_acc"],
+                    val["bin_acc"],
+                    train_memory,
+                )
             )
-        )
 
-        if np.average(val_ious) >= best_val_iou:
-            best_val_iou = np.average(val_ious)
-            # save model checkpoint
-            torch.save(
-                model.state_dict(),
-                os.path.join(
-                    exp_out_dir,
-                    "segmentation_checkpoints/ep{:0d}_lr{:.0e}_bs{:02d}_mo{:.1f}_{:03d}.model".format(
-                        params.ep, params.lr, params.bs, params.mo, epoch
-                    ),
+            if teacher is not None:
+                experiment.log_metrics(
+                    dict(train_distill_loss=train["distill_loss"]), epoch=epoch
+                )
+            experiment.log_metrics(
+                dict(
+                    train_loss=train["loss"],
+                    train_image_loss=train["image_loss"],
+                    train_gen_loss=train["gen_loss"],
+                    train_bin_loss=train["bin_loss"],
+                    val_loss=val["loss"],
+                    val_image_loss=val["image_loss"],
+                    val_gen_loss=val["gen_loss"],
+                    val_bin_loss=val["bin_loss"],
+                    train_iou=train["iou"],
+                    val_iou=val["iou"],
+                    train_bin_acc=train["bin_acc"],
+                    val_bin_acc=val["bin_acc"],
+                    train_mae=train["mae"],
+                    val_mae=val["mae"],
+                    train_peak_memory=train_memory,
                 ),
+                epoch=epoch,
             )
 
-        if val_gen_loss_total / (j + 1) <= best_mse:
-            best_mse = val_gen_loss_total / (j + 1)
-            # save model checkpoint
-            torch.save(
-                model.state_dict(),
-                os.path.join(
-                    exp_out_dir,
-                    "regression_checkpoints/ep{:0d}_lr{:.0e}_bs{:02d}_mo{:.1f}_{:03d}.model".format(
-                        params.ep, params.lr, params.bs, params.mo, epoch
-                    ),
-                ),
+        # one snapshot serves all criteria the epoch is best on
+        criteria = []
+        if val["iou"] >= best_val_iou:
+            best_val_iou = val["iou"]
+            criteria.append("segmentation")
+
+        if val["gen_loss"] <= best_mse:
+            best_mse = val["gen_loss"]
+            criteria.append("regression")
+
+        if val["bin_acc"] >= best_val_acc:
+            best_val_acc = val["bin_acc"]
+            criteria.append("classification")
+
+        with profiler.stage("checkpoint"):
+            checkpoints.save(
+                epoch,
+                net,
+                opt,
+                scaler,
+                dict(iou=best_val_iou, gen_loss=best_mse, bin_acc=best_val_acc),
+                criteria,
             )
 
-        if val_bin_acc_total / (j + 1) >= best_val_acc:
-            best_val_acc = val_bin_acc_total / (j + 1)
-            torch.save(
-                model.state_dict(),
-                os.path.join(
-                    exp_out_dir,
-                    "classification_checkpoints/ep{:0d}_lr{:.0e}_bs{:02d}_mo{:.1f}_{:03d}.model".format(
-                        params.ep, params.lr, params.bs, params.mo, epoch
-                    ),
-                ),
-            )
+        report = profiler.end_epoch(train_dl.num_workers, train_memory)
+        if report is not None:
+            print(profiler.format_report(report))
+
+    if main_process:
+        checkpoints.close()
+        experiment.close()
+    profiler.close()
 
 
 def main():
@@ -362,13 +642,223 @@ def main():
         default="checkpoints",
         help="Path to checkpoint directory",
     )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default="cache",
+        help="Path to dataset cache directory",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=PRECISIONS,
+        help="Mixed precision mode (bf16 works on CPU, fp16 needs CUDA)",
+    )
+    parser.add_argument(
+        "--device_transforms",
+        action="store_true",
+        help="Normalize and randomize batches on the training device",
+    )
+    parser.add_argument(
+        "--store_dir",
+        type=str,
+        default=None,
+        help="Path to materialized tile stores (see materialize_multitask.py)",
+    )
+    parser.add_argument(
+        "--tile_cache",
+        type=str,
+        default="none",
+        choices=CACHE_MODES,
+        help="Keep decoded tiles in shared memory, filled on first access (lazy) "
+        "or at startup (eager)",
+    )
+    parser.add_argument(
+        "--heads",
+        type=str,
+        default="dense",
+        choices=HEADS,
+        help="Task heads; pooled heads train on 300x300 tiles at native resolution",
+    )
+    parser.add_argument(
+        "--width", type=float, default=1.0, help="Channel width multiplier"
+    )
+    parser.add_argument(
+        "--depth", type=int, default=4, help="Number of U-Net down/up stages"
+    )
+    parser.add_argument(
+        "--teacher_checkpoint",
+        type=str,
+        default=None,
+        help="Checkpoint of a trained model to distill into the trained model",
+    )
+    parser.add_argument(
+        "--teacher_heads",
+        type=str,
+        default="dense",
+        choices=HEADS,
+        help="Task heads of the teacher",
+    )
+    parser.add_argument(
+        "--teacher_width", type=float, default=1.0, help="Width of the teacher"
+    )
+    parser.add_argument(
+        "--teacher_depth", type=int, default=4, help="Depth of the teacher"
+    )
+    parser.add_argument(
+        "--distill_alpha",
+        type=float,
+        default=0.5,
+        help="Weight of the distillation loss against the ground truth loss",
+    )
+    parser.add_argument(
+        "--distill_temperature",
+        type=float,
+        default=2.0,
+        help="Temperature softening segmentation and classification logits",
+    )
+    parser.add_argument(
+        "--micro_bs",
+        type=int,
+        default=None,
+        help="Micro-batch size; gradients are accumulated up to the batch size",
+    )
+    parser.add_argument(
+        "--checkpoint_activations",
+        action="store_true",
+        help="Recompute U-Net activations in the backward pass to save memory",
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the experiment from its last checkpoint",
+    )
+    parser.add_argument(
+        "--keep_checkpoints",
+        type=int,
+        default=None,
+        help="Number of best checkpoints to keep per task; all by default",
+    )
+
+    parser.add_argument(
+        "--logger",
+        type=str,
+        default="comet",
+        choices=LOGGERS,
+        help="Experiment logger; jsonl and sqlite write to "
+        "<checkpoint_dir>/<exp_name>/logs",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Time the stages of every training step and write a trace",
+    )
+    parser.add_argument(
+        "--profile_steps",
+        type=str,
+        default=None,
+        help="start:end window of training steps to record with torch.profiler",
+    )
+
+    parser.add_argument(
+        "--nproc",
+        type=int,
+        default=1,
+        help="Number of training processes to spawn on this node; "
+        "not needed with torchrun",
+    )
+    parser.add_argument(
+        "--dist_backend",
+        type=str,
+        default="gloo",
+        choices=DIST_BACKENDS,
+        help="Backend of distributed training (gloo for CPUs, nccl for GPUs)",
+    )
+    parser.add_argument(
+        "--sync_bn",
+        action="store_true",
+        help="Compute BatchNorm statistics over the batches of all processes",
+    )
 
     args = parser.parse_args()
 
+    check_precision(device, args.precision)
+    if args.keep_checkpoints is not None and args.keep_checkpoints < 1:
+        parser.error("--keep_checkpoints must be at least 1")
+    if args.teacher_checkpoint is not None:
+        if args.heads == "pooled" and args.teacher_heads == "dense":
+            parser.error("a teacher with dense heads cannot see native tiles")
+    if args.sync_bn and args.heads == "pooled" and (args.micro_bs or args.bs) < args.bs:
+        # size buckets give ranks batches of different sizes, so they would
+        # run different numbers of synchronized BatchNorm passes and hang
+        parser.error("--sync_bn with pooled heads does not support --micro_bs")
+
+    if args.nproc > 1 and "WORLD_SIZE" not in os.environ:
+        # single node run without torchrun
+        os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+        os.environ.setdefault("MASTER_PORT", "29500")
+        torch.multiprocessing.spawn(run, args=(args,), nprocs=args.nproc)
+    else:
+        run(None, args)
+
+
+def run(rank, args):
+    """Train in one process of a (possibly) distributed run.
+    :param rank: rank given by `torch.multiprocessing.spawn`; `None` reads
+        it from the environment set by `torchrun`
+    :param args: parsed arguments"""
+    world_size = args.nproc if rank is not None else None
+    rank, world_size = init_distributed(args.dist_backend, rank, world_size)
+    local_rank = int(os.environ.get("LOCAL_RANK", rank))
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", world_size))
+
+    run_device = device
+    if world_size > 1:
+        if device.type == "cuda":
+            run_device = torch.device("cuda", local_rank)
+            torch.cuda.set_device(run_device)
+        else:
+            # share the cores of a node between its processes
+            torch.set_num_threads(max(torch.get_num_threads() // local_world_size, 1))
+
     channels = [int(c) for c in args.channels.split(",")]
 
-    model = MultiTaskModel(n_channels=len(channels), n_classes=1)
-    model.to(device)
+    model = MultiTaskModel(
+        n_channels=len(channels),
+        n_classes=1,
+        heads=args.heads,
+        width=args.width,
+        depth=args.depth,
+    )
+    model.checkpoint_activations = args.checkpoint_activations
+    if args.sync_bn and world_size > 1:
+        model = convert_sync_batchnorm(model)
+    if args.precision != "fp32":
+        keep_batchnorm_fp32(model)
+    model.to(run_device)
+    if world_size > 1:
+        # all ranks start from the weights of rank 0
+        model = DistributedDataParallel(
+            model, device_ids=[run_device] if run_device.type == "cuda" else None
+        )
+
+    teacher = None
+    if args.teacher_checkpoint is not None:
+        teacher = MultiTaskModel(
+            n_channels=len(channels),
+            n_classes=1,
+            heads=args.teacher_heads,
+            width=args.teacher_width,
+            depth=args.teacher_depth,
+        )
+        teacher.load_state_dict(
+            torch.load(args.teacher_checkpoint, map_location=torch.device("cpu"))
+        )
+        if args.precision != "fp32":
+            keep_batchnorm_fp32(teacher)
+        teacher.to(run_device)
 
     # initialize optimizer
     opt = optim.SGD(model.parameters(), lr=args.lr, momentum=args.mo)
@@ -383,8 +873,15 @@ def main():
         seglabeldir=args.seg_label_dir,
         reg_file=args.reg_file,
         checkpoint_dir=args.checkpoint_dir,
+        cache_dir=args.cache_dir,
+        store_dir=args.store_dir,
+        teacher=teacher,
+        device=run_device,
     )
 
+    if is_distributed():
+        dist.destroy_process_group()
+
 
 if __name__ == "__main__":
     main()